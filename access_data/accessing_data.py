@@ -6,12 +6,19 @@ The general flow:
  - Two ways to go over the frames:
    - dataview.get_iterator()
    - dataview.to_list()
+ - Cache the frames list of snapshot versions locally with a CachedDataView.
+ - Download the frames with dataview.prefetch_files() or with a bounded look-ahead FramePrefetcher.
+ - Keep the downloaded frames under a disk budget with a SourceCache.
 """
 
 from allegroai import DataView, IterationOrder, Task
 
 import cv2
 
+from dataview_cache import CachedDataView
+from frame_prefetcher import FramePrefetcher
+from source_cache import SourceCache
+
 task = Task.init(project_name="examples", task_name="dv accessing")
 
 
@@ -76,7 +83,8 @@ for idx, frame in enumerate(dataview.get_iterator()):
 
 # A complex query example with more sophisticated filter
 # First, set the DataView to iterate randomly over our images
-dataview = DataView(iteration_order=IterationOrder.random)
+# The CachedDataView keeps the frames list of snapshot versions locally, so the next runs do not query the server again
+dataview = CachedDataView("~/.clearml/dataview_cache", iteration_order=IterationOrder.random)
 
 # Second, set a seed number for random order
 dataview.set_iteration_parameters(random_seed=1337)
@@ -93,14 +101,33 @@ dataview.add_multi_query(
 # Get a list of SingleFrames
 frames = dataview.to_list()
 
+# Instead of pre-fetching the whole version, download only the next 8 frames in background threads
+# (stop reading ahead while more than 256MB are waiting to be used)
+prefetcher = FramePrefetcher(frames, lookahead=8, max_bytes=256 * 1024 * 1024)
 
-for idx, frame in enumerate(frames):
-    # Download the file locally
-    local_file = frame.get_local_source()
-
+for idx, (frame, local_file) in enumerate(prefetcher):
+    # The file is already downloaded locally
     print(local_file, frame.annotations)
     im = cv2.imread(local_file)
     cv2.imshow('image', im)
     cv2.waitKey()
     if idx == 10:  # stop after 10 files
         break
+
+# How many frames we waited for, and for how long
+print(prefetcher.stats)
+
+# Keep the downloaded files in a 2GB cache, evicting the least recently used ones
+# (the prefetched frames are pinned until they are released)
+source_cache = SourceCache("/tmp/allegro_sources", max_size_mb=2 * 1024)
+prefetcher = FramePrefetcher(frames, lookahead=8, source_cache=source_cache)
+
+for idx, (frame, local_file) in enumerate(prefetcher):
+    im = cv2.imread(local_file)
+    source_cache.release(frame)
+    print(local_file, im.shape)
+    if idx == 10:  # stop after 10 files
+        break
+
+# How many files were already in the cache, downloaded and evicted
+print(source_cache.stats())
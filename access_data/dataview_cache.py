@@ -0,0 +1,128 @@
+"""
+Local cache of DataView query results.
+
+Resolving the frames of a big version (get_count(), to_list()) can take minutes, even when the queried versions are
+committed snapshots that cannot change. CachedDataView records the queries and iteration parameters it is given,
+and when all the queried versions are snapshots, it stores the resolved frames list in a compressed file, keyed by a
+hash of the queries, the iteration parameters and the versions ids. The next runs with the same DataView load the
+frames from that file without querying the server. Queries on editable (draft) versions are never cached.
+
+Usage:
+    dataview = CachedDataView(cache_dir="~/.clearml/dataview_cache", name="train")
+    dataview.add_query(dataset_name="COCO - Common Objects in Context", version_name="Train2017 version")
+    frames = dataview.to_list()
+"""
+import hashlib
+import json
+import os
+import pickle
+import zlib
+
+from allegroai import DatasetVersion, DataView
+
+
+def _get_version(query):
+    try:
+        return DatasetVersion.get_version(
+            dataset_id=query.get("dataset_id"),
+            version_id=query.get("version_id"),
+            dataset_name=query.get("dataset_name"),
+            version_name=query.get("version_name"),
+        )
+    except ValueError:
+        # the SDK raises ValueError when no version matches, the query is then not cached, any other error (e.g. the
+        # server is not reachable) is raised
+        return None
+
+
+class CachedDataView(object):
+    def __init__(self, cache_dir, *args, **kwargs):
+        """
+        :param cache_dir: Folder for the cached frames lists
+        :type cache_dir: str
+        :param args: DataView arguments
+        :param kwargs: DataView keyword arguments (e.g. name, iteration_order)
+        """
+        self._cache_dir = os.path.expanduser(cache_dir)
+        self._dataview = DataView(*args, **kwargs)
+        self._key_data = {"dataview": [repr(a) for a in args] + sorted((k, repr(v)) for k, v in kwargs.items()),
+                          "queries": [], "iteration": []}
+        self._frames = None
+        self._key = None
+        os.makedirs(self._cache_dir, exist_ok=True)
+
+    @property
+    def dataview(self):
+        return self._dataview
+
+    def add_query(self, **kwargs):
+        self._key_data["queries"].append(("add_query", kwargs))
+        self._frames = self._key = None
+        return self._dataview.add_query(**kwargs)
+
+    def add_multi_query(self, **kwargs):
+        self._key_data["queries"].append(("add_multi_query", kwargs))
+        self._frames = self._key = None
+        return self._dataview.add_multi_query(**kwargs)
+
+    def set_iteration_parameters(self, **kwargs):
+        self._key_data["iteration"].append(kwargs)
+        self._frames = self._key = None
+        return self._dataview.set_iteration_parameters(**kwargs)
+
+    def _cache_key(self):
+        """
+        :return: the cache key, or "" if any of the queried versions can still change
+        """
+        if self._key is None:
+            self._key = self._compute_cache_key()
+        return self._key
+
+    def _compute_cache_key(self):
+        version_ids = []
+        for _, query in self._key_data["queries"]:
+            version = _get_version(query)
+            if version is None or getattr(version, "is_draft", True):
+                return ""
+            version_ids.append(getattr(version, "version_id", None) or getattr(version, "id", None))
+        if not version_ids:
+            return ""
+        key_data = dict(self._key_data, version_ids=version_ids)
+        return hashlib.sha1(json.dumps(key_data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _get_frames(self):
+        if self._frames is not None:
+            return self._frames
+        key = self._cache_key()
+        cache_file = os.path.join(self._cache_dir, "{}.pkl.z".format(key)) if key else None
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file, "rb") as f:
+                self._frames = pickle.loads(zlib.decompress(f.read()))
+            return self._frames
+
+        self._frames = self._dataview.to_list()
+        if cache_file:
+            with open(cache_file + ".tmp", "wb") as f:
+                f.write(zlib.compress(pickle.dumps(self._frames, protocol=pickle.HIGHEST_PROTOCOL)))
+            os.rename(cache_file + ".tmp", cache_file)
+        return self._frames
+
+    def to_list(self):
+        return list(self._get_frames())
+
+    def get_iterator(self, *args, **kwargs):
+        # snapshot versions: iterate the cached list, draft versions: iterate from the server as usual
+        if not self._cache_key():
+            return self._dataview.get_iterator(*args, **kwargs)
+        return iter(self._get_frames())
+
+    def get_count(self):
+        if not self._cache_key():
+            return self._dataview.get_count()
+        return len(self._get_frames()), None
+
+    def __getattr__(self, item):
+        # everything else (e.g. prefetch_files) goes to the DataView
+        if item.startswith("_"):
+            raise AttributeError(item)
+        return getattr(self._dataview, item)
@@ -0,0 +1,117 @@
+"""
+Fast decode path for small training images.
+
+The reference transform (see pytorch_with_iter_dataset.default_transform) decodes every image at full resolution as
+RGB, and only then resizes it to 28x28 and converts it to grayscale, so most of the decode work is thrown away.
+Here the JPEG is decoded directly in grayscale, at the smallest DCT scale (1/2, 1/4 or 1/8) that still gives at
+least 4 times the target size (see PIL Image.draft), closer scales alias the DCT blocks into the final pixels (at 2
+times the target size, pixels still differ from the reference by up to 0.15).
+The final resize and the float conversion are done once per batch, in ResizeCollate, and not per sample.
+
+Compare the fast path with the reference path on a few images (fails if the difference exceeds the tolerance) with:
+
+python fast_decode.py ../register_data/samples/*.jpg
+"""
+from argparse import ArgumentParser
+from collections import defaultdict
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.nn import functional as F
+from torch.utils.data import default_collate
+
+# the decoded image is at least this many times the target size
+DRAFT_MARGIN = 4
+# maximum absolute difference of a pixel (in [0, 1]) between the fast path and the reference path
+MAX_ABS_TOLERANCE = 0.05
+
+
+def draft_decode(img_path, size=(28, 28)):
+    """
+    Decode an image in grayscale, with reduced resolution when the format supports it (JPEG)
+    :param img_path: Path to the image file
+    :type img_path: str
+    :param size: The final (height, width), the image is decoded to the smallest scale not smaller than DRAFT_MARGIN
+        times it
+    :type size: tuple
+    :return: grayscale PIL image
+    """
+    img = Image.open(img_path)
+    # draft() expects (width, height), and is a no-op for formats without scaled decoding
+    img.draft("L", (size[1] * DRAFT_MARGIN, size[0] * DRAFT_MARGIN))
+    return img.convert("L")
+
+
+def pil_to_uint8_tensor(img):
+    """
+    :param img: grayscale PIL image
+    :return: uint8 tensor of shape (1, H, W)
+    """
+    return torch.from_numpy(np.array(img, dtype=np.uint8)).unsqueeze(0)
+
+
+def resize_batch(images, size=(28, 28)):
+    """
+    Resize a list of (C, H, W) uint8 images and convert them to a single float batch.
+    Images with the same shape are resized together in one interpolate call.
+    :param images: list of uint8 tensors
+    :param size: Target (height, width)
+    :return: float tensor of shape (N, C, height, width) with values in [0, 1]
+    """
+    by_shape = defaultdict(list)
+    for idx, img in enumerate(images):
+        by_shape[tuple(img.shape)].append(idx)
+
+    batch = torch.empty((len(images), images[0].shape[0]) + tuple(size), dtype=torch.float)
+    for shape, indexes in by_shape.items():
+        group = torch.stack([images[i] for i in indexes]).float()
+        if shape[1:] != tuple(size):
+            group = F.interpolate(group, size=size, mode="bilinear", align_corners=False, antialias=True)
+        batch[indexes] = group
+    return batch.div_(255.).clamp_(0., 1.)
+
+
+class ResizeCollate(object):
+    """
+    DataLoader collate_fn for samples decoded with draft_decode, resize and convert the whole batch in one step
+    """
+
+    def __init__(self, size=(28, 28)):
+        self.size = tuple(size)
+
+    def __call__(self, batch):
+        images, labels = zip(*batch)
+        return resize_batch(list(images), self.size), default_collate(list(labels))
+
+
+def compare_with_reference(img_paths, reference_transform, size=(28, 28), tolerance=None):
+    """
+    Run both decode paths over the same images
+    :param img_paths: list of image paths
+    :param reference_transform: The reference transform, gets an RGB PIL image and returns a (1, H, W) float tensor
+    :param size: Target (height, width)
+    :param tolerance: If given, raise ValueError when the max absolute difference exceeds it
+    :return: tuple of (max absolute difference, mean absolute difference)
+    """
+    reference = torch.stack([reference_transform(Image.open(p).convert("RGB")) for p in img_paths])
+    fast = resize_batch([pil_to_uint8_tensor(draft_decode(p, size)) for p in img_paths], size)
+    diff = (reference - fast).abs()
+    max_diff, mean_diff = diff.max().item(), diff.mean().item()
+    if tolerance is not None and max_diff > tolerance:
+        worst = img_paths[int(diff.flatten(1).max(dim=1)[0].argmax())]
+        raise ValueError("Fast decode differs from the reference by {:.4f} (tolerance {:.4f}) on {}".format(
+            max_diff, tolerance, worst))
+    return max_diff, mean_diff
+
+
+if __name__ == '__main__':
+    from pytorch_with_iter_dataset import default_transform
+
+    parser = ArgumentParser(description='Compare the fast decode path with the reference transform')
+    parser.add_argument('images', nargs='+', help='Image files to compare on')
+    parser.add_argument('--tolerance', type=float, help='Maximum absolute pixel difference', default=MAX_ABS_TOLERANCE)
+    args = parser.parse_args()
+
+    max_diff, mean_diff = compare_with_reference(args.images, default_transform(), tolerance=args.tolerance)
+    print("max abs diff: {:.4f}, mean abs diff: {:.4f}".format(max_diff, mean_diff))
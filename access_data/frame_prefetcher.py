@@ -0,0 +1,134 @@
+"""
+Bounded look-ahead download of frames local sources.
+
+dataview.prefetch_files() downloads the entire version in the background, regardless of where the consumer is.
+FramePrefetcher wraps the frames of dataview.get_iterator() (or dataview.to_list()) and downloads only the next
+`lookahead` frames on a thread pool, and stops reading ahead while the downloaded but not yet consumed files exceed
+`max_bytes`. The frames are returned in their original order, together with their local source (None for the frames
+`is_cached` says are not needed, e.g. already in a samples cache, they are never downloaded).
+
+Usage:
+    prefetcher = FramePrefetcher(dataview.get_iterator(), lookahead=16, max_bytes=512 * 1024 * 1024)
+    for frame, local_file in prefetcher:
+        ...
+    print(prefetcher.stats)
+"""
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from operator import methodcaller
+from time import time
+
+from allegroai import FrameGroup
+
+
+def resolve_local_source(frame, source_cache=None):
+    """
+    Download the frame source (cached)
+    :param frame: SingleFrame or FrameGroup
+    :param source_cache: If given, download through this SourceCache and pin the files until the consumer releases
+        them (see source_cache.py)
+    :return: tuple of (local source, size in bytes), for a FrameGroup the local source is a dict of
+        frame name to local source
+    """
+    if source_cache is not None:
+        get_local_source = partial(source_cache.get, pin=True)
+    else:
+        get_local_source = methodcaller("get_local_source")
+    if isinstance(frame, FrameGroup):
+        local_source = {name: get_local_source(single_frame) for name, single_frame in frame.items()}
+        return local_source, sum(_file_size(f) for f in local_source.values())
+    local_source = get_local_source(frame)
+    return local_source, _file_size(local_source)
+
+
+def single_frames(frame):
+    """
+    :return: list of the SingleFrames of a SingleFrame or a FrameGroup
+    """
+    return list(frame.values()) if isinstance(frame, FrameGroup) else [frame]
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+class FramePrefetcher(object):
+    def __init__(self, frames, lookahead=16, max_bytes=None, num_threads=4, source_cache=None, is_cached=None):
+        """
+        :param frames: Iterable of frames, e.g. dataview.get_iterator() or dataview.to_list()
+        :param lookahead: Maximum number of frames downloaded ahead of the consumer
+        :type lookahead: int
+        :param max_bytes: Stop reading ahead while the downloaded frames waiting for the consumer exceed this size
+            (at least one frame is always downloaded), None for no limit
+        :type max_bytes: int
+        :param num_threads: Number of download threads
+        :type num_threads: int
+        :param source_cache: If given, download through this SourceCache, the consumer must release every frame
+            (see source_cache.py)
+        :type source_cache: SourceCache
+        :param is_cached: Optional callable, the frames it returns True for are not downloaded
+        :type is_cached: callable
+        """
+        self._frames = frames
+        self._lookahead = max(1, int(lookahead))
+        self._max_bytes = max_bytes
+        self._num_threads = num_threads
+        self._source_cache = source_cache
+        self._is_cached = is_cached
+        self.stats = {"frames": 0, "bytes": 0, "blocked": 0, "blocked_seconds": 0.0}
+
+    def __iter__(self):
+        frames = iter(self._frames)
+        pending = deque()
+        exhausted = False
+        pool = ThreadPoolExecutor(max_workers=self._num_threads)
+        try:
+            while True:
+                while not exhausted and len(pending) < self._lookahead and not self._over_budget(pending):
+                    try:
+                        frame = next(frames)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if self._is_cached is not None and self._is_cached(frame):
+                        future = Future()
+                        future.set_result((None, 0))
+                    else:
+                        future = pool.submit(resolve_local_source, frame, self._source_cache)
+                    pending.append((frame, future))
+                if not pending:
+                    return
+
+                frame, future = pending.popleft()
+                if not future.done():
+                    # the consumer is faster than the downloads
+                    self.stats["blocked"] += 1
+                    start = time()
+                    future.result()
+                    self.stats["blocked_seconds"] += time() - start
+                local_source, size = future.result()
+                self.stats["frames"] += 1
+                self.stats["bytes"] += size
+                yield frame, local_source
+        finally:
+            for frame, future in pending:
+                if not future.cancel() and self._source_cache is not None:
+                    # downloaded (or still downloading) but never consumed, unpin it once the download finished
+                    future.add_done_callback(partial(self._release, frame))
+            pool.shutdown(wait=False)
+
+    def _release(self, frame, future):
+        if future.exception() is None and future.result()[0] is not None:
+            for single_frame in single_frames(frame):
+                self._source_cache.release(single_frame)
+
+    def _over_budget(self, pending):
+        if not self._max_bytes or not pending:
+            return False
+        ready_bytes = sum(future.result()[1] for _, future in pending if future.done() and not future.exception())
+        return ready_bytes >= self._max_bytes
@@ -0,0 +1,228 @@
+"""
+Local label index of a version, for class-balanced sampling without new queries.
+
+Changing the class mix of a training run (e.g. roi_query="car", or roi_queries for "aeroplane" and "person") means a
+new DataView and new server queries. LabelIndex is built once from the frames (and annotations) of a version, and maps
+every label to the sorted array of the indexes of the frames with that label (label -> frame indexes, in a single
+concatenated array with per label offsets). It is saved to a small .npz file, so the label counts and the frames of any
+label are available instantly, and LabelBalancedSampler draws class-balanced (or custom weighted) samples from it in
+O(1) per draw: a label is drawn with the alias method, then a frame of that label uniformly. The sampler position (epoch
+and samples consumed by the model) can be saved and restored, so a resumed run continues the same draws.
+
+The frame indexes are positions in the frames list the index was built from (e.g. dataview.to_list(), see
+MyDataModule --data.label_index in pytorch_with_iter_dataset.py). Frames without annotations are never sampled.
+
+You can build an index and print the label counts from this dir with:
+
+python label_index.py --dataset "COCO - Common Objects in Context" --version "Train2017 version" --out train_labels.npz
+"""
+from argparse import ArgumentParser
+
+import numpy as np
+from torch.utils.data import Sampler
+
+from allegroai import DataView, FrameGroup, Task
+
+
+def frame_labels(frame):
+    """
+    :param frame: SingleFrame or FrameGroup
+    :return: set of the labels of all the frame annotations
+    """
+    single_frames = list(frame.values()) if isinstance(frame, FrameGroup) else [frame]
+    annotations = [a for f in single_frames for a in f.annotations or []]
+    if isinstance(frame, FrameGroup):
+        annotations.extend(getattr(frame, "global_annotations", None) or [])
+    return {label for annotation in annotations for label in annotation.labels or []}
+
+
+class LabelIndex(object):
+    def __init__(self, labels, frame_ids, offsets, indexes):
+        """
+        :param labels: Array of label names
+        :param frame_ids: Array of the frame ids, in the frames list order
+        :param offsets: (L + 1) offsets of every label frames in indexes
+        :param indexes: The frame indexes of all the labels, concatenated
+        """
+        self.labels = np.asarray(labels, dtype=str)
+        self.frame_ids = np.asarray(frame_ids, dtype=str)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.indexes = np.asarray(indexes, dtype=np.int64)
+        self._label_ids = {label: i for i, label in enumerate(self.labels.tolist())}
+
+    @classmethod
+    def build(cls, frames):
+        """
+        :param frames: list of SingleFrame or FrameGroup (e.g. dataview.to_list())
+        :return: LabelIndex of the frames
+        """
+        label_ids, pairs_label, pairs_frame, frame_ids = {}, [], [], []
+        for frame_index, frame in enumerate(frames):
+            frame_ids.append(frame.id)
+            for label in frame_labels(frame):
+                pairs_label.append(label_ids.setdefault(label, len(label_ids)))
+                pairs_frame.append(frame_index)
+        pairs_label = np.asarray(pairs_label, dtype=np.int64)
+        # stable sort: the frame indexes stay sorted inside every label
+        order = np.argsort(pairs_label, kind="stable")
+        counts = np.bincount(pairs_label, minlength=len(label_ids))
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        labels = sorted(label_ids, key=label_ids.get)
+        return cls(labels, frame_ids, offsets, np.asarray(pairs_frame, dtype=np.int64)[order])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["labels"], data["frame_ids"], data["offsets"], data["indexes"])
+
+    def save(self, path):
+        """
+        :param path: The .npz file path
+        """
+        np.savez(path, labels=self.labels, frame_ids=self.frame_ids, offsets=self.offsets, indexes=self.indexes)
+
+    def __len__(self):
+        # number of frames
+        return len(self.frame_ids)
+
+    def counts(self):
+        """
+        :return: dictionary of label to number of frames with that label
+        """
+        return dict(zip(self.labels.tolist(), np.diff(self.offsets).tolist()))
+
+    def frames_of(self, label):
+        """
+        :return: sorted array of the indexes of the frames with the label
+        """
+        label_id = self._label_ids.get(label)
+        if label_id is None:
+            return self.indexes[:0]
+        return self.indexes[self.offsets[label_id]:self.offsets[label_id + 1]]
+
+    def matches(self, frames):
+        """
+        :return: True if the index was built from these frames (same frames in the same order)
+        """
+        return len(frames) == len(self.frame_ids) and all(
+            frame.id == frame_id for frame, frame_id in zip(frames, self.frame_ids.tolist()))
+
+
+def alias_table(weights):
+    """
+    Walker/Vose alias table, to draw from a discrete distribution in O(1)
+    :param weights: (K,) non-negative weights
+    :return: tuple of (probability, alias) arrays
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    count = len(weights)
+    scaled = weights * count / weights.sum()
+    probability = np.ones(count)
+    alias = np.arange(count)
+    small = [i for i in range(count) if scaled[i] < 1.]
+    large = [i for i in range(count) if scaled[i] >= 1.]
+    while small and large:
+        s, g = small.pop(), large.pop()
+        probability[s], alias[s] = scaled[s], g
+        scaled[g] -= 1. - scaled[s]
+        (small if scaled[g] < 1. else large).append(g)
+    return probability, alias
+
+
+class LabelBalancedSampler(Sampler):
+    """
+    Draw frame indexes with per label weights, from a LabelIndex
+    """
+
+    def __init__(self, index, class_weights=None, num_samples=None, seed=0, block_size=4096):
+        """
+        :param index: LabelIndex of the dataset frames
+        :param class_weights: Dictionary of label to weight, the labels not in it are not sampled
+            (default: the same weight for all the labels, i.e. class-balanced)
+        :param num_samples: Number of samples per epoch (default: the number of frames)
+        :param seed: Random seed, the epoch number is added to it (see set_epoch)
+        :param block_size: Number of samples drawn together
+        """
+        counts = np.diff(index.offsets)
+        if class_weights is None:
+            weights = (counts > 0).astype(np.float64)
+        else:
+            unknown = set(class_weights) - set(index.labels.tolist())
+            if unknown:
+                raise ValueError("Unknown labels {}".format(sorted(unknown)))
+            weights = np.array([float(class_weights.get(label, 0.)) for label in index.labels.tolist()])
+            # labels without frames cannot be drawn
+            weights[counts == 0] = 0.
+        if not len(weights) or weights.sum() <= 0:
+            raise ValueError("No label to sample from")
+        self._index = index
+        self._counts = counts
+        self._probability, self._alias = alias_table(weights)
+        self._num_samples = num_samples or len(index)
+        self._seed = seed
+        self._epoch = 0
+        self._block_size = block_size
+        # samples of the current epoch consumed by the model (see record_batch), and to skip when resuming
+        self._consumed = 0
+        self._resume = 0
+
+    def set_epoch(self, epoch):
+        if epoch != self._epoch:
+            self._consumed = self._resume = 0
+        self._epoch = epoch
+
+    def record_batch(self, size):
+        """
+        Record a batch consumed by the model, the position saved by state_dict()
+        :param size: Number of samples in the batch
+        """
+        self._consumed += size
+
+    def state_dict(self):
+        return {"epoch": self._epoch, "consumed": self._consumed}
+
+    def load_state_dict(self, state_dict):
+        """
+        Resume from a saved position: the next iteration of the same epoch skips the consumed samples
+        """
+        self._epoch = state_dict.get("epoch", 0)
+        self._consumed = self._resume = state_dict.get("consumed", 0)
+
+    def __iter__(self):
+        rnd = np.random.RandomState((self._seed + self._epoch) % 2 ** 32)
+        # the skipped samples are drawn (the same random sequence), but never loaded
+        skip, self._resume = self._resume, 0
+        self._consumed = skip
+        remaining = self._num_samples
+        while remaining > 0:
+            size = min(self._block_size, remaining)
+            # the label (alias method), then a frame of the label
+            column = rnd.randint(len(self._probability), size=size)
+            labels = np.where(rnd.random_sample(size) < self._probability[column], column, self._alias[column])
+            positions = (rnd.random_sample(size) * self._counts[labels]).astype(np.int64)
+            frame_indexes = self._index.indexes[self._index.offsets[labels] + positions]
+            for frame_index in frame_indexes[min(skip, size):].tolist():
+                yield frame_index
+            skip = max(0, skip - size)
+            remaining -= size
+
+    def __len__(self):
+        return self._num_samples
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Build the label index of a version and print the label counts')
+
+    parser.add_argument('--dataset', type=str, help='Dataset name', required=True)
+    parser.add_argument('--version', type=str, help='Version name', required=True)
+    parser.add_argument('--out', type=str, help='Output index file (.npz)', required=True)
+
+    args = parser.parse_args()
+
+    task = Task.init(project_name="examples", task_name="label index")
+    dataview = DataView(name="label index")
+    dataview.add_query(dataset_name=args.dataset, version_name=args.version)
+    label_index = LabelIndex.build(dataview.to_list())
+    label_index.save(args.out)
+    for label, count in sorted(label_index.counts().items(), key=lambda item: -item[1]):
+        print("{:<30} {}".format(label, count))
@@ -0,0 +1,198 @@
+"""
+Per stage timing of the data pipeline.
+
+PipelineStats records the duration of each stage of the samples loading (iterator fetch, local source download, image
+decode, transform, collate) in every DataLoader worker, and writes them to a per worker jsonl file in `stats_dir`,
+tagged with the name of the loader (e.g. "train" or "val"). The measures are written every `flush_every` measures or
+`flush_seconds` seconds, and a worker writes its last measures when it exits (including the DataLoader workers leaving
+with os._exit), so the measures of workers still running at the end of an epoch are reported with the next epoch.
+At the end of every training epoch, PipelineStatsCallback (running in the main process, where it also measures the
+time waiting for data and the model step) aggregates all the workers files and reports the latency percentiles (the
+stages of the loaders other than "train" are reported apart, e.g. "val_decode"), the data wait fraction and the
+throughput as scalars of the current Task, or to `stats_dir/summary.jsonl` when there is
+no Task.
+
+When the stats are disabled, NullStats is used instead, and every measure point costs a single no-op method call.
+"""
+import glob
+import json
+import os
+from collections import defaultdict
+from multiprocessing import util
+from time import perf_counter
+
+import numpy as np
+import pytorch_lightning as pl
+from torch.utils.data import default_collate
+
+from allegroai import Task
+
+PERCENTILES = (50, 90, 99)
+
+
+class NullStats(object):
+    def clock(self):
+        return 0.
+
+    def lap(self, stage, start):
+        return 0.
+
+    def flush(self):
+        pass
+
+
+class PipelineStats(object):
+    def __init__(self, stats_dir, flush_every=256, loader="train", flush_seconds=5.):
+        """
+        :param stats_dir: Folder for the per worker stats files
+        :type stats_dir: str
+        :param flush_every: Write the measured durations to the worker file every N measures
+        :type flush_every: int
+        :param loader: Name of the DataLoader the stats are measured in, the records are tagged with it
+        :type loader: str
+        :param flush_seconds: Also write the measured durations when the last write is older than this
+        :type flush_seconds: float
+        """
+        self._stats_dir = stats_dir
+        self._flush_every = flush_every
+        self._loader = loader
+        self._flush_seconds = flush_seconds
+        self._flushed_at = perf_counter()
+        self._samples = defaultdict(list)
+        self._measures = 0
+        self._pid = os.getpid()
+        os.makedirs(stats_dir, exist_ok=True)
+
+    def clock(self):
+        return perf_counter()
+
+    def lap(self, stage, start):
+        """
+        Record the duration of a stage
+        :param stage: Stage name
+        :param start: The stage start time, as returned by clock() or a previous lap()
+        :return: current time, to be used as the start of the next stage
+        """
+        now = perf_counter()
+        if self._pid != os.getpid():
+            # forked into a DataLoader worker, drop what was measured in the parent process
+            self.drain()
+            self._pid = os.getpid()
+            # DataLoader workers leave with os._exit, only the multiprocessing finalizers run before it
+            util.Finalize(self, self.flush, exitpriority=10)
+        self._samples[stage].append(now - start)
+        self._measures += 1
+        if self._measures >= self._flush_every or now - self._flushed_at >= self._flush_seconds:
+            self.flush()
+        return now
+
+    def drain(self):
+        """
+        :return: dictionary of stage name to list of durations measured since the last drain/flush
+        """
+        samples = self._samples
+        self._samples, self._measures = defaultdict(list), 0
+        return samples
+
+    def flush(self):
+        self._flushed_at = perf_counter()
+        if not self._measures:
+            return
+        with open(os.path.join(self._stats_dir, "worker_{}.jsonl".format(os.getpid())), "a") as f:
+            f.write(json.dumps({"loader": self._loader, "durations": self.drain()}) + "\n")
+
+
+class TimedCollate(object):
+    """
+    collate_fn wrapper measuring the collate stage
+    """
+
+    def __init__(self, collate_fn, stats):
+        self._collate_fn = collate_fn or default_collate
+        self._stats = stats
+
+    def __call__(self, batch):
+        start = self._stats.clock()
+        ret = self._collate_fn(batch)
+        self._stats.lap("collate", start)
+        return ret
+
+
+class PipelineStatsCallback(pl.Callback):
+    """
+    Aggregate the workers stats and report them at the end of each training epoch
+    """
+
+    def __init__(self, stats_dir, stats=None):
+        """
+        :param stats_dir: Folder of the workers stats files
+        :param stats: Optional list of the PipelineStats of the DataLoaders, flushed at the end of every epoch (the
+            measures of the DataLoaders without workers are made in the main process)
+        """
+        self._stats_dir = stats_dir
+        self._stats = stats or []
+        self._offsets = {}
+        self._main = PipelineStats(stats_dir, flush_every=10 ** 9, loader="main", flush_seconds=float("inf"))
+        self._batch_start = self._batch_end = None
+        self._epoch_start = None
+        self._samples = 0
+
+    def on_fit_start(self, trainer, pl_module):
+        for stats_file in glob.glob(os.path.join(self._stats_dir, "worker_*.jsonl")):
+            os.remove(stats_file)
+        self._offsets = {}
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._epoch_start = self._batch_end = perf_counter()
+        self._samples = 0
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, *args):
+        self._batch_start = self._main.lap("data_wait", self._batch_end)
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, *args):
+        self._batch_end = self._main.lap("model_step", self._batch_start)
+        self._samples += len(batch[0])
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        epoch_seconds = perf_counter() - self._epoch_start
+        for stats in self._stats:
+            stats.flush()
+        durations = self._read_workers()
+        for stage, values in self._main.drain().items():
+            durations[stage].extend(values)
+
+        scalars = {}
+        for stage, values in durations.items():
+            for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                scalars["{}/p{}_ms".format(stage, p)] = float(value) * 1000.
+        wait, step = sum(durations.get("data_wait", [])), sum(durations.get("model_step", []))
+        scalars["pipeline/data_wait_fraction"] = wait / (wait + step) if wait + step else 0.
+        scalars["pipeline/samples_per_sec"] = self._samples / epoch_seconds if epoch_seconds else 0.
+        self._report(scalars, trainer.current_epoch)
+
+    def _read_workers(self):
+        durations = defaultdict(list)
+        for stats_file in glob.glob(os.path.join(self._stats_dir, "worker_*.jsonl")):
+            with open(stats_file, "r") as f:
+                f.seek(self._offsets.get(stats_file, 0))
+                for line in iter(f.readline, ""):
+                    if not line.endswith("\n"):
+                        # partially written line, read it on the next epoch
+                        break
+                    record = json.loads(line)
+                    loader = record.get("loader", "train")
+                    for stage, values in record["durations"].items():
+                        durations[stage if loader == "train" else "{}_{}".format(loader, stage)].extend(values)
+                    self._offsets[stats_file] = f.tell()
+        return durations
+
+    def _report(self, scalars, epoch):
+        task = Task.current_task()
+        if task:
+            logger = task.get_logger()
+            for name, value in scalars.items():
+                title, series = name.split("/", 1)
+                logger.report_scalar(title=title, series=series, value=value, iteration=epoch)
+            return
+        with open(os.path.join(self._stats_dir, "summary.jsonl"), "a") as f:
+            f.write(json.dumps({"epoch": epoch, "scalars": scalars}) + "\n")
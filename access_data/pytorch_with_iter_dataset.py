@@ -3,19 +3,98 @@ PyTorch-lightning training script with data from ClearML hyperdataset - iterator
 You can change the dataset MyDataModule._load_dataview and MyDataModule.setup for versions
 
 python pytorch_with_iter_dataset.py
+
+With --data.streaming true, the frames are read by AllegroIterableDataset, which splits the DataView stream between
+the DataLoader workers and the distributed ranks, so every frame is downloaded and decoded exactly once per epoch.
+The whole version is never prefetched in this mode: each worker only downloads its next frames ahead (64 if
+--data.prefetch_lookahead is not set).
+
+With --data.cache_dir /path/to/cache, the transformed samples are kept in a memory-mapped cache file (see
+tensor_cache.py), so from the second epoch onward no image is downloaded or decoded: the whole version prefetch is
+replaced with a look-ahead prefetch (64 frames if --data.prefetch_lookahead is not set) skipping the cached frames.
+
+With --data.fast_decode true, the JPEGs are decoded in grayscale at reduced resolution, and the resize is done per batch
+(see fast_decode.py).
+
+With --data.prefetch_lookahead N, only the next N frames of each worker are downloaded ahead (see frame_prefetcher.py),
+instead of prefetching the whole version with dataview.prefetch_files().
+
+With --data.stats_dir /path/to/stats, the time spent in every stage of the data pipeline is measured and reported as
+scalars of the Task at the end of every epoch, the validation stages apart from the training ones (see
+pipeline_stats.py).
+
+With --data.query_cache_dir /path/to/cache, the frames lists of snapshot versions are cached locally, so the next runs
+do not query the server again (see dataview_cache.py).
+
+With --data.fast_startup true, the train and val DataViews are built concurrently, the whole version prefetch is
+replaced with a look-ahead prefetch starting from the first batch, and with --data.streaming true the DataLoader
+workers are kept between epochs. The time from the process start to the first training batch is reported as a scalar
+of the Task in any case.
+
+With --data.shm_transport true, the workers keep the images as uint8 and write the batches directly into a shared
+memory ring, and the float conversion is done once per batch in the main process (see shm_transport.py). A new ring
+is created for every epoch, so the DataLoader workers are never persistent with the shared memory transport.
+
+With --data.random_seed N, the frames are iterated in a random order with a fixed seed. The number of frames consumed
+in the current epoch by every shard is saved in the checkpoints, so a preempted run resumed in the middle of an epoch
+(e.g. with ModelCheckpoint(every_n_train_steps=...) and --trainer.resume_from_checkpoint) skips the consumed frames
+instead of downloading and decoding them again (see resumable_iteration.py).
+
+With --data.shards_dir /path/to/shards, the training samples are read from shards exported with shard_export.py
+(sequential reads of large files instead of one small file per frame), through a shuffle buffer of
+--data.shuffle_buffer samples.
+
+With --data.source_cache_dir /path/to/scratch, the downloaded images are kept in a cache capped at
+--data.source_cache_mb MB, evicting the least recently (--data.source_cache_policy lru) or least frequently (lfu) used
+files, so a version larger than the local disk can be trained on. The whole version prefetch is replaced with a
+look-ahead prefetch (64 frames if --data.prefetch_lookahead is not set), the look-ahead frames are pinned until they
+are decoded, and the cache hits, misses and evictions are reported at the end of every epoch (see source_cache.py).
+
+With --data.label_index /path/to/train_labels.npz, the train DataView queries the whole version, and the frames are
+drawn by LabelBalancedSampler from a local label index (built on the first run and saved to that path, see
+label_index.py): class-balanced by default, or weighted with e.g. --data.class_weights '{"car": 2, "person": 1}'.
+Changing the class mix needs no new DataView or server query, --data.samples_per_epoch sets the epoch length.
+The frames list of a snapshot version is cached next to the index (or in --data.query_cache_dir, see
+dataview_cache.py), so the next runs reuse the index without querying the version again. The frames of every batch
+are downloaded together (a look-ahead of --data.prefetch_lookahead frames, 64 if not set) instead of prefetching the
+whole version.
 """
-from typing import Optional
+import io
+import math
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from time import time
+from typing import Dict, Optional, Tuple
 
 import numpy as np
+import psutil
 import pytorch_lightning as pl
 import torch
 from PIL import Image
 from pytorch_lightning.utilities.cli import LightningCLI
 from torch.nn import functional as F
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
 from torchvision.transforms import transforms
 
-from allegroai import DataView, FrameGroup, Task
+from allegroai import DataView, FrameGroup, IterationOrder, Task
+from dataview_cache import CachedDataView
+from fast_decode import ResizeCollate, draft_decode, pil_to_uint8_tensor
+from frame_prefetcher import FramePrefetcher, single_frames
+from label_index import LabelBalancedSampler, LabelIndex
+from pipeline_stats import NullStats, PipelineStats, PipelineStatsCallback, TimedCollate
+from resumable_iteration import IterationState, IterationTrackerCallback, shard_frames
+from shard_export import list_shards, read_shard
+from shm_transport import RINGS, SharedBatchRing, ShmBatch, ShmCollate, ShmDataLoader, to_float_batch
+from source_cache import SourceCache, SourceCacheStatsCallback
+from tensor_cache import TensorCache
+
+IMAGE_SIZE = (28, 28)
+# the same classification is returned for all the samples (not flagged read only, default_collate warns about
+# non-writable arrays on every batch), never modify it
+MOCK_CLASSIFICATION = np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 1], dtype=np.float32)
 
 
 class Backbone(torch.nn.Module):
@@ -51,6 +130,12 @@ class LitClassifier(pl.LightningModule):
         self.log("train_loss", loss, on_epoch=True)
         return None
 
+    def on_train_epoch_start(self):
+        # called before the train DataLoader workers are started, they get a copy of the dataset with the epoch
+        train_data = getattr(self.trainer.datamodule, "train_data", None)
+        if callable(getattr(train_data, "set_epoch", None)):
+            train_data.set_epoch(self.current_epoch)
+
     def validation_step(self, batch, batch_idx):
         x, y = batch
         y_hat = self(x)
@@ -72,38 +157,215 @@ class LitClassifier(pl.LightningModule):
         return torch.optim.Adam(self.parameters(), lr=self.hparams.learning_rate)
 
 
+def default_transform(convert_dtype: bool = True):
+    """
+    :param convert_dtype: If False, keep the image as uint8 (the float conversion is done later, per batch)
+    """
+    steps = [
+        transforms.PILToTensor(),
+        transforms.Resize(list(IMAGE_SIZE)),
+        transforms.Grayscale(),
+    ]
+    if convert_dtype:
+        steps.append(transforms.ConvertImageDtype(torch.float))
+    return transforms.Compose(steps)
+
+
+def read_rgb(img_path):
+    return Image.open(img_path).convert("RGB")
+
+
+class FrameLoader(object):
+    """
+    Download, decode and transform a frame into a training sample
+    """
+
+    def __init__(
+            self,
+            fast_decode: bool = False,
+            cache_dir: Optional[str] = None,
+            cache_size_mb: int = 1024,
+            stats: Optional[PipelineStats] = None,
+            uint8: bool = False,
+            source_cache: Optional[SourceCache] = None,
+    ):
+        """
+        :param fast_decode: If True, decode in grayscale at reduced resolution and leave the resize to the collate_fn
+            (the decoded samples are not fixed size, so they are not cached)
+        :param cache_dir: If given, cache the transformed samples in this folder (see TensorCache)
+        :param cache_size_mb: Maximum size of the samples cache in MB
+        :param stats: If given, measure the duration of each loading stage
+        :param uint8: If True, return fixed size uint8 images (for the shared memory transport), with fast_decode
+            the image is still decoded at reduced resolution, but resized per sample
+        :param source_cache: If given, download the frames through this size-capped cache (see SourceCache)
+        """
+        self.stats = stats or NullStats()
+        if uint8:
+            self.read_image = partial(draft_decode, size=IMAGE_SIZE) if fast_decode else read_rgb
+            self.transform = default_transform(convert_dtype=False)
+            self.collate_fn = None
+        elif fast_decode:
+            self.read_image = partial(draft_decode, size=IMAGE_SIZE)
+            self.transform = pil_to_uint8_tensor
+            self.collate_fn = ResizeCollate(IMAGE_SIZE)
+            cache_dir = None
+        else:
+            self.read_image = read_rgb
+            self.transform = default_transform()
+            self.collate_fn = None
+        self.cache = TensorCache(
+            cache_dir, self.transform, cache_size_mb, decode="draft" if fast_decode else "full") if cache_dir else None
+        self.source_cache = source_cache
+        if stats:
+            self.collate_fn = TimedCollate(self.collate_fn, stats)
+
+    def __call__(self, frame, local_source=None):
+        """
+        :param frame: SingleFrame or FrameGroup returned by the DataView iterator
+        :param local_source: The frame local source, if already downloaded (see FramePrefetcher), with a source
+            cache the prefetched files are pinned, and released here
+        :return: tuple of (image tensor, classification)
+        """
+        mock_classification = MOCK_CLASSIFICATION
+        frame_id = frame.id
+        # the source cache files pinned until the image is decoded
+        pinned = single_frames(frame) if self.source_cache is not None and local_source else []
+        start = self.stats.clock()
+        if self.cache is not None:
+            sample = self.cache.get(frame_id)
+            if sample is not None:
+                self._release(pinned)
+                self.stats.lap("cache_hit", start)
+                return sample, mock_classification
+        if isinstance(frame, FrameGroup):
+            # if this is a FrameGroup, use the first SingleFrame
+            frame = list(frame.values())[0]
+            if local_source:
+                local_source = list(local_source.values())[0]
+        # Download the data locally (cached)
+        if local_source:
+            img_path = local_source
+        elif self.source_cache is not None:
+            img_path = self.source_cache.get(frame, pin=True)
+            pinned = [frame]
+        else:
+            img_path = frame.get_local_source()
+        start = self.stats.lap("download", start)
+        img = self.read_image(img_path)
+        self._release(pinned)
+        start = self.stats.lap("decode", start)
+        sample = self.transform(img)
+        self.stats.lap("transform", start)
+        if self.cache is not None:
+            self.cache.put(frame_id, sample)
+        return sample, mock_classification
+
+    def is_cached(self, frame):
+        """
+        :return: True if the frame sample is in the samples cache (no need to download the frame)
+        """
+        return self.cache is not None and frame.id in self.cache
+
+    def _release(self, frames):
+        for frame in frames:
+            self.source_cache.release(frame)
+
+    def load_bytes(self, data):
+        """
+        :param data: The encoded image bytes (e.g. read from a shard, see shard_export.py)
+        :return: tuple of (image tensor, classification)
+        """
+        start = self.stats.clock()
+        img = self.read_image(io.BytesIO(data))
+        start = self.stats.lap("decode", start)
+        sample = self.transform(img)
+        self.stats.lap("transform", start)
+        return sample, MOCK_CLASSIFICATION
+
+
+def get_shard_info() -> Tuple[int, int]:
+    """
+    Get the shard of the frames stream the current process should read.
+    Every DataLoader worker of every distributed rank is a shard of its own.
+    :return: tuple of (shard index, number of shards)
+    """
+    rank, world_size = get_rank_info()
+    worker_info = get_worker_info()
+    worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+    # interleave the ranks, so each rank reads every world_size-th frame and its workers split those
+    return worker_id * world_size + rank, world_size * num_workers
+
+
+def get_rank_info() -> Tuple[int, int]:
+    """
+    :return: tuple of (rank, world size), (0, 1) when not running distributed
+    """
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
 class AllegroDatasetIter(Dataset):
 
     def __init__(
             self,
             dataview: DataView,
+            loader: Optional[FrameLoader] = None,
+            prefetch_lookahead: int = 0,
+            prefetch_max_bytes: Optional[int] = None,
+            state: Optional[IterationState] = None,
     ):
         """
         :param dataview: The Allegro DataView
+        :param loader: FrameLoader turning frames into samples (default: reference transform, no cache)
+        :param prefetch_lookahead: If > 0, download this number of frames ahead on background threads
+        :param prefetch_max_bytes: Maximum size of downloaded frames waiting to be used
+        :param state: If given, the iteration state to resume from (see resumable_iteration.py)
         """
         self._dataview = dataview
         self._count = None
-        self._transform = transforms.Compose(
-            [
-                transforms.PILToTensor(),
-                transforms.Resize([28, 28]),
-                transforms.Grayscale(),
-                transforms.ConvertImageDtype(torch.float)
-            ]
-        )
+        self._loader = loader or FrameLoader()
+        self._prefetch_lookahead = prefetch_lookahead
+        self._prefetch_max_bytes = prefetch_max_bytes
+        self._prefetched = None
+        self._state = state or IterationState()
+        self._resumed = False
         self.frames = self._dataview.get_iterator()
 
+    def state_dict(self) -> dict:
+        return self._state.state_dict()
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        seed = self._state.seed
+        self._state.load_state_dict(state_dict)
+        if self._state.seed is not None and self._state.seed != seed:
+            # continue the same random order as the checkpointed run
+            self._dataview.set_iteration_parameters(random_seed=self._state.seed)
+            self.frames = self._dataview.get_iterator()
+
     def __next__(self):
+        if not self._resumed:
+            # every DataLoader worker iterates its own copy of the frames iterator
+            self._resumed = True
+            worker_info = get_worker_info()
+            skip = self._state.take_resume(worker_info.id if worker_info else 0)
+            if skip:
+                self.frames = islice(self.frames, skip, None)
+        if self._prefetch_lookahead:
+            # created on first use, so the download threads are started inside the DataLoader worker
+            if self._prefetched is None:
+                self._prefetched = iter(FramePrefetcher(
+                    self.frames, self._prefetch_lookahead, self._prefetch_max_bytes,
+                    source_cache=self._loader.source_cache, is_cached=self._loader.is_cached))
+            start = self._loader.stats.clock()
+            frame, local_source = next(self._prefetched)
+            self._loader.stats.lap("fetch", start)
+            return self._loader(frame, local_source)
         # We will call the iterator next() for getting the next frame
+        start = self._loader.stats.clock()
         frame = next(self.frames)
-        if isinstance(frame, FrameGroup):
-            # if this is a FrameGroup, use the first SingleFrame
-            frame = list(frame.values())[0]
-        # Download the data locally (cached)
-        img_path = frame.get_local_source()
-        img = Image.open(img_path).convert("RGB")
-        mock_classification = np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 1], dtype=np.float32)
-        return self._transform(img), mock_classification
+        self._loader.stats.lap("fetch", start)
+        return self._loader(frame)
 
     def __getitem__(self, item):
         return self.__next__()
@@ -115,34 +377,472 @@ class AllegroDatasetIter(Dataset):
         return self._count
 
 
+class AllegroIterableDataset(IterableDataset):
+    """
+    Streaming version of AllegroDatasetIter.
+    Every DataLoader worker (on every distributed rank) creates its own DataView iterator and only downloads and
+    decodes the frames of its shard (frame index modulo number of shards), so the shards never overlap and together
+    cover the whole DataView.
+    Notice: all the shards must see the same frames order, use sequential iteration or random iteration with a fixed
+    random_seed (see DataView.set_iteration_parameters).
+    """
+
+    def __init__(
+            self,
+            dataview: DataView,
+            loader: Optional[FrameLoader] = None,
+            prefetch_lookahead: int = 0,
+            prefetch_max_bytes: Optional[int] = None,
+            state: Optional[IterationState] = None,
+    ):
+        """
+        :param dataview: The Allegro DataView
+        :param loader: FrameLoader turning frames into samples (default: reference transform, no cache)
+        :param prefetch_lookahead: If > 0, download this number of frames of the shard ahead on background threads
+        :param prefetch_max_bytes: Maximum size of downloaded frames waiting to be used
+        :param state: If given, the iteration state to resume from (see resumable_iteration.py)
+        """
+        self._dataview = dataview
+        self._count = None
+        self._loader = loader or FrameLoader()
+        self._prefetch_lookahead = prefetch_lookahead
+        self._prefetch_max_bytes = prefetch_max_bytes
+        self._state = state or IterationState()
+
+    def state_dict(self) -> dict:
+        return self._state.state_dict()
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        seed = self._state.seed
+        self._state.load_state_dict(state_dict)
+        if self._state.seed is not None and self._state.seed != seed:
+            # continue the same random order as the checkpointed run
+            self._dataview.set_iteration_parameters(random_seed=self._state.seed)
+
+    def _shard_frames(self):
+        shard, num_shards = get_shard_info()
+        # skip the frames consumed before the checkpoint (only once, persistent workers start the next epochs anew)
+        return shard_frames(self._dataview.get_iterator(), shard, num_shards, skip=self._state.take_resume(shard))
+
+    def _fetch(self, frames):
+        stats = self._loader.stats
+        start = stats.clock()
+        for item in frames:
+            stats.lap("fetch", start)
+            yield item
+            start = stats.clock()
+        stats.flush()
+
+    def __iter__(self):
+        if self._prefetch_lookahead:
+            prefetcher = FramePrefetcher(
+                self._shard_frames(), self._prefetch_lookahead, self._prefetch_max_bytes,
+                source_cache=self._loader.source_cache, is_cached=self._loader.is_cached)
+            for frame, local_source in self._fetch(prefetcher):
+                yield self._loader(frame, local_source)
+        else:
+            for frame in self._fetch(self._shard_frames()):
+                yield self._loader(frame)
+
+    def frames_count(self) -> int:
+        if self._count is None:
+            # will return the total number of frames in this version
+            self._count = self._dataview.get_count()[0]
+        return self._count
+
+    def __len__(self) -> int:
+        # number of frames this rank will see (all its workers together)
+        rank, world_size = get_rank_info()
+        return int(math.ceil((self.frames_count() - rank) / float(world_size)))
+
+
+class FrameListDataset(Dataset):
+    """
+    Random access to a list of frames (e.g. dataview.to_list()), for samplers choosing the frames
+    """
+
+    def __init__(
+            self,
+            frames: list,
+            loader: Optional[FrameLoader] = None,
+            prefetch_lookahead: int = 0,
+            prefetch_max_bytes: Optional[int] = None,
+    ):
+        """
+        :param frames: list of SingleFrame or FrameGroup
+        :param loader: FrameLoader turning frames into samples (default: reference transform, no cache)
+        :param prefetch_lookahead: If > 0, the frames of a batch are downloaded together on background threads, up to
+            this number of frames ahead of the decoding
+        :param prefetch_max_bytes: Maximum size of downloaded frames waiting to be decoded (see FramePrefetcher)
+        """
+        self.frames = frames
+        self._loader = loader or FrameLoader()
+        self._prefetch_lookahead = prefetch_lookahead
+        self._prefetch_max_bytes = prefetch_max_bytes
+
+    def __getitem__(self, item):
+        return self._loader(self.frames[item])
+
+    def __getitems__(self, items):
+        # the DataLoader asks for the whole batch, the sampler order is only known here
+        if not self._prefetch_lookahead:
+            return [self[item] for item in items]
+        prefetcher = FramePrefetcher(
+            [self.frames[item] for item in items], self._prefetch_lookahead, self._prefetch_max_bytes,
+            source_cache=self._loader.source_cache, is_cached=self._loader.is_cached)
+        return [self._loader(frame, local_source) for frame, local_source in prefetcher]
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+
+class ShardDataset(IterableDataset):
+    """
+    Read the samples from the shards exported with shard_export.py.
+    The shards are split between the DataLoader workers and the distributed ranks, every worker reads its shards
+    sequentially, and the samples go through a shuffle buffer.
+    """
+
+    def __init__(
+            self,
+            shards_dir: str,
+            loader: Optional[FrameLoader] = None,
+            shuffle_buffer: int = 1000,
+            seed: Optional[int] = None,
+    ):
+        """
+        :param shards_dir: Folder with the exported shards
+        :param loader: FrameLoader turning the image bytes into samples (default: reference transform)
+        :param shuffle_buffer: Number of samples in the shuffle buffer (0 to keep the shards order)
+        :param seed: Random seed of the shards order and the shuffle buffer
+        """
+        self._shards = list_shards(shards_dir)
+        if not self._shards:
+            raise ValueError("No shards found in {}".format(shards_dir))
+        self._loader = loader or FrameLoader()
+        self._shuffle_buffer = shuffle_buffer
+        self._seed = seed
+        self._epoch = 0
+        self._shard_counts = None
+
+    def set_epoch(self, epoch):
+        """
+        Set the epoch of the shards order and shuffle buffer, before the DataLoader workers get their copy of the
+        dataset (see LitClassifier.on_train_epoch_start)
+        """
+        self._epoch = epoch
+
+    def _samples(self, rnd):
+        shard, num_shards = get_shard_info()
+        shards = self._shards[shard::num_shards]
+        if self._shuffle_buffer:
+            rnd.shuffle(shards)
+        stats = self._loader.stats
+        for path in shards:
+            start = stats.clock()
+            for _, images, _ in read_shard(path):
+                stats.lap("fetch", start)
+                # use the first source of the frame, as with the DataView frames
+                yield self._loader.load_bytes(next(iter(images.values())))
+                start = stats.clock()
+        stats.flush()
+
+    def __iter__(self):
+        rnd = random.Random(None if self._seed is None else self._seed + self._epoch)
+        if not self._shuffle_buffer:
+            yield from self._samples(rnd)
+            return
+        buffer = []
+        for sample in self._samples(rnd):
+            if len(buffer) < self._shuffle_buffer:
+                buffer.append(sample)
+                continue
+            idx = rnd.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = sample
+        rnd.shuffle(buffer)
+        yield from buffer
+
+    def __len__(self) -> int:
+        if self._shard_counts is None:
+            self._shard_counts = []
+            for path in self._shards:
+                with open(path[:-len(".tar")] + ".idx", "r") as f:
+                    self._shard_counts.append(sum(1 for _ in f))
+        # the samples of this rank, its workers split the same shards (see _samples)
+        rank, world_size = get_rank_info()
+        return sum(self._shard_counts[rank::world_size])
+
+
 class MyDataModule(pl.LightningDataModule):
-    def __init__(self, batch_size: int = 32):
+    def __init__(
+            self,
+            batch_size: int = 32,
+            num_workers: int = 6,
+            streaming: bool = False,
+            cache_dir: Optional[str] = None,
+            cache_size_mb: int = 1024,
+            fast_decode: bool = False,
+            prefetch_lookahead: int = 0,
+            prefetch_max_mb: Optional[int] = None,
+            stats_dir: Optional[str] = None,
+            query_cache_dir: Optional[str] = None,
+            fast_startup: bool = False,
+            shm_transport: bool = False,
+            pin_memory: bool = False,
+            random_seed: Optional[int] = None,
+            shards_dir: Optional[str] = None,
+            shuffle_buffer: int = 1000,
+            source_cache_dir: Optional[str] = None,
+            source_cache_mb: int = 10 * 1024,
+            source_cache_policy: str = "lru",
+            label_index: Optional[str] = None,
+            class_weights: Optional[Dict[str, float]] = None,
+            samples_per_epoch: Optional[int] = None,
+    ):
+        """
+        :param batch_size: Batch size for the train and val DataLoaders
+        :param num_workers: Number of DataLoader workers
+        :param streaming: If True, use AllegroIterableDataset and split the frames between the workers and ranks,
+            with a look-ahead prefetch (prefetch_lookahead frames, 64 if not set)
+        :param cache_dir: If given, keep the transformed samples in a memory-mapped cache in this folder
+        :param cache_size_mb: Maximum size of the samples cache in MB
+        :param fast_decode: If True, decode JPEGs in grayscale at reduced resolution and resize per batch
+        :param prefetch_lookahead: If > 0, each worker downloads this number of frames ahead, instead of
+            prefetching the whole version
+        :param prefetch_max_mb: Maximum size in MB of downloaded frames waiting to be used, per worker
+        :param stats_dir: If given, measure the data pipeline stages and report them (see PipelineStatsCallback)
+        :param query_cache_dir: If given, cache the frames lists of snapshot versions in this folder
+        :param fast_startup: If True, build the train and val DataViews concurrently, prefetch lazily (look-ahead of
+            prefetch_lookahead frames, 64 if not set) and, when streaming, keep the DataLoader workers between epochs
+        :param shm_transport: If True, the workers send uint8 batches through a shared memory ring
+        :param pin_memory: With shm_transport, pin the ring memory for faster copies to the GPU
+        :param random_seed: If given, iterate the frames in a random order with this seed
+        :param shards_dir: If given, read the training samples from the shards in this folder (see shard_export.py)
+        :param shuffle_buffer: With shards_dir, number of samples in the shuffle buffer
+        :param source_cache_dir: If given, keep the downloaded images in this folder, up to source_cache_mb
+        :param source_cache_mb: Maximum size of the downloaded images in MB
+        :param source_cache_policy: Eviction order of the downloaded images, "lru" or "lfu"
+        :param label_index: If given, sample the training frames from the label index in this file (built if missing)
+        :param class_weights: With label_index, weight of every label (default: class-balanced)
+        :param samples_per_epoch: With label_index, number of samples per epoch (default: the number of frames)
+        """
         super().__init__()
         self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.streaming = streaming
+        self.stats_dir = stats_dir
+        self.query_cache_dir = query_cache_dir
+        self.source_cache = SourceCache(
+            source_cache_dir, source_cache_mb, source_cache_policy) if source_cache_dir else None
+        loader_kwargs = dict(
+            fast_decode=fast_decode,
+            cache_dir=cache_dir,
+            cache_size_mb=cache_size_mb,
+            uint8=shm_transport,
+            source_cache=self.source_cache,
+        )
+        self.loader = FrameLoader(
+            stats=PipelineStats(stats_dir, loader="train") if stats_dir else None, **loader_kwargs)
+        # the validation timings are recorded apart from the training ones
+        self.val_loader = FrameLoader(
+            stats=PipelineStats(stats_dir, loader="val"), **loader_kwargs) if stats_dir else self.loader
+        self.shm_transport = shm_transport
+        self.pin_memory = pin_memory
+        self.fast_startup = fast_startup
+        if (streaming or fast_startup or source_cache_dir or cache_dir or label_index) and not prefetch_lookahead:
+            # never prefetch the whole version
+            prefetch_lookahead = 64
+        self.prefetch_lookahead = prefetch_lookahead
+        self.prefetch_max_bytes = prefetch_max_mb * 1024 * 1024 if prefetch_max_mb else None
+        self.random_seed = random_seed
+        # the train iteration position, saved in the checkpoints (see IterationTrackerCallback)
+        self.train_state = IterationState(seed=random_seed)
+        self.shards_dir = shards_dir
+        self.shuffle_buffer = shuffle_buffer
+        self.label_index = label_index
+        self.class_weights = class_weights
+        self.samples_per_epoch = samples_per_epoch
+        self.train_sampler = None
+        self._train_sampler_state = None
         self.train_data = self.val_data = None
 
-    @staticmethod
-    def _load_dataview(version, dv_name):
-        dataview = DataView(dv_name)
+    def _create_dataview(self, version, dv_name, roi_query="car", query_cache_dir=None):
+        kwargs = dict(iteration_order=IterationOrder.random) if self.random_seed is not None else {}
+        query_cache_dir = query_cache_dir or self.query_cache_dir
+        if query_cache_dir:
+            dataview = CachedDataView(query_cache_dir, dv_name, **kwargs)
+        else:
+            dataview = DataView(dv_name, **kwargs)
+        if self.random_seed is not None:
+            dataview.set_iteration_parameters(random_seed=self.random_seed)
         # Can be changed with other datasets and queries
-        dataview.add_query(
-            dataset_name="COCO - Common Objects in Context",
-            version_name=version,
-            roi_query="car"
+        query = dict(dataset_name="COCO - Common Objects in Context", version_name=version)
+        if roi_query:
+            query["roi_query"] = roi_query
+        dataview.add_query(**query)
+        return dataview
+
+    def _load_dataview(self, version, dv_name, state=None, loader=None):
+        dataview = self._create_dataview(version, dv_name)
+        if not self.prefetch_lookahead:
+            # prefetch_files will start downloading all the files in background threads
+            dataview.prefetch_files()
+        dataset_class = AllegroIterableDataset if self.streaming else AllegroDatasetIter
+        return dataset_class(
+            dataview=dataview,
+            loader=loader or self.loader,
+            prefetch_lookahead=self.prefetch_lookahead,
+            prefetch_max_bytes=self.prefetch_max_bytes,
+            state=state,
         )
-        # prefetch_files will start downloading all the files in background threads
-        dataview.prefetch_files()
-        return AllegroDatasetIter(dataview=dataview)
+
+    def _load_dataview_with_count(self, version, dv_name, state=None, loader=None):
+        dataset = self._load_dataview(version, dv_name, state, loader)
+        # the DataLoader will ask for the length, resolve it here while the other view is being built
+        len(dataset)
+        return dataset
 
     def setup(self, stage: Optional[str] = None) -> None:
-        self.train_data = self._load_dataview("Train2017 version", "train")
-        self.val_data = self._load_dataview("Val2014 version", "val")
+        if self.source_cache is not None:
+            # pins left by the workers of a previous (killed) run
+            self.source_cache.clear_pins()
+        if self.fast_startup:
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                train_data = pool.submit(self._load_train_data, True)
+                val_data = pool.submit(
+                    self._load_dataview_with_count, "Val2014 version", "val", loader=self.val_loader)
+                self.train_data, self.val_data = train_data.result(), val_data.result()
+            return
+        self.train_data = self._load_train_data()
+        self.val_data = self._load_dataview("Val2014 version", "val", loader=self.val_loader)
+
+    def _load_train_data(self, with_count=False):
+        if self.shards_dir:
+            return ShardDataset(self.shards_dir, self.loader, self.shuffle_buffer, self.random_seed)
+        if self.label_index:
+            return self._load_label_sampled_data()
+        if with_count:
+            return self._load_dataview_with_count("Train2017 version", "train", self.train_state)
+        return self._load_dataview("Train2017 version", "train", self.train_state)
+
+    def _load_label_sampled_data(self):
+        # the whole version, the class mix is set by the sampler weights. The frames list of a snapshot version is
+        # kept next to the label index, so the next runs load it (and reuse the index) without querying the server
+        dataview = self._create_dataview(
+            "Train2017 version", "train", roi_query=None,
+            query_cache_dir=self.query_cache_dir or os.path.splitext(self.label_index)[0] + "_frames")
+        frames = dataview.to_list()
+        index = LabelIndex.load(self.label_index) if os.path.exists(self.label_index) else None
+        if index is None or not index.matches(frames):
+            # first run, or the version changed since the index was built
+            index = LabelIndex.build(frames)
+            index.save(self.label_index)
+        print("Label counts: {}".format(index.counts()))
+        self.train_sampler = LabelBalancedSampler(
+            index, self.class_weights, self.samples_per_epoch, seed=self.random_seed or 0)
+        if self._train_sampler_state is not None:
+            self.train_sampler.load_state_dict(self._train_sampler_state)
+        return FrameListDataset(frames, self.loader, self.prefetch_lookahead, self.prefetch_max_bytes)
+
+    def _dataloader(self, dataset, loader, prefetch_factor=2, sampler=None):
+        kwargs = dict(num_workers=self.num_workers, batch_size=self.batch_size, sampler=sampler)
+        if self.num_workers:
+            # torch < 2.0 rejects any prefetch_factor (even None) without workers
+            kwargs["prefetch_factor"] = prefetch_factor
+        if self.shm_transport:
+            # enough slots for the batches in flight, the batch used by the model and a pending GPU copy
+            ring_factory = partial(
+                SharedBatchRing,
+                num_slots=max(1, self.num_workers) * prefetch_factor + 2,
+                batch_size=self.batch_size,
+                image_shape=(1,) + IMAGE_SIZE,
+                label_size=len(MOCK_CLASSIFICATION),
+                pin_memory=self.pin_memory,
+            )
+            shm_collate = ShmCollate()
+            collate_fn = TimedCollate(shm_collate, loader.stats) if self.stats_dir else shm_collate
+            # a new ring for every epoch, the workers cannot be persistent
+            return ShmDataLoader(dataset, ring_factory, shm_collate, collate_fn=collate_fn, **kwargs)
+        # AllegroDatasetIter workers iterate a copy of the DataView iterator, and ShardDataset workers get the epoch
+        # with their copy of the dataset, they must be forked again every epoch
+        persistent_workers = self.fast_startup and self.streaming and self.num_workers > 0 and \
+            not isinstance(dataset, ShardDataset)
+        return DataLoader(
+            dataset, collate_fn=loader.collate_fn, persistent_workers=persistent_workers, **kwargs)
+
+    def state_dict(self):
+        state = {}
+        if self.train_data is None or hasattr(self.train_data, "state_dict"):
+            # e.g. not when training from exported shards, there is no iteration position to resume from
+            state["train"] = self.train_state.state_dict()
+        if self.train_sampler is not None:
+            state["train_sampler"] = self.train_sampler.state_dict()
+        return state
+
+    def load_state_dict(self, state_dict):
+        if "train_sampler" in state_dict:
+            if self.train_sampler is not None:
+                self.train_sampler.load_state_dict(state_dict["train_sampler"])
+            else:
+                # restored before setup(), applied when the sampler is created
+                self._train_sampler_state = state_dict["train_sampler"]
+        if "train" not in state_dict:
+            return
+        if self.train_data is None:
+            self.train_state.load_state_dict(state_dict["train"])
+            self.random_seed = self.train_state.seed
+        elif hasattr(self.train_data, "load_state_dict"):
+            self.train_data.load_state_dict(state_dict["train"])
 
     def train_dataloader(self):
-        return DataLoader(self.train_data, num_workers=6, batch_size=self.batch_size)
+        return self._dataloader(self.train_data, self.loader, sampler=self.train_sampler)
 
     def val_dataloader(self):
-        return DataLoader(self.val_data, num_workers=6, batch_size=self.batch_size)
+        return self._dataloader(self.val_data, self.val_loader)
+
+    def on_before_batch_transfer(self, batch, dataloader_idx):
+        if isinstance(batch, ShmBatch):
+            # zero-copy views of the shared memory slot, the slot is released after the float conversion
+            images, labels = RINGS[batch.ring_id].views(batch)
+            return batch, images, labels
+        return batch
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if isinstance(batch, tuple) and len(batch) == 3 and isinstance(batch[0], ShmBatch):
+            shm_batch, images, labels = batch
+            images, labels = to_float_batch(images, labels)
+            event = None
+            if images.is_cuda:
+                event = torch.cuda.Event()
+                event.record()
+            RINGS[shm_batch.ring_id].release(shm_batch.slot, event)
+            return images, labels
+        return batch
+
+
+class TimeToFirstBatchCallback(pl.Callback):
+    """
+    Report the time from the process start to the first training batch
+    """
+
+    def __init__(self, start_time: Optional[float] = None):
+        """
+        :param start_time: Start time (default: the process creation time)
+        """
+        self._start_time = start_time or psutil.Process().create_time()
+        self._reported = False
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, *args):
+        if self._reported:
+            return
+        self._reported = True
+        seconds = time() - self._start_time
+        print("Time to first batch: {:.2f} seconds".format(seconds))
+        task = Task.current_task()
+        if task:
+            task.get_logger().report_scalar(
+                title="startup", series="time_to_first_batch_sec", value=seconds, iteration=0)
 
 
 def cli_main():
@@ -154,6 +854,16 @@ def cli_main():
         save_config_overwrite=True,
         run=False,
     )
+    if cli.datamodule.stats_dir:
+        # reports the pipeline stats as scalars of the task
+        cli.trainer.callbacks.append(PipelineStatsCallback(
+            cli.datamodule.stats_dir, [cli.datamodule.loader.stats, cli.datamodule.val_loader.stats]))
+    if cli.datamodule.source_cache is not None:
+        # reports the downloaded images cache hits, misses and evictions
+        cli.trainer.callbacks.append(SourceCacheStatsCallback(cli.datamodule.source_cache))
+    cli.trainer.callbacks.append(TimeToFirstBatchCallback())
+    # tracks the consumed frames, so a run resumed from a mid-epoch checkpoint skips them
+    cli.trainer.callbacks.append(IterationTrackerCallback(cli.datamodule))
     cli.trainer.fit(cli.model, datamodule=cli.datamodule)
 
 
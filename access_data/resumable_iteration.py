@@ -0,0 +1,158 @@
+"""
+Resumable mid-epoch iteration of a DataView.
+
+When a training job is preempted in the middle of an epoch, the DataView iterator starts again from the first frame,
+and all the frames already consumed in that epoch are downloaded and decoded again. IterationState keeps the DataView
+random seed, the epoch and the number of frames consumed (by the model, not just read by the DataLoader workers) from
+every shard of the frames stream. It is saved in the Lightning checkpoints through the DataModule state_dict(), and
+when the run is resumed, every shard skips its consumed frames before anything is downloaded or decoded.
+
+The DataLoader workers cannot report which samples reached the model, so IterationTrackerCallback follows the
+DataLoader order in the main process: the batches of an IterableDataset are returned from the workers in round-robin
+order (skipping the exhausted workers), and the batches of a map-style dataset go to worker `batch_idx % num_workers`.
+A sampler with a record_batch() method (e.g. LabelBalancedSampler) is told about every consumed batch instead.
+
+Usage:
+    datamodule = MyDataModule(streaming=True, random_seed=1337)
+    trainer = pl.Trainer(callbacks=[IterationTrackerCallback(datamodule), ModelCheckpoint(every_n_train_steps=100)])
+    trainer.fit(model, datamodule=datamodule, ckpt_path=last_checkpoint)
+"""
+import math
+from itertools import islice
+
+import pytorch_lightning as pl
+import torch
+
+
+class IterationState(object):
+    def __init__(self, seed=None):
+        """
+        :param seed: The DataView random seed (None for the DataView default iteration order)
+        :type seed: int
+        """
+        self.seed = seed
+        self.epoch = 0
+        # shard -> frames consumed by the model in the current epoch
+        self.offsets = {}
+        # shard -> frames to skip when the shard iteration starts (restored from a checkpoint)
+        self.resume = {}
+        self._active = []
+        self._next_worker = 0
+
+    def state_dict(self):
+        offsets = dict(self.offsets)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            # every rank tracks its own shards
+            gathered = [None] * torch.distributed.get_world_size()
+            torch.distributed.all_gather_object(gathered, offsets)
+            offsets = {shard: offset for rank_offsets in gathered for shard, offset in rank_offsets.items()}
+        return {"seed": self.seed, "epoch": self.epoch, "offsets": offsets}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict.get("seed")
+        self.epoch = state_dict.get("epoch", 0)
+        self.offsets = {int(shard): offset for shard, offset in state_dict.get("offsets", {}).items()}
+        self.resume = dict(self.offsets)
+
+    def take_resume(self, shard):
+        """
+        Called when a shard iteration starts, the resume offset is only used once
+        :return: number of frames of the shard to skip
+        """
+        return self.resume.pop(shard, 0)
+
+    def start_epoch(self, epoch, shards, frames_count=None, batch_size=1):
+        """
+        Start tracking an epoch, resuming from the restored offsets if they belong to this epoch
+        :param epoch: The epoch number
+        :param shards: The shards read by the DataLoader workers of this process, in worker order
+        :param frames_count: Number of frames of every shard (None for map-style datasets, never exhausted)
+        :param batch_size: The DataLoader batch size
+        """
+        if epoch != self.epoch:
+            self.epoch, self.offsets, self.resume = epoch, {}, {}
+        self.offsets = {shard: self.offsets.get(shard, 0) for shard in shards}
+        # list of [shard, remaining batches], in the DataLoader round-robin order
+        self._active = []
+        for shard in shards:
+            remaining = None
+            if frames_count is not None:
+                remaining = int(math.ceil(max(0, frames_count[shard] - self.offsets[shard]) / float(batch_size)))
+                if not remaining:
+                    continue
+            self._active.append([shard, remaining])
+        self._next_worker = 0
+
+    def record_batch(self, size):
+        """
+        Record a batch consumed by the model
+        :param size: Number of samples in the batch
+        """
+        if not self._active:
+            return
+        worker = self._active[self._next_worker]
+        self.offsets[worker[0]] += size
+        if worker[1] is not None:
+            worker[1] -= 1
+            if not worker[1]:
+                self._active.pop(self._next_worker)
+                self._next_worker = self._next_worker % len(self._active) if self._active else 0
+                return
+        self._next_worker = (self._next_worker + 1) % len(self._active)
+
+
+def shard_frames(frames, shard, num_shards, skip=0):
+    """
+    :param frames: Frames iterator (e.g. dataview.get_iterator())
+    :param shard: Shard index
+    :param num_shards: Number of shards
+    :param skip: Number of frames of the shard to skip
+    :return: iterator over the frames of the shard, every num_shards-th frame starting from the shard index
+    """
+    # the skipped frames are only read from the iterator, never downloaded or decoded
+    return islice(frames, shard + skip * num_shards, None, num_shards)
+
+
+def shard_sizes(frames_count, num_shards):
+    """
+    :return: list of the number of frames in every shard
+    """
+    return [len(range(shard, frames_count, num_shards)) for shard in range(num_shards)]
+
+
+class IterationTrackerCallback(pl.Callback):
+    """
+    Track the frames consumed by the model in the IterationState of the train dataset
+    """
+
+    def __init__(self, datamodule):
+        """
+        :param datamodule: DataModule with `train_state`, `num_workers`, `batch_size` and `streaming` attributes
+        """
+        self._datamodule = datamodule
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        # called before the DataLoader workers are started, so they get the resume offsets of this epoch only
+        dm = self._datamodule
+        if not hasattr(dm.train_data, "state_dict"):
+            # e.g. training from exported shards
+            return
+        num_workers = max(1, dm.num_workers)
+        if not dm.streaming:
+            dm.train_state.start_epoch(trainer.current_epoch, list(range(num_workers)))
+            return
+        rank, world_size = trainer.global_rank, trainer.world_size
+        num_shards = world_size * num_workers
+        dm.train_state.start_epoch(
+            trainer.current_epoch,
+            [worker_id * world_size + rank for worker_id in range(num_workers)],
+            frames_count=shard_sizes(dm.train_data.frames_count(), num_shards),
+            batch_size=dm.batch_size,
+        )
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, *args):
+        self._datamodule.train_state.record_batch(len(batch[0]))
+        # samplers drawing the frames in the main process (e.g. LabelBalancedSampler) know the order themselves
+        sampler = getattr(self._datamodule, "train_sampler", None)
+        if callable(getattr(sampler, "record_batch", None)):
+            sampler.record_batch(len(batch[0]))
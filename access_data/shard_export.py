@@ -0,0 +1,192 @@
+"""
+Export a DataView to packed sequential shards.
+
+Reading the frames one small file at a time with frame.get_local_source() gives a poor disk (and network mounted
+cache) throughput. export_dataview() downloads the frames of any DataView (with a bounded look-ahead, see
+frame_prefetcher.py) and packs them, in the DataView order, into tar shards of about `shard_size_mb` each, in the
+WebDataset layout: for every frame `<key>.<source name><ext>` members with the image bytes and a `<key>.json` member
+with the frame id, metadata and annotations. Next to every shard, a small `<shard>.idx` file (one json line per frame)
+keeps the offset and size of every member, so a shard is read front to back with large sequential reads and without
+parsing the tar headers (see read_shard).
+
+The shards are read for training by ShardDataset in pytorch_with_iter_dataset.py (--data.shards_dir).
+
+You can run this example from this dir with:
+
+python shard_export.py --dataset "COCO - Common Objects in Context" --version "Train2017 version" --out ./shards
+"""
+import io
+import json
+import os
+import tarfile
+from argparse import ArgumentParser
+from glob import glob
+
+from allegroai import DataView, FrameGroup, Task
+
+from frame_prefetcher import FramePrefetcher
+
+# annotation attributes kept in the shards (when the annotation has them)
+ANNOTATION_FIELDS = ("id", "labels", "confidence", "bounding_box_xywh", "polygon_xy", "points", "mask_rgb")
+
+
+def annotation_to_dict(annotation):
+    """
+    :param annotation: Frame annotation
+    :return: json serializable dictionary
+    """
+    ret = {}
+    for field in ANNOTATION_FIELDS:
+        value = getattr(annotation, field, None)
+        if value is not None and not callable(value):
+            ret[field] = list(value) if isinstance(value, tuple) else value
+    return ret
+
+
+def frame_record(frame):
+    """
+    :param frame: SingleFrame or FrameGroup
+    :return: json serializable dictionary with the frame id, metadata and annotations
+    """
+    record = {"id": frame.id, "metadata": dict(frame.metadata or {})}
+    if isinstance(frame, FrameGroup):
+        record["frames"] = {
+            name: {"metadata": dict(single_frame.metadata or {}),
+                   "annotations": [annotation_to_dict(a) for a in single_frame.annotations or []]}
+            for name, single_frame in frame.items()}
+        record["annotations"] = [annotation_to_dict(a) for a in getattr(frame, "global_annotations", None) or []]
+    else:
+        record["annotations"] = [annotation_to_dict(a) for a in frame.annotations or []]
+    return record
+
+
+class ShardWriter(object):
+    def __init__(self, out_dir, shard_size_mb=256, prefix="shard"):
+        """
+        :param out_dir: Output folder for the shards
+        :type out_dir: str
+        :param shard_size_mb: Start a new shard once the current one reaches this size
+        :type shard_size_mb: int
+        :param prefix: Shard files name prefix
+        :type prefix: str
+        """
+        self._out_dir = out_dir
+        self._shard_size = shard_size_mb * 1024 * 1024
+        self._prefix = prefix
+        self._tar = self._index = None
+        self.shards = []
+        self.count = 0
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _open_shard(self):
+        self.close()
+        path = os.path.join(self._out_dir, "{}_{:05d}.tar".format(self._prefix, len(self.shards)))
+        self._tar = tarfile.open(path, "w", format=tarfile.USTAR_FORMAT)
+        self._index = open(path[:-len(".tar")] + ".idx", "w")
+        self.shards.append(path)
+
+    def _add_member(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        # a ustar header is a single block (the member names are short)
+        offset = self._tar.offset + tarfile.BLOCKSIZE
+        self._tar.addfile(info, io.BytesIO(data))
+        return [offset, info.size]
+
+    def write(self, frame, local_source):
+        """
+        Add a frame to the current shard
+        :param frame: SingleFrame or FrameGroup
+        :param local_source: The frame local source (for a FrameGroup, dictionary of frame name to local source)
+        """
+        if self._tar is None or self._tar.offset >= self._shard_size:
+            self._open_shard()
+        key = "{:09d}".format(self.count)
+        sources = local_source if isinstance(local_source, dict) else {"image": local_source}
+        entry = {"key": key, "sources": {}}
+        for name, path in sources.items():
+            with open(path, "rb") as f:
+                data = f.read()
+            entry["sources"][name] = self._add_member(
+                "{}.{}{}".format(key, name, os.path.splitext(path)[1].lower()), data)
+        entry["record"] = self._add_member("{}.json".format(key), json.dumps(frame_record(frame)).encode("utf-8"))
+        self._index.write(json.dumps(entry) + "\n")
+        self.count += 1
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._index.close()
+            self._tar = self._index = None
+
+
+def export_dataview(dataview, out_dir, shard_size_mb=256, lookahead=64, num_threads=8):
+    """
+    Download the frames of a DataView and pack them into shards
+    :param dataview: The DataView (already queried)
+    :param out_dir: Output folder for the shards
+    :param shard_size_mb: Approximate size of a shard in MB
+    :param lookahead: Number of frames downloaded ahead of the writer
+    :param num_threads: Number of download threads
+    :return: list of the written shard files
+    """
+    writer = ShardWriter(out_dir, shard_size_mb)
+    prefetcher = FramePrefetcher(dataview.get_iterator(), lookahead=lookahead, num_threads=num_threads)
+    try:
+        for frame, local_source in prefetcher:
+            writer.write(frame, local_source)
+    finally:
+        writer.close()
+    print("Exported {} frames into {} shards, download stats {}".format(
+        writer.count, len(writer.shards), prefetcher.stats))
+    return writer.shards
+
+
+def list_shards(shards_dir):
+    """
+    :return: sorted list of the shard files in the folder
+    """
+    return sorted(glob(os.path.join(shards_dir, "*.tar")))
+
+
+def read_shard(path, buffer_size=8 * 1024 * 1024):
+    """
+    Read a shard front to back
+    :param path: The shard tar file
+    :param buffer_size: Read buffer size, large enough for sequential disk reads
+    :return: iterator of (key, dictionary of source name to image bytes, frame record)
+    """
+    with open(path[:-len(".tar")] + ".idx", "r") as f:
+        entries = [json.loads(line) for line in f]
+    with open(path, "rb", buffering=buffer_size) as f:
+        for entry in entries:
+            # the members are in offset order, the seeks only skip the tar headers within the read buffer
+            images = {}
+            for name, (offset, size) in entry["sources"].items():
+                f.seek(offset)
+                images[name] = f.read(size)
+            offset, size = entry["record"]
+            f.seek(offset)
+            yield entry["key"], images, json.loads(f.read(size).decode("utf-8"))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Export a DataView to packed shards')
+
+    parser.add_argument('--dataset', type=str, help='Dataset name', required=True)
+    parser.add_argument('--version', type=str, help='Version name', required=True)
+    parser.add_argument('--roi_query', type=str, help='Optional ROI query (e.g. a label)')
+    parser.add_argument('--out', type=str, help='Output folder for the shards', required=True)
+    parser.add_argument('--shard_size_mb', type=int, help='Approximate size of a shard in MB', default=256)
+    parser.add_argument('--lookahead', type=int, help='Number of frames downloaded ahead', default=64)
+    parser.add_argument('--threads', type=int, help='Number of download threads', default=8)
+
+    args = parser.parse_args()
+
+    task = Task.init(project_name="examples", task_name="export dataview to shards")
+    dataview = DataView(name="export")
+    query = dict(dataset_name=args.dataset, version_name=args.version)
+    if args.roi_query:
+        query["roi_query"] = args.roi_query
+    dataview.add_query(**query)
+    export_dataview(dataview, args.out, args.shard_size_mb, args.lookahead, args.threads)
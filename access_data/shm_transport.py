@@ -0,0 +1,157 @@
+"""
+uint8 shared-memory batch transport from the DataLoader workers.
+
+By default every sample is converted to float32 in the worker, and every batch is pickled back to the main process
+through the DataLoader queue. With the shared memory transport, the workers keep the images as uint8, and the
+collate_fn (ShmCollate) writes each batch directly into a slot of a preallocated shared memory ring (SharedBatchRing),
+returning only the slot number. The main process gets zero-copy views of the slot (optionally in pinned memory for
+fast GPU copies), converts them to float once per batch, and releases the slot for the workers to reuse.
+
+The batches prefetched by the workers but never consumed (an early break, limit_*_batches, the sanity check) never
+release their slots, so ShmDataLoader creates a new ring for every iteration and closes the ring of the previous one.
+
+Usage:
+    loader = ShmDataLoader(
+        dataset, partial(SharedBatchRing, num_workers * 2 + 2, 32, (1, 28, 28), 10),
+        batch_size=32, num_workers=num_workers)
+    for shm_batch in loader:
+        images, labels = to_float_batch(*loader.ring.views(shm_batch))
+        loader.ring.release(shm_batch.slot)
+"""
+import itertools
+import weakref
+from collections import namedtuple
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+# the open rings of this process, by ring id (dropped once closed or garbage collected)
+RINGS = weakref.WeakValueDictionary()
+_ring_ids = itertools.count()
+
+ShmBatch = namedtuple("ShmBatch", ["ring_id", "slot", "count"])
+
+
+class SharedBatchRing(object):
+    def __init__(self, num_slots, batch_size, image_shape, label_size, pin_memory=False):
+        """
+        :param num_slots: Number of batch slots, must be larger than the number of batches the DataLoader keeps in
+            flight (num_workers * prefetch_factor), plus the batches used by the consumer
+        :param batch_size: Maximum batch size
+        :param image_shape: Shape of a single image, e.g. (1, 28, 28)
+        :param label_size: Size of a single label vector
+        :param pin_memory: Register the ring as pinned memory, for faster non blocking copies to the GPU
+        """
+        self.ring_id = next(_ring_ids)
+        self.images = torch.empty((num_slots, batch_size) + tuple(image_shape), dtype=torch.uint8).share_memory_()
+        self.labels = torch.empty((num_slots, batch_size, label_size), dtype=torch.uint8).share_memory_()
+        self.free_slots = mp.get_context().SimpleQueue()
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+        self.pinned = pin_memory and self._pin()
+        self._pending = []
+        RINGS[self.ring_id] = self
+
+    def _pin(self):
+        if not torch.cuda.is_available():
+            return False
+        cudart = torch.cuda.cudart()
+        for tensor in (self.images, self.labels):
+            cudart.cudaHostRegister(tensor.data_ptr(), tensor.numel() * tensor.element_size(), 0)
+        return True
+
+    def close(self):
+        """
+        Stop using the ring (its shared memory is freed once the workers using it exited)
+        """
+        RINGS.pop(self.ring_id, None)
+        if self.pinned:
+            cudart = torch.cuda.cudart()
+            for tensor in (self.images, self.labels):
+                cudart.cudaHostUnregister(tensor.data_ptr())
+            self.pinned = False
+
+    def __del__(self):
+        self.close()
+
+    def views(self, shm_batch):
+        """
+        :param shm_batch: ShmBatch returned by ShmCollate
+        :return: tuple of (uint8 images, uint8 labels) views of the slot (valid until the slot is released)
+        """
+        return self.images[shm_batch.slot, :shm_batch.count], self.labels[shm_batch.slot, :shm_batch.count]
+
+    def release(self, slot, event=None):
+        """
+        Return a slot to the workers
+        :param slot: The slot number
+        :param event: Optional torch.cuda.Event, the slot is released only once the event completed (e.g. after the
+            non blocking copy of its views to the GPU)
+        """
+        self._pending.append((slot, event))
+        pending = []
+        for slot, event in self._pending:
+            if event is None or event.query():
+                self.free_slots.put(slot)
+            else:
+                pending.append((slot, event))
+        self._pending = pending
+
+
+class ShmCollate(object):
+    """
+    DataLoader collate_fn writing the uint8 samples of a batch into a free slot of a SharedBatchRing
+    """
+
+    def __init__(self, ring=None):
+        """
+        :param ring: The SharedBatchRing (set by ShmDataLoader for every iteration)
+        """
+        self.ring = ring
+
+    def __call__(self, batch):
+        slot = self.ring.free_slots.get()
+        images, labels = self.ring.images[slot], self.ring.labels[slot]
+        for idx, (image, label) in enumerate(batch):
+            images[idx].copy_(image)
+            labels[idx].numpy()[:] = label
+        return ShmBatch(self.ring.ring_id, slot, len(batch))
+
+
+class ShmDataLoader(DataLoader):
+    """
+    DataLoader sending the batches through a new SharedBatchRing for every iteration
+    """
+
+    def __init__(self, dataset, ring_factory, shm_collate=None, **kwargs):
+        """
+        :param dataset: The dataset, returning (uint8 image, label) samples
+        :param ring_factory: Callable returning a new SharedBatchRing
+        :param shm_collate: The ShmCollate of the loader, when collate_fn wraps it (e.g. TimedCollate)
+        :param kwargs: DataLoader arguments, without persistent workers (they keep the collate_fn of their first
+            iteration, so they would keep writing into a closed ring)
+        """
+        if kwargs.get("persistent_workers"):
+            raise ValueError("The shared memory transport does not support persistent workers")
+        self.ring_factory = ring_factory
+        self.shm_collate = shm_collate or ShmCollate()
+        self.ring = None
+        kwargs.setdefault("collate_fn", self.shm_collate)
+        super().__init__(dataset, **kwargs)
+
+    def __iter__(self):
+        # the slots of the batches the previous iteration left in flight are lost with its ring
+        if self.ring is not None:
+            self.ring.close()
+        self.ring = self.ring_factory()
+        self.shm_collate.ring = self.ring
+        return super().__iter__()
+
+
+def to_float_batch(images, labels):
+    """
+    Convert a uint8 batch to float, in a single step per tensor
+    :return: tuple of (float images in [0, 1], float labels)
+    """
+    return images.float().div_(255.), labels.float()
@@ -0,0 +1,277 @@
+"""
+Size-capped local cache of frames sources.
+
+frame.get_local_source() (and dataview.prefetch_files()) keep every downloaded file, so training on a version larger
+than the local disk eventually fills it. SourceCache wraps frame.get_local_source(): every downloaded file is hard
+linked (or copied, across file systems) into `cache_dir`, then removed from the SDK cache (the SDK downloads it again
+if it is ever asked for it outside of SourceCache), and when the cached files exceed `max_size_mb`, the least recently
+used (or, with policy="lfu", the least frequently used) files are deleted.
+
+`max_size_mb` bounds the disk used by the downloaded sources: the files in `cache_dir`, plus the files being
+downloaded at the moment (at most one per download thread). Sources downloaded by the SDK outside of SourceCache
+(e.g. dataview.prefetch_files()) are not counted.
+
+Files used by a worker (between get(frame, pin=True) and release(frame)), and frames pinned for the current epoch
+window with pin(), are not evicted. A pin expires after `pin_ttl` seconds, so the pins of killed workers (or of
+DataLoader workers leaving with os._exit) cannot keep the cache over its size limit.
+
+The index (size, last access, number of hits and pins of every file) and the hit/miss/eviction counters are kept in a
+sqlite file inside `cache_dir`, so a single cache (and its byte cap) is shared by all the DataLoader workers.
+Local sources (paths and file:// URIs) are never copied, they are returned as is.
+
+Usage:
+    cache = SourceCache("/scratch/sources", max_size_mb=200 * 1024)
+    local_file = cache.get(frame, pin=True)
+    img = Image.open(local_file)
+    cache.release(frame)
+    print(cache.stats())
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import pytorch_lightning as pl
+
+from allegroai import Task
+
+POLICIES = {
+    "lru": "last_access",
+    "lfu": "hits, last_access",
+}
+COUNTERS = ("hits", "misses", "evictions", "evicted_bytes", "downloaded_bytes")
+
+
+def source_key(frame):
+    """
+    :param frame: SingleFrame
+    :return: the cache key of the frame source
+    """
+    return str(frame.source)
+
+
+def is_local(source):
+    return "://" not in source or source.startswith("file://")
+
+
+class SourceCache(object):
+    def __init__(self, cache_dir, max_size_mb=10 * 1024, policy="lru", pin_ttl=600):
+        """
+        :param cache_dir: Folder to keep the downloaded sources in
+        :type cache_dir: str
+        :param max_size_mb: Maximum size of the cached files in MB
+        :type max_size_mb: int
+        :param policy: Eviction order, "lru" (least recently used first) or "lfu" (least frequently used first)
+        :type policy: str
+        :param pin_ttl: Seconds after which a pin not released is ignored
+        :type pin_ttl: float
+        """
+        if policy not in POLICIES:
+            raise ValueError("Unsupported eviction policy {}, use one of {}".format(policy, list(POLICIES)))
+        self._cache_dir = cache_dir
+        self._max_bytes = int(max_size_mb) * 1024 * 1024
+        self._order = POLICIES[policy]
+        self._pin_ttl = pin_ttl
+        self._local = threading.local()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, frame, pin=False):
+        """
+        Get the local copy of a frame source, downloading it on a miss
+        :param frame: SingleFrame
+        :param pin: If True, the file is not evicted until release(frame) is called
+        :return: the local file path
+        """
+        key = source_key(frame)
+        if is_local(key):
+            return frame.get_local_source()
+        path = self._lookup(key, pin)
+        if path:
+            return path
+        downloaded = frame.get_local_source()
+        # another worker may have stored (and removed) the same SDK file in the meantime
+        # if the file cannot be stored, do not fail the training, use the SDK cache file
+        return self._store(key, downloaded, pin) or self._lookup(key, pin) or downloaded
+
+    def release(self, frame):
+        """
+        Unpin a frame source pinned by get(frame, pin=True)
+        """
+        self.unpin([source_key(frame)])
+
+    def pin(self, keys):
+        """
+        Protect cached sources from eviction (e.g. the frames of the current epoch window)
+        :param keys: list of sources (see source_key)
+        """
+        db = self._connect()
+        with db:
+            db.executemany(
+                "UPDATE entries SET pins=pins+1, pinned_until=? WHERE key=?",
+                ((time.time() + self._pin_ttl, key) for key in keys))
+
+    def unpin(self, keys):
+        db = self._connect()
+        with db:
+            db.executemany("UPDATE entries SET pins=MAX(0, pins-1) WHERE key=?", ((key,) for key in keys))
+
+    def clear_pins(self):
+        """
+        Drop all the pins, e.g. the ones left by killed DataLoader workers
+        """
+        db = self._connect()
+        with db:
+            db.execute("UPDATE entries SET pins=0 WHERE pins>0")
+
+    def stats(self):
+        """
+        :return: dictionary of the hits, misses, evictions, evicted bytes and downloaded bytes of all the processes
+            using the cache, with the current number of entries, size in bytes and hit rate
+        """
+        db = self._connect()
+        stats = dict.fromkeys(COUNTERS, 0)
+        stats.update(db.execute("SELECT name, value FROM counters"))
+        stats["entries"], stats["size_bytes"] = db.execute("SELECT COUNT(*), TOTAL(size) FROM entries").fetchone()
+        stats["size_bytes"] = int(stats["size_bytes"])
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = float(stats["hits"]) / lookups if lookups else 0.
+        return stats
+
+    def _path(self, key, downloaded):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self._cache_dir, digest[:2], digest + os.path.splitext(downloaded)[1])
+
+    def _lookup(self, key, pin):
+        db = self._connect()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT path FROM entries WHERE key=?", (key,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(row[0]):
+                # deleted outside of the cache
+                db.execute("DELETE FROM entries WHERE key=?", (key,))
+                return None
+            now = time.time()
+            db.execute(
+                "UPDATE entries SET last_access=?, hits=hits+1, pins=pins+?, "
+                "pinned_until=CASE WHEN ? THEN ? ELSE pinned_until END WHERE key=?",
+                (now, int(pin), int(pin), now + self._pin_ttl, key))
+            self._count(db, hits=1)
+        return row[0]
+
+    def _store(self, key, downloaded, pin):
+        """
+        Link (or copy) a downloaded file into the cache, remove the SDK copy, and evict files over the size limit
+        :return: the cached file path, or None if the downloaded file could not be stored
+        """
+        path = self._path(key, downloaded)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            try:
+                # no copy on the same file system
+                os.link(downloaded, tmp_path)
+            except OSError:
+                shutil.copyfile(downloaded, tmp_path)
+        except (IOError, OSError):
+            return None
+        size = os.path.getsize(tmp_path)
+        db = self._connect()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT path FROM entries WHERE key=?", (key,)).fetchone()
+            if row is not None:
+                # stored by another worker while we were downloading
+                os.remove(tmp_path)
+                now = time.time()
+                db.execute(
+                    "UPDATE entries SET last_access=?, pins=pins+?, "
+                    "pinned_until=CASE WHEN ? THEN ? ELSE pinned_until END WHERE key=?",
+                    (now, int(pin), int(pin), now + self._pin_ttl, key))
+                self._remove_download(downloaded)
+                return row[0]
+            os.replace(tmp_path, path)
+            now = time.time()
+            db.execute(
+                "INSERT INTO entries (key, path, size, last_access, hits, pins, pinned_until) "
+                "VALUES (?, ?, ?, ?, 0, ?, ?)",
+                (key, path, size, now, int(pin), now + self._pin_ttl if pin else 0))
+            self._count(db, misses=1, downloaded_bytes=size)
+            evicted = self._evict(db)
+        # the cache holds the only copy, so evicting it frees the disk space
+        self._remove_download(downloaded)
+        for evicted_path in evicted:
+            try:
+                os.remove(evicted_path)
+            except OSError:
+                pass
+        return path
+
+    @staticmethod
+    def _remove_download(downloaded):
+        try:
+            os.remove(downloaded)
+        except OSError:
+            pass
+
+    def _evict(self, db):
+        """
+        Remove the unpinned entries over the size limit from the index
+        :return: list of the files to delete (once the transaction is committed)
+        """
+        excess = db.execute("SELECT TOTAL(size) FROM entries").fetchone()[0] - self._max_bytes
+        if excess <= 0:
+            return []
+        evicted, evicted_bytes = [], 0
+        for key, path, size in db.execute(
+                "SELECT key, path, size FROM entries WHERE pins=0 OR pinned_until<? ORDER BY {}".format(self._order),
+                (time.time(),)).fetchall():
+            if evicted_bytes >= excess:
+                break
+            evicted.append((key, path))
+            evicted_bytes += size
+        db.executemany("DELETE FROM entries WHERE key=?", ((key,) for key, _ in evicted))
+        self._count(db, evictions=len(evicted), evicted_bytes=evicted_bytes)
+        return [path for _, path in evicted]
+
+    @staticmethod
+    def _count(db, **counters):
+        db.executemany(
+            "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value=value+?",
+            [(name, value, value) for name, value in counters.items()])
+
+    def _connect(self):
+        # sqlite connections cannot be shared between forked DataLoader workers, nor between prefetch threads
+        local = self._local
+        if getattr(local, "db", None) is None or local.pid != os.getpid():
+            local.db = sqlite3.connect(os.path.join(self._cache_dir, "index.sqlite"), timeout=60, isolation_level=None)
+            local.db.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, path TEXT, size INTEGER, last_access REAL, hits INTEGER, pins INTEGER, "
+                "pinned_until REAL)")
+            local.db.execute("CREATE INDEX IF NOT EXISTS entries_access ON entries (last_access)")
+            local.db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+            local.pid = os.getpid()
+        return local.db
+
+
+class SourceCacheStatsCallback(pl.Callback):
+    """
+    Report the source cache stats at the end of each training epoch
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        stats = self._cache.stats()
+        print("Source cache: {hits} hits, {misses} misses ({hit_rate:.1%} hit rate), {evictions} evictions, "
+              "{size_bytes} bytes in {entries} files".format(**stats))
+        task = Task.current_task()
+        if task:
+            logger = task.get_logger()
+            for name, value in stats.items():
+                logger.report_scalar(title="source_cache", series=name, value=value, iteration=trainer.current_epoch)
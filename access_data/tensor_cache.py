@@ -0,0 +1,200 @@
+"""
+Persistent on-disk cache of transformed samples.
+
+The transformed tensors are stored in a single memory-mapped array file (one fixed size slot per frame), so from the
+second epoch onward (and in later runs using the same transform) a sample is read straight from the page cache
+without downloading or decoding the image.
+
+Each transform pipeline (and image decode mode) gets its own cache file, named by a fingerprint of the transform, and
+the entries inside it are keyed by the frame id. The index is kept in a small sqlite file, so the cache can be shared
+by all the DataLoader workers. When the cache reaches its size limit, the least recently used entries are evicted.
+A cache hit only reads the index: the access times are buffered in every process and written in one transaction every
+flush_every hits (or flush_seconds), and before evicting, so the eviction order is approximately LRU.
+
+Usage:
+    cache = TensorCache("/tmp/allegro_cache", transform, max_size_mb=1024)
+    tensor = cache.get(frame.id)
+    if tensor is None:
+        tensor = transform(img)
+        cache.put(frame.id, tensor)
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+import torch
+
+
+def transform_fingerprint(transform, decode=""):
+    """
+    Get a fingerprint of a transform pipeline
+    :param transform: The transform (e.g. transforms.Compose), its repr should describe all of its parameters
+    :type transform: callable
+    :param decode: Name of the decode mode before the transform (e.g. reduced resolution decoding)
+    :type decode: str
+    :return: hex digest identifying the transform
+    """
+    return hashlib.sha1((decode + repr(transform)).encode("utf-8")).hexdigest()[:16]
+
+
+class TensorCache(object):
+    def __init__(self, cache_dir, transform, max_size_mb=1024, decode="", flush_every=256, flush_seconds=5.):
+        """
+        :param cache_dir: Folder to store the cache files in
+        :type cache_dir: str
+        :param transform: The transform whose outputs are cached (used for the fingerprint)
+        :type transform: callable
+        :param max_size_mb: Maximum size of the samples array file in MB
+        :type max_size_mb: int
+        :param decode: Name of the image decode mode, part of the fingerprint (the same transform of a differently
+            decoded image gives different samples)
+        :type decode: str
+        :param flush_every: Number of cache hits whose access times are buffered before updating the index
+        :type flush_every: int
+        :param flush_seconds: Also update the index if the oldest buffered access time is older than this
+        :type flush_seconds: float
+        """
+        self._fingerprint = transform_fingerprint(transform, decode)
+        self._base_path = os.path.join(cache_dir, self._fingerprint)
+        self._max_bytes = int(max_size_mb) * 1024 * 1024
+        self._meta = None
+        self._array = None
+        self._db = None
+        self._pid = None
+        self._flush_every = flush_every
+        self._flush_seconds = flush_seconds
+        self._accessed = {}
+        self._accessed_since = None
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def fingerprint(self):
+        return self._fingerprint
+
+    def get(self, key):
+        """
+        Get a cached sample
+        :param key: The frame id
+        :type key: str
+        :return: torch.Tensor or None if the frame is not in the cache
+        """
+        db = self._connect()
+        row = db.execute("SELECT slot FROM entries WHERE key=?", (key,)).fetchone()
+        if row is None or not self._open_array():
+            return None
+        slot = row[0]
+        sample = np.array(self._array[slot])
+        # make sure the slot was not evicted and rewritten while we copied it
+        row = db.execute("SELECT slot FROM entries WHERE key=?", (key,)).fetchone()
+        if row is None or row[0] != slot:
+            return None
+        self._accessed[key] = time.time()
+        if self._accessed_since is None:
+            self._accessed_since = self._accessed[key]
+        if len(self._accessed) >= self._flush_every or \
+                self._accessed[key] - self._accessed_since >= self._flush_seconds:
+            self.flush()
+        return torch.from_numpy(sample)
+
+    def flush(self):
+        """
+        Write the buffered access times to the index
+        """
+        if not self._accessed:
+            return
+        accessed, self._accessed, self._accessed_since = self._accessed, {}, None
+        db = self._connect()
+        with db:
+            db.execute("BEGIN")
+            db.executemany(
+                "UPDATE entries SET last_access=? WHERE key=?", [(t, key) for key, t in accessed.items()])
+
+    def __contains__(self, key):
+        return self._connect().execute("SELECT 1 FROM entries WHERE key=?", (key,)).fetchone() is not None
+
+    def put(self, key, tensor):
+        """
+        Store a sample in the cache, evicting the least recently used sample if the cache is full
+        :param key: The frame id
+        :type key: str
+        :param tensor: The transformed sample
+        :type tensor: torch.Tensor
+        """
+        sample = tensor.detach().cpu().numpy()
+        db = self._connect()
+        if not self._open_array(sample):
+            # different shape/dtype than the cache (transform output is not fixed size), do not cache
+            return
+        # the eviction order must include the hits of this process
+        self.flush()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            if db.execute("SELECT 1 FROM entries WHERE key=?", (key,)).fetchone():
+                return
+            slot = self._allocate_slot(db)
+            db.execute("DELETE FROM entries WHERE slot=?", (slot,))
+            self._array[slot] = sample
+            db.execute(
+                "INSERT INTO entries (key, slot, last_access) VALUES (?, ?, ?)", (key, slot, time.time()))
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _allocate_slot(self, db):
+        # entries are only removed when their slot is reused, so the used slots are always 0..used-1
+        used = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if used < self._meta["capacity"]:
+            return used
+        # cache is full, evict the least recently used sample
+        return db.execute("SELECT slot FROM entries ORDER BY last_access LIMIT 1").fetchone()[0]
+
+    def _connect(self):
+        # sqlite connections cannot be shared between forked DataLoader workers
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self._base_path + ".sqlite", timeout=60, isolation_level=None)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, slot INTEGER UNIQUE, last_access REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_access ON entries (last_access)")
+            self._array = None
+            # the access times buffered by the parent process are flushed by the parent
+            self._accessed, self._accessed_since = {}, None
+            self._pid = os.getpid()
+        return self._db
+
+    def _open_array(self, sample=None):
+        """
+        Open the memory mapped samples file, creating it from the first stored sample
+        :return: True if the array is available (and matches the sample, if given)
+        """
+        if self._array is None or self._pid != os.getpid():
+            meta_file = self._base_path + ".json"
+            if not os.path.exists(meta_file):
+                if sample is None:
+                    return False
+                self._create_array(sample, meta_file)
+            with open(meta_file, "r") as f:
+                self._meta = json.load(f)
+            self._array = np.memmap(
+                self._base_path + ".bin", dtype=self._meta["dtype"], mode="r+",
+                shape=tuple([self._meta["capacity"]] + self._meta["shape"]))
+        if sample is not None:
+            return list(sample.shape) == self._meta["shape"] and str(sample.dtype) == self._meta["dtype"]
+        return True
+
+    def _create_array(self, sample, meta_file):
+        capacity = max(1, self._max_bytes // max(1, sample.nbytes))
+        db = self._db
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            # another worker might have created the file while we were waiting for the lock
+            if os.path.exists(meta_file):
+                return
+            np.memmap(
+                self._base_path + ".bin", dtype=sample.dtype, mode="w+", shape=(capacity, ) + sample.shape).flush()
+            with open(meta_file + ".tmp", "w") as f:
+                json.dump({"shape": list(sample.shape), "dtype": str(sample.dtype), "capacity": capacity}, f)
+            os.rename(meta_file + ".tmp", meta_file)
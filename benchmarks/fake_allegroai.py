@@ -0,0 +1,239 @@
+"""
+In-process stand-in for the allegroai (and clearml StorageManager) classes used by the examples, so the registration
+and data loading scripts can be measured without a ClearML server.
+
+Server calls sleep for a configurable latency, and data transfers (file downloads, auto upload) for their size divided
+by a configurable bandwidth, see FakeServer.
+
+Usage:
+    import fake_allegroai
+    fake_allegroai.install(latency=0.05, bandwidth=50 * 1024 * 1024)
+    # from now on `from allegroai import DataView` returns the fake classes
+"""
+import hashlib
+import os
+import sys
+import threading
+import types
+from time import sleep
+
+
+class FakeServer(object):
+    latency = 0.0
+    bandwidth = None
+    lock = threading.Lock()
+    # version name -> list of registered frames
+    versions = {}
+    calls = {}
+
+    @classmethod
+    def call(cls, name, transfer_bytes=0):
+        with cls.lock:
+            cls.calls[name] = cls.calls.get(name, 0) + 1
+        delay = cls.latency
+        if cls.bandwidth and transfer_bytes:
+            delay += transfer_bytes / float(cls.bandwidth)
+        if delay:
+            sleep(delay)
+
+    @classmethod
+    def reset(cls):
+        cls.versions = {}
+        cls.calls = {}
+
+
+class IterationOrder(object):
+    sequential = "sequential"
+    random = "random"
+
+
+class ImageAnnotation(object):
+    def __init__(self, labels=None, **kwargs):
+        self.labels = labels or []
+        self.kwargs = kwargs
+
+
+class SingleFrame(object):
+    def __init__(self, source=None, id=None, metadata=None, width=None, height=None, preview_source=None, **kwargs):
+        self.source = source
+        self._id = id
+        self.metadata = metadata if metadata is not None else {}
+        self.width = width
+        self.height = height
+        self.preview_source = preview_source
+        self.annotations = []
+
+    @property
+    def id(self):
+        if self._id is None:
+            return hashlib.sha1(str(self.source).encode("utf-8")).hexdigest()
+        return self._id
+
+    @id.setter
+    def id(self, value):
+        self._id = value
+
+    def add_annotation(self, **kwargs):
+        self.annotations.append(ImageAnnotation(**kwargs))
+
+    def get_local_source(self):
+        size = os.path.getsize(self.source) if os.path.exists(self.source) else 0
+        FakeServer.call("get_local_source", size)
+        return self.source
+
+
+class FrameGroup(dict):
+    def __init__(self, id=None, metadata=None, **kwargs):
+        super(FrameGroup, self).__init__(**kwargs)
+        self._id = id
+        self.metadata = metadata if metadata is not None else {}
+        self.global_annotations = []
+
+    @property
+    def id(self):
+        if self._id is None:
+            return hashlib.sha1("".join(sorted(f.id for f in self.values())).encode("utf-8")).hexdigest()
+        return self._id
+
+    def add_global_annotation(self, annotation):
+        self.global_annotations.append(annotation)
+
+
+class DatasetVersion(object):
+    def __init__(self, dataset_name, version_name=None):
+        self.dataset_name = dataset_name
+        self.version_name = version_name or "current"
+        self.id = hashlib.sha1("{}/{}".format(dataset_name, self.version_name).encode("utf-8")).hexdigest()
+        self.is_draft = True
+
+    @classmethod
+    def create_new_dataset(cls, dataset_name=None, **kwargs):
+        FakeServer.call("create_new_dataset")
+        return cls(dataset_name)
+
+    @classmethod
+    def get_current(cls, dataset_name=None, **kwargs):
+        FakeServer.call("get_current")
+        return cls(dataset_name)
+
+    def create_version(self, version_name=None, **kwargs):
+        FakeServer.call("create_version")
+        return DatasetVersion(self.dataset_name, version_name)
+
+    @classmethod
+    def get_version(cls, dataset_name=None, version_name=None, **kwargs):
+        FakeServer.call("get_version")
+        return cls(dataset_name, version_name)
+
+    @classmethod
+    def create_snapshot(cls, dataset_name=None, **kwargs):
+        FakeServer.call("create_snapshot")
+
+    def _key(self):
+        return "{}/{}".format(self.dataset_name, self.version_name)
+
+    def add_frames(self, frames, auto_upload_destination=None, local_dataset_root_path=None, **kwargs):
+        frames = list(frames)
+        upload_bytes = 0
+        if auto_upload_destination:
+            upload_bytes = sum(os.path.getsize(f.source) for f in frames if os.path.exists(str(f.source)))
+        FakeServer.call("add_frames", upload_bytes)
+        with FakeServer.lock:
+            FakeServer.versions.setdefault(self._key(), []).extend(frames)
+
+    def delete_frames(self, frames, **kwargs):
+        frame_ids = set(f if isinstance(f, str) else f.id for f in frames)
+        FakeServer.call("delete_frames")
+        with FakeServer.lock:
+            FakeServer.versions[self._key()] = [
+                f for f in FakeServer.versions.get(self._key(), []) if f.id not in frame_ids]
+
+    def commit_version(self, **kwargs):
+        FakeServer.call("commit_version")
+        self.is_draft = False
+
+
+class DataView(object):
+    page_size = 500
+
+    def __init__(self, name=None, iteration_order=None, **kwargs):
+        self.name = name
+        self.iteration_order = iteration_order
+        self.queries = []
+        self.iteration_parameters = {}
+
+    def add_query(self, **kwargs):
+        self.queries.append(kwargs)
+
+    def add_multi_query(self, **kwargs):
+        self.queries.append(kwargs)
+
+    def set_iteration_parameters(self, **kwargs):
+        self.iteration_parameters.update(kwargs)
+
+    def _frames(self):
+        frames = []
+        for query in self.queries:
+            version = query.get("version_name") or query.get("version_id")
+            for key, version_frames in FakeServer.versions.items():
+                if key.endswith("/{}".format(version)):
+                    frames.extend(version_frames)
+        return frames
+
+    def get_count(self):
+        FakeServer.call("get_count")
+        return len(self._frames()), {}
+
+    def get_iterator(self, **kwargs):
+        for idx, frame in enumerate(self._frames()):
+            if idx % self.page_size == 0:
+                FakeServer.call("get_iterator_page")
+            yield frame
+
+    def to_list(self):
+        return list(self.get_iterator())
+
+    def prefetch_files(self, **kwargs):
+        pass
+
+
+class Task(object):
+    @classmethod
+    def init(cls, **kwargs):
+        return cls()
+
+    @classmethod
+    def current_task(cls):
+        return None
+
+
+class StorageManager(object):
+    @staticmethod
+    def list(remote_url, return_full_path=False, **kwargs):
+        FakeServer.call("storage_list")
+        names = sorted(os.listdir(remote_url))
+        return [os.path.join(remote_url, n) for n in names] if return_full_path else names
+
+
+def install(latency=0.0, bandwidth=None):
+    """
+    Replace the allegroai and clearml modules with the fake classes
+    :param latency: Seconds added to every server call
+    :param bandwidth: Bytes per second for downloads and uploads (None for unlimited)
+    """
+    FakeServer.latency = latency
+    FakeServer.bandwidth = bandwidth
+
+    allegroai = types.ModuleType("allegroai")
+    for cls in (DatasetVersion, DataView, FrameGroup, IterationOrder, SingleFrame, Task):
+        setattr(allegroai, cls.__name__, cls)
+    dataframe = types.ModuleType("allegroai.dataframe")
+    dataframe.ImageAnnotation = ImageAnnotation
+    allegroai.dataframe = dataframe
+    clearml = types.ModuleType("clearml")
+    clearml.StorageManager = StorageManager
+    clearml.Task = Task
+
+    sys.modules["allegroai"] = allegroai
+    sys.modules["allegroai.dataframe"] = dataframe
+    sys.modules["clearml"] = clearml
@@ -0,0 +1,203 @@
+"""
+Offline benchmarks of the registration and data loading examples.
+
+The allegroai classes are replaced with the in-process fakes of fake_allegroai.py (with configurable server latency and
+bandwidth), and the inputs are generated at scale from the register_data/data/sample_ds and register_data/toy_img
+fixtures (files are symlinked, not copied).
+
+Measured:
+ - registration_with_roi_and_meta: get_frames_with_roi_meta and the streaming iter_frames_with_roi_meta
+ - register_s3_buckets: create_frames + create_version_with_frames and register_versions_concurrently
+ - register_dataset_with_upload: get_frames + create_version_with_frames (with auto upload)
+ - pytorch_with_iter_dataset: AllegroDatasetIter and AllegroIterableDataset through a DataLoader, for each
+   num_workers and batch size (skipped if torch / torchvision / pytorch_lightning are not installed)
+
+The results are written as json, so runs can be compared with each other.
+
+You can run the benchmarks from this dir with:
+
+python run_benchmarks.py --frames 2000 --latency 0.01 --bandwidth_mb 100 --out results.json
+"""
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+from argparse import ArgumentParser
+from glob import glob
+from time import time
+
+import fake_allegroai
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_DS = os.path.join(ROOT, "register_data", "data", "sample_ds")
+TOY_IMG = os.path.join(ROOT, "register_data", "toy_img")
+
+
+def _link(src, dst):
+    try:
+        os.symlink(src, dst)
+    except (OSError, NotImplementedError):
+        shutil.copyfile(src, dst)
+
+
+def make_sidecar_dataset(out_dir, count):
+    """
+    Generate `count` images with json sidecars from the sample_ds fixture
+    """
+    os.makedirs(out_dir)
+    samples = sorted(glob(os.path.join(SAMPLE_DS, "*.jpg")))
+    for i in range(count):
+        sample = samples[i % len(samples)]
+        _link(sample, os.path.join(out_dir, "{:08d}.jpg".format(i)))
+        _link(sample.replace(".jpg", ".json"), os.path.join(out_dir, "{:08d}.json".format(i)))
+    return out_dir
+
+
+def make_image_tree(out_dir, count, folders=4):
+    """
+    Generate `count` images from the toy_img fixture, split into `folders` sub folders
+    """
+    samples = sorted(glob(os.path.join(TOY_IMG, "*", "*.jpg")))
+    for f in range(folders):
+        os.makedirs(os.path.join(out_dir, "folder_{}".format(f)))
+    for i in range(count):
+        _link(samples[i % len(samples)],
+              os.path.join(out_dir, "folder_{}".format(i % folders), "{:08d}.jpg".format(i)))
+    return out_dir
+
+
+def measure(name, func, items, **params):
+    """
+    Run a benchmark function
+    :param name: Benchmark name
+    :param func: Function to measure, returns the number of processed items (or None to use `items`)
+    :param items: Number of items processed by func
+    :return: result dictionary
+    """
+    fake_allegroai.FakeServer.reset()
+    start = time()
+    # the examples print a line per file, keep the benchmark output readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        processed = func()
+    seconds = time() - start
+    items = processed if processed is not None else items
+    result = {
+        "name": name,
+        "params": params,
+        "items": items,
+        "seconds": round(seconds, 4),
+        "items_per_sec": round(items / seconds, 2) if seconds else None,
+        "server_calls": dict(fake_allegroai.FakeServer.calls),
+    }
+    print("{:<60} {:>10.3f}s {:>12.1f} items/sec".format(
+        name + " " + json.dumps(params, sort_keys=True), seconds, result["items_per_sec"] or 0))
+    return result
+
+
+def bench_registration(work_dir, frames, workers):
+    import registration_with_roi_and_meta as roi_meta
+    import register_s3_buckets as s3_buckets
+    import register_dataset_with_upload as with_upload
+
+    results = []
+    sidecar_dir = make_sidecar_dataset(os.path.join(work_dir, "sidecars"), frames)
+    image_tree = make_image_tree(os.path.join(work_dir, "images"), frames)
+
+    def roi_meta_baseline():
+        roi_meta.base_path = sidecar_dir
+        roi_meta.create_version_with_frames(roi_meta.get_frames_with_roi_meta("jpg"), "bench", "roi_meta")
+    results.append(measure("get_frames_with_roi_meta", roi_meta_baseline, frames))
+
+    def roi_meta_streaming():
+        roi_meta.create_version_with_frames(
+            roi_meta.iter_frames_with_roi_meta(sidecar_dir, "jpg", workers), "bench", "roi_meta", chunk_size=1000)
+    results.append(measure("iter_frames_with_roi_meta", roi_meta_streaming, frames, workers=workers))
+
+    def s3_baseline():
+        s3_buckets.create_version_with_frames("bench", s3_buckets.create_frames(image_tree))
+    results.append(measure("create_frames", s3_baseline, frames))
+
+    for concurrency in (1, 4):
+        results.append(measure(
+            "register_versions_concurrently",
+            lambda: sum(s3_buckets.register_versions_concurrently("bench", image_tree, concurrency).values()),
+            frames, concurrency=concurrency))
+
+    def upload_baseline():
+        version_frames = with_upload.get_frames(image_tree, "jpg")
+        with_upload.create_version_with_frames("bench", "upload", version_frames, "s3://bench/", image_tree)
+    results.append(measure("get_frames/create_version_with_frames", upload_baseline, frames))
+    return results
+
+
+def bench_loader(frames, num_workers_list, batch_sizes, max_batches):
+    try:
+        from torch.utils.data import DataLoader
+        import pytorch_with_iter_dataset as loader_example
+    except ImportError as ex:
+        print("Skipping the DataLoader benchmarks: {}".format(ex))
+        return [{"name": "AllegroDatasetIter", "skipped": str(ex)}]
+
+    samples = sorted(glob(os.path.join(TOY_IMG, "*", "*.jpg")))
+    version = "COCO - Common Objects in Context/Train2017 version"
+    results = []
+    for dataset_class in (loader_example.AllegroDatasetIter, loader_example.AllegroIterableDataset):
+        for num_workers in num_workers_list:
+            for batch_size in batch_sizes:
+                def run():
+                    fake_allegroai.FakeServer.versions[version] = [
+                        fake_allegroai.SingleFrame(source=samples[i % len(samples)], id=str(i))
+                        for i in range(frames)]
+                    dataview = fake_allegroai.DataView("bench")
+                    dataview.add_query(version_name="Train2017 version")
+                    loader = DataLoader(dataset_class(dataview), num_workers=num_workers, batch_size=batch_size)
+                    seen = 0
+                    for idx, (x, y) in enumerate(loader):
+                        seen += len(x)
+                        if max_batches and idx + 1 >= max_batches:
+                            break
+                    return seen
+                results.append(measure(
+                    dataset_class.__name__, run, frames, num_workers=num_workers, batch_size=batch_size))
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Offline benchmarks with a fake ClearML server')
+
+    parser.add_argument('--frames', type=int, help='Number of generated frames', default=2000)
+    parser.add_argument('--latency', type=float, help='Seconds added to every server call', default=0.01)
+    parser.add_argument('--bandwidth_mb', type=float, help='Download/upload bandwidth in MB/sec (default: unlimited)')
+    parser.add_argument('--workers', type=int, help='Processes for the parallel registration', default=4)
+    parser.add_argument('--num_workers', type=int, nargs='+', help='DataLoader num_workers values', default=[0, 2, 6])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', help='DataLoader batch sizes', default=[32, 128])
+    parser.add_argument('--max_batches', type=int, help='Stop each DataLoader benchmark after N batches')
+    parser.add_argument('--skip_loader', action='store_true', help='Only run the registration benchmarks')
+    parser.add_argument('--out', type=str, help='Output json file', default='benchmark_results.json')
+
+    args = parser.parse_args()
+
+    fake_allegroai.install(
+        latency=args.latency, bandwidth=args.bandwidth_mb * 1024 * 1024 if args.bandwidth_mb else None)
+    sys.path[:0] = [os.path.join(ROOT, "register_data"), os.path.join(ROOT, "access_data")]
+
+    work_dir = tempfile.mkdtemp(prefix="clearml_bench_")
+    try:
+        all_results = bench_registration(work_dir, args.frames, args.workers)
+        if not args.skip_loader:
+            all_results += bench_loader(args.frames, args.num_workers, args.batch_sizes, args.max_batches)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.out, "w") as f:
+        json.dump({
+            "time": time(),
+            "python": platform.python_version(),
+            "config": vars(args),
+            "results": all_results,
+        }, f, indent=2)
+    print("Results written to {}".format(args.out))
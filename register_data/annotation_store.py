@@ -0,0 +1,227 @@
+"""
+Columnar annotation store, replacing the per image json sidecars.
+
+Packs a folder of json sidecars (see data/sample_ds/*.json) into a single uncompressed .npz file:
+ - Frame level columns: image name, width, height, preview url and metadata (dictionary-encoded).
+ - ROIs: polygons in one contiguous float64 array with offset indexes, labels as ids into a label table,
+   confidence (float64) and metadata (dictionary-encoded).
+ - Keypoints: points in one contiguous float64 (N, 2) array with offset indexes (the -999999 "missing point"
+   sentinel is stored as is, and restored as an int).
+
+The floats are stored as float64, exactly the json values. The store is memory-mapped when read, so frames can be
+built from it without reading the whole file.
+
+Pack a folder with:
+
+python annotation_store.py --path data/sample_ds --ext jpg --out sample_ds.npz
+
+and register it with registration_with_roi_and_meta.py --store sample_ds.npz
+"""
+import glob
+import json
+import os
+import zipfile
+from argparse import ArgumentParser
+
+import numpy as np
+
+MISSING_KEYPOINT = -999999
+
+
+def _encode(values):
+    """
+    Dictionary-encode a list of strings
+    :return: tuple of (int32 ids array, table of unique values)
+    """
+    table = {}
+    ids = np.array([table.setdefault(v, len(table)) for v in values], dtype=np.int32)
+    return ids, np.array(list(table.keys()), dtype=np.str_)
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def pack_sidecars(folder, ext, out_path):
+    """
+    Pack the json sidecars of the images in a folder into a single columnar file
+    :param folder: Folder with the images and json files
+    :type folder: str
+    :param ext: Images extension
+    :type ext: str
+    :param out_path: Output .npz file
+    :type out_path: str
+    :return: number of packed frames
+    """
+    images, widths, heights, urls, frame_meta = [], [], [], [], []
+    rois_per_frame, roi_confidence, roi_meta, roi_labels_count, roi_labels, roi_poly_len, roi_poly = \
+        [], [], [], [], [], [], []
+    kps_per_frame, kp_labels_count, kp_labels, kp_points_len, kp_points = [], [], [], [], []
+
+    for image_path in sorted(glob.glob(os.path.join(folder, "*.{}".format(ext)))):
+        with open(os.path.splitext(image_path)[0] + ".json", "r") as f:
+            data = json.load(f)
+        images.append(os.path.basename(image_path))
+        widths.append(data['size']['x'])
+        heights.append(data['size']['y'])
+        urls.append(data.get('url', ''))
+        frame_meta.append(json.dumps(data.get('meta', {}), sort_keys=True))
+
+        rois_per_frame.append(len(data['rois']))
+        for roi in data['rois']:
+            roi_confidence.append(roi.get('confidence', 1.0))
+            roi_meta.append(json.dumps(roi.get('meta', {}), sort_keys=True))
+            roi_labels_count.append(len(roi['labels']))
+            roi_labels.extend(roi['labels'])
+            roi_poly_len.append(len(roi['poly']))
+            roi_poly.extend(roi['poly'])
+
+        keypoints = data.get('keypoints', [])
+        kps_per_frame.append(len(keypoints))
+        for kp in keypoints:
+            kp_labels_count.append(len(kp['labels']))
+            kp_labels.extend(kp['labels'])
+            kp_points_len.append(len(kp['keypoints']))
+            kp_points.extend(kp['keypoints'])
+
+    # a single label table for the rois and keypoints labels
+    label_ids, label_table = _encode(roi_labels + kp_labels)
+    frame_meta_ids, frame_meta_table = _encode(frame_meta)
+    roi_meta_ids, roi_meta_table = _encode(roi_meta)
+
+    np.savez(
+        out_path,
+        image=np.array(images, dtype=np.str_),
+        width=np.array(widths, dtype=np.int32),
+        height=np.array(heights, dtype=np.int32),
+        url=np.array(urls, dtype=np.str_),
+        meta_ids=frame_meta_ids,
+        meta_table=frame_meta_table,
+        label_table=label_table,
+        roi_frame_offsets=_offsets(rois_per_frame),
+        roi_confidence=np.array(roi_confidence, dtype=np.float64),
+        roi_meta_ids=roi_meta_ids,
+        roi_meta_table=roi_meta_table,
+        roi_label_offsets=_offsets(roi_labels_count),
+        roi_label_ids=label_ids[:len(roi_labels)],
+        roi_poly_offsets=_offsets(roi_poly_len),
+        roi_poly=np.array(roi_poly, dtype=np.float64),
+        kp_frame_offsets=_offsets(kps_per_frame),
+        kp_label_offsets=_offsets(kp_labels_count),
+        kp_label_ids=label_ids[len(roi_labels):],
+        kp_point_offsets=_offsets(kp_points_len),
+        kp_points=np.array(kp_points, dtype=np.float64).reshape(-1, 2),
+    )
+    return len(images)
+
+
+def load_store(store_path):
+    """
+    Memory-map all the columns of a store
+    :param store_path: .npz file created by pack_sidecars
+    :return: dictionary of column name to (read only) numpy array
+    """
+    columns = {}
+    with zipfile.ZipFile(store_path) as archive, open(store_path, "rb") as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError("Store {} is compressed and cannot be memory-mapped".format(store_path))
+            # skip the zip local header (fixed 30 bytes + file name + extra field)
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = np.frombuffer(f.read(4), dtype="<u2")
+            f.seek(info.header_offset + 30 + int(name_len) + int(extra_len))
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) \
+                else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            name = os.path.splitext(info.filename)[0]
+            if not np.prod(shape):
+                columns[name] = np.empty(shape, dtype=dtype)
+                continue
+            columns[name] = np.memmap(
+                store_path, dtype=dtype, mode="r", offset=f.tell(), shape=shape,
+                order="F" if fortran_order else "C")
+    return columns
+
+
+class AnnotationStore(object):
+    def __init__(self, store_path):
+        """
+        :param store_path: .npz file created by pack_sidecars
+        :type store_path: str
+        """
+        self.columns = load_store(store_path)
+
+    def __len__(self):
+        return len(self.columns["image"])
+
+    def rois(self, idx):
+        """
+        :param idx: Frame index in the store
+        :return: list of (poly float64 array, labels list, confidence, metadata dict)
+        """
+        c = self.columns
+        labels = c["label_table"]
+        ret = []
+        for r in range(c["roi_frame_offsets"][idx], c["roi_frame_offsets"][idx + 1]):
+            poly = c["roi_poly"][c["roi_poly_offsets"][r]:c["roi_poly_offsets"][r + 1]]
+            label_ids = c["roi_label_ids"][c["roi_label_offsets"][r]:c["roi_label_offsets"][r + 1]]
+            roi_labels = [str(labels[i]) for i in label_ids]
+            meta = json.loads(str(c["roi_meta_table"][c["roi_meta_ids"][r]]))
+            ret.append((poly, roi_labels, float(c["roi_confidence"][r]), meta))
+        return ret
+
+    def keypoints(self, idx):
+        """
+        :param idx: Frame index in the store
+        :return: list of (points float64 (N, 2) array, labels list)
+        """
+        c = self.columns
+        labels = c["label_table"]
+        ret = []
+        for k in range(c["kp_frame_offsets"][idx], c["kp_frame_offsets"][idx + 1]):
+            points = c["kp_points"][c["kp_point_offsets"][k]:c["kp_point_offsets"][k + 1]]
+            label_ids = c["kp_label_ids"][c["kp_label_offsets"][k]:c["kp_label_offsets"][k + 1]]
+            kp_labels = [str(labels[i]) for i in label_ids]
+            ret.append((points, kp_labels))
+        return ret
+
+    def sidecar(self, idx):
+        """
+        Rebuild the json sidecar data of a frame
+        :param idx: Frame index in the store
+        :return: dictionary in the json sidecar format
+        """
+        c = self.columns
+        data = {
+            "meta": json.loads(str(c["meta_table"][c["meta_ids"][idx]])),
+            "size": {"x": int(c["width"][idx]), "y": int(c["height"][idx])},
+            "url": str(c["url"][idx]),
+            "rois": [
+                {"confidence": confidence, "labels": labels, "poly": poly.tolist(), "meta": meta}
+                for poly, labels, confidence, meta in self.rois(idx)
+            ],
+        }
+        keypoints = self.keypoints(idx)
+        if keypoints:
+            data["keypoints"] = [
+                {"labels": labels,
+                 "keypoints": [[MISSING_KEYPOINT if v == MISSING_KEYPOINT else v for v in p] for p in points.tolist()]}
+                for points, labels in keypoints
+            ]
+        return data
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Pack json sidecars into a columnar annotation store')
+
+    parser.add_argument('--path', type=str, help='Folder with the images and json files', required=True)
+    parser.add_argument('--ext', type=str, help='Images extension', default="jpg")
+    parser.add_argument('--out', type=str, help='Output .npz store file', required=True)
+
+    args = parser.parse_args()
+
+    count = pack_sidecars(args.path, args.ext, args.out)
+    print("Packed {} frames into {}".format(count, args.out))
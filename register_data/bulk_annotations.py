@@ -0,0 +1,205 @@
+"""
+Bulk annotation ingest from numpy arrays.
+
+Detection output and columnar stores (see annotation_store.py) hold the annotations of many frames as arrays, not as
+per annotation python objects. add_annotations() takes the annotations of many frames (or FrameGroup members) as
+arrays:
+ - box2d_xywh: (N, 4) boxes, or poly2d_xy: all the polygons flattened (x0, y0, x1, y1, ...) with poly_offsets (N + 1)
+ - label_ids: ids into label_table, one per annotation, or several per annotation with label_offsets (N + 1)
+ - confidence: (N,) optional
+ - frame_offsets: (F + 1) the annotations of frame f are [frame_offsets[f], frame_offsets[f + 1])
+The validation runs once over the whole arrays, and the arrays are converted to python lists in a single call per
+array. The SDK has no batch call, so the annotations are still created with one add_annotation() per annotation, and
+registering from arrays is no faster than the scripts loop over their json rois (add_rois_to_frame in
+registration_with_roi_and_meta.py): use it for the array input and its validation, not for speed.
+
+Compare with the per annotation loop of the scripts with:
+
+python bulk_annotations.py --frames 1000 --boxes 200
+"""
+from argparse import ArgumentParser
+from time import time
+
+import numpy as np
+from allegroai import SingleFrame
+
+
+def validate_boxes(boxes):
+    """
+    :param boxes: (N, 4) array of x, y, width, height
+    :return: (N,) bool array, True for finite boxes with a positive width and height
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return np.isfinite(boxes).all(axis=1) & (boxes[:, 2] > 0) & (boxes[:, 3] > 0)
+
+
+def validate_polygons(poly2d_xy, poly_offsets):
+    """
+    :param poly2d_xy: Flattened (x0, y0, x1, y1, ...) coordinates of all the polygons
+    :param poly_offsets: (N + 1) offsets of every polygon in poly2d_xy
+    :return: (N,) bool array, True for polygons with at least 3 finite points
+    """
+    poly2d_xy = np.asarray(poly2d_xy, dtype=np.float64)
+    lengths = np.diff(poly_offsets)
+    # number of non finite coordinates per polygon
+    not_finite = np.concatenate(([0], np.cumsum(~np.isfinite(poly2d_xy))))
+    bad_values = not_finite[poly_offsets[1:]] - not_finite[poly_offsets[:-1]]
+    return (lengths >= 6) & (lengths % 2 == 0) & (bad_values == 0)
+
+
+def add_annotations(
+        frames,
+        frame_offsets,
+        label_ids,
+        label_table,
+        box2d_xywh=None,
+        poly2d_xy=None,
+        poly_offsets=None,
+        label_offsets=None,
+        confidence=None,
+        metadata=None,
+        drop_invalid=False,
+        validate=True,
+):
+    """
+    Add the annotations of many frames in one pass
+    :param frames: list of SingleFrame
+    :param frame_offsets: (F + 1) offsets of every frame annotations
+    :param label_ids: Label ids into label_table, one per annotation (or as set by label_offsets)
+    :param label_table: Sequence of label names
+    :param box2d_xywh: (N, 4) boxes (either box2d_xywh or poly2d_xy)
+    :param poly2d_xy: Flattened polygons coordinates
+    :param poly_offsets: (N + 1) offsets of every polygon in poly2d_xy
+    :param label_offsets: (N + 1) offsets of every annotation labels in label_ids, for multiple labels per annotation
+    :param confidence: (N,) confidence of every annotation
+    :param metadata: Sequence of N metadata dictionaries
+    :param drop_invalid: If True, skip the invalid annotations, otherwise raise ValueError
+    :param validate: If False, only the label ids are checked, the geometry and confidence values are passed as is
+        (like add_annotation() calls on the same data)
+    :return: number of added annotations
+    """
+    if (box2d_xywh is None) == (poly2d_xy is None):
+        raise ValueError("Exactly one of box2d_xywh and poly2d_xy is required")
+    frame_offsets = np.asarray(frame_offsets, dtype=np.int64)
+    if len(frame_offsets) != len(frames) + 1:
+        raise ValueError("Expected {} frame offsets, got {}".format(len(frames) + 1, len(frame_offsets)))
+    label_ids = np.asarray(label_ids, dtype=np.int64)
+
+    if box2d_xywh is not None:
+        box2d_xywh = np.asarray(box2d_xywh).reshape(-1, 4)
+        valid = validate_boxes(box2d_xywh) if validate else np.ones(len(box2d_xywh), dtype=bool)
+    else:
+        poly_offsets = np.asarray(poly_offsets, dtype=np.int64)
+        valid = validate_polygons(poly2d_xy, poly_offsets) if validate else np.ones(len(poly_offsets) - 1, dtype=bool)
+    count = len(valid)
+    if frame_offsets[-1] != count:
+        raise ValueError("frame_offsets cover {} annotations, got {}".format(frame_offsets[-1], count))
+
+    if label_offsets is None:
+        if len(label_ids) != count:
+            raise ValueError("Expected {} label ids, got {}".format(count, len(label_ids)))
+        valid &= (label_ids >= 0) & (label_ids < len(label_table))
+    else:
+        label_offsets = np.asarray(label_offsets, dtype=np.int64)
+        bad_label = (label_ids < 0) | (label_ids >= len(label_table))
+        bad_count = np.concatenate(([0], np.cumsum(bad_label)))
+        valid &= bad_count[label_offsets[1:]] == bad_count[label_offsets[:-1]]
+    if confidence is not None:
+        confidence = np.asarray(confidence, dtype=np.float64)
+    if confidence is not None and validate:
+        valid &= np.isfinite(confidence) & (confidence >= 0) & (confidence <= 1)
+
+    invalid = np.flatnonzero(~valid)
+    if len(invalid) and not drop_invalid:
+        raise ValueError("{} invalid annotations, first at index {}".format(len(invalid), invalid[0]))
+
+    # a single conversion to python objects per array
+    valid = valid.tolist()
+    names = [str(name) for name in label_table]
+    ids = label_ids.tolist()
+    if label_offsets is None:
+        labels = [[names[i]] if ok else None for i, ok in zip(ids, valid)]
+    else:
+        offsets = label_offsets.tolist()
+        labels = [[names[i] for i in ids[offsets[r]:offsets[r + 1]]] if valid[r] else None for r in range(count)]
+    if box2d_xywh is not None:
+        geometry_key, geometry = "box2d_xywh", box2d_xywh.tolist()
+    else:
+        values, offsets = np.asarray(poly2d_xy).tolist(), poly_offsets.tolist()
+        geometry_key, geometry = "poly2d_xy", [values[offsets[r]:offsets[r + 1]] for r in range(count)]
+    confidence = confidence.tolist() if confidence is not None else None
+
+    added = 0
+    frame_offsets = frame_offsets.tolist()
+    for f, frame in enumerate(frames):
+        for r in range(frame_offsets[f], frame_offsets[f + 1]):
+            if not valid[r]:
+                continue
+            kwargs = {geometry_key: geometry[r], "labels": labels[r]}
+            if confidence is not None:
+                kwargs["confidence"] = confidence[r]
+            if metadata is not None:
+                kwargs["metadata"] = dict(metadata[r])
+            frame.add_annotation(**kwargs)
+            added += 1
+    return added
+
+
+def add_rois_per_call(frames, frames_rois):
+    """
+    The per annotation loop of the registration scripts (see add_rois_to_frame), for comparison
+    :param frames: list of SingleFrame
+    :param frames_rois: list of the rois of every frame, as parsed from the json sidecars
+    :return: number of added annotations
+    """
+    added = 0
+    for frame, rois in zip(frames, frames_rois):
+        for roi in rois:
+            frame.add_annotation(box2d_xywh=roi["box"], labels=roi["labels"], confidence=roi["confidence"])
+            added += 1
+    return added
+
+
+def benchmark(frames_count, boxes_per_frame, seed=0):
+    """
+    Time add_annotations on arrays against the scripts per annotation loop on the same (json like) boxes
+    :return: dictionary of path name to seconds
+    """
+    rnd = np.random.RandomState(seed)
+    count = frames_count * boxes_per_frame
+    box2d_xywh = np.column_stack((rnd.uniform(0, 1000, (count, 2)), rnd.uniform(1, 200, (count, 2))))
+    label_table = np.array(["class_{}".format(i) for i in range(80)])
+    label_ids = rnd.randint(0, len(label_table), count)
+    confidence = rnd.uniform(0, 1, count)
+    frame_offsets = np.arange(frames_count + 1) * boxes_per_frame
+    # what the scripts get from the json sidecars: python lists, not arrays
+    names, boxes, scores = label_table.tolist(), box2d_xywh.tolist(), confidence.tolist()
+    frames_rois = [
+        [{"box": boxes[r], "labels": [names[label_ids[r]]], "confidence": scores[r]}
+         for r in range(frame_offsets[f], frame_offsets[f + 1])]
+        for f in range(frames_count)]
+
+    runs = (
+        ("per_call", lambda frames: add_rois_per_call(frames, frames_rois)),
+        ("bulk", lambda frames: add_annotations(
+            frames, frame_offsets, label_ids, label_table, box2d_xywh=box2d_xywh, confidence=confidence)),
+    )
+    timings = {}
+    for name, func in runs:
+        frames = [SingleFrame(source="frame_{}.jpg".format(i)) for i in range(frames_count)]
+        start = time()
+        func(frames)
+        timings[name] = time() - start
+        print("{:<10} {:>8.3f}s {:>12.0f} annotations/sec".format(name, timings[name], count / timings[name]))
+    return timings
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Compare the bulk annotation ingest with per annotation calls')
+
+    parser.add_argument('--frames', type=int, help='Number of frames', default=1000)
+    parser.add_argument('--boxes', type=int, help='Number of boxes per frame', default=200)
+
+    args = parser.parse_args()
+
+    benchmark(args.frames, args.boxes)
@@ -0,0 +1,262 @@
+"""
+Frame level delta commits.
+
+Registering a version again with its full frames list sends every frame record to the server, even when only a few
+frames changed. FingerprintIndex keeps, in a local sqlite file, a content fingerprint (source, size, preview, metadata
+and annotations) of every frame of a version. commit_delta() fingerprints the new frames list, compares it with the
+index of the target version, and sends only the added and changed frames (and deletes the removed frames), so a small
+annotation fix on a large version costs a few add_frames calls instead of a full re-registration.
+
+The index of a version is keyed by the version id. It is filled by commit_delta() itself, copied from the parent
+version when a child version is created (copy_version), or built from the server content with index_from_server()
+when the index has nothing for the version (the first run, or another machine): delta_commit_version() does all three.
+Snapshots (see dataset_snapshot.py) do not need their own index: the snapshot is locked, and the editable version
+keeps its id and content.
+
+Usage:
+    index = FingerprintIndex("fingerprints.sqlite")
+    diff = commit_delta(version, frames, index, version_key="my_dataset/my_version")
+    print(diff)
+
+or, getting (or creating) the version and its index by name:
+    diff = delta_commit_version(frames, "my_dataset", "my_version", "fingerprints.sqlite")
+"""
+import hashlib
+import json
+import sqlite3
+from collections import namedtuple
+from itertools import islice
+
+from allegroai import DatasetVersion, DataView, FrameGroup
+
+FrameDiff = namedtuple("FrameDiff", ["added", "changed", "removed", "unchanged"])
+
+# frame attributes included in the fingerprint
+FRAME_FIELDS = ("source", "width", "height", "preview_source", "mask_source")
+
+
+def _annotation_data(annotation):
+    to_dict = getattr(annotation, "to_dict", None)
+    if callable(to_dict):
+        return to_dict()
+    return {k: v for k, v in vars(annotation).items() if not k.startswith("_")}
+
+
+def _frame_data(frame):
+    if isinstance(frame, FrameGroup):
+        return {
+            "metadata": frame.metadata,
+            "frames": {name: _frame_data(single_frame) for name, single_frame in sorted(frame.items())},
+            "global_annotations": [_annotation_data(a) for a in getattr(frame, "global_annotations", None) or []],
+        }
+    data = {field: getattr(frame, field, None) for field in FRAME_FIELDS}
+    data["metadata"] = frame.metadata
+    data["annotations"] = [_annotation_data(a) for a in frame.annotations or []]
+    return data
+
+
+def frame_fingerprint(frame):
+    """
+    :param frame: SingleFrame or FrameGroup
+    :return: sha1 hex digest of the frame content (source, metadata, annotations)
+    """
+    data = json.dumps(_frame_data(frame), sort_keys=True, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class FingerprintIndex(object):
+    def __init__(self, db_path):
+        """
+        :param db_path: Path to the sqlite index file (created if missing)
+        :type db_path: str
+        """
+        self._db = sqlite3.connect(db_path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints "
+            "(version TEXT, frame_id TEXT, fingerprint TEXT, PRIMARY KEY (version, frame_id))")
+
+    def lookup(self, version_key, frame_ids):
+        """
+        :param version_key: The version key
+        :param frame_ids: list of frame ids
+        :return: dictionary of frame id to fingerprint, for the frames in the index
+        """
+        found = {}
+        for start in range(0, len(frame_ids), 500):
+            chunk = frame_ids[start:start + 500]
+            found.update(self._db.execute(
+                "SELECT frame_id, fingerprint FROM fingerprints WHERE version=? AND frame_id IN ({})".format(
+                    ",".join("?" * len(chunk))),
+                [version_key] + chunk))
+        return found
+
+    def update(self, version_key, fingerprints):
+        """
+        :param version_key: The version key
+        :param fingerprints: list of (frame id, fingerprint)
+        """
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO fingerprints (version, frame_id, fingerprint) VALUES (?, ?, ?)",
+                [(version_key, frame_id, fingerprint) for frame_id, fingerprint in fingerprints])
+
+    def remove(self, version_key, frame_ids):
+        with self._db:
+            self._db.executemany(
+                "DELETE FROM fingerprints WHERE version=? AND frame_id=?",
+                [(version_key, frame_id) for frame_id in frame_ids])
+
+    def missing(self, version_key, seen_ids):
+        """
+        :param version_key: The version key
+        :param seen_ids: iterable of frame ids
+        :return: list of the frame ids of the version that are not in seen_ids
+        """
+        self._db.execute("CREATE TEMP TABLE IF NOT EXISTS seen (frame_id TEXT PRIMARY KEY)")
+        self._db.execute("DELETE FROM seen")
+        self._db.executemany("INSERT OR IGNORE INTO seen (frame_id) VALUES (?)", ((i,) for i in seen_ids))
+        missing = [row[0] for row in self._db.execute(
+            "SELECT frame_id FROM fingerprints WHERE version=? AND frame_id NOT IN (SELECT frame_id FROM seen)",
+            (version_key,))]
+        self._db.execute("DELETE FROM seen")
+        return missing
+
+    def count(self, version_key):
+        """
+        :param version_key: The version key
+        :return: number of indexed frames of the version
+        """
+        return self._db.execute("SELECT COUNT(*) FROM fingerprints WHERE version=?", (version_key,)).fetchone()[0]
+
+    def copy_version(self, parent_key, child_key):
+        """
+        Start the index of a child version (or a snapshot) from its parent
+        """
+        with self._db:
+            self._db.execute("DELETE FROM fingerprints WHERE version=?", (child_key,))
+            self._db.execute(
+                "INSERT INTO fingerprints (version, frame_id, fingerprint) "
+                "SELECT ?, frame_id, fingerprint FROM fingerprints WHERE version=?", (child_key, parent_key))
+
+    def close(self):
+        self._db.close()
+
+
+def _chunks(iterable, chunk_size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunk_size))
+
+
+def index_from_server(index, version_key, dataset_name, version_name):
+    """
+    Fill the index of a version from the frames registered on the server
+    :return: number of indexed frames
+    """
+    dataview = DataView(name="fingerprint index")
+    dataview.add_query(dataset_name=dataset_name, version_name=version_name)
+    count = 0
+    for chunk in _chunks(dataview.get_iterator(), 1000):
+        index.update(version_key, [(frame.id, frame_fingerprint(frame)) for frame in chunk])
+        count += len(chunk)
+    return count
+
+
+def commit_delta(version, frames, index, version_key, full=True, chunk_size=1000, commit=True):
+    """
+    Send only the added, changed and removed frames to a version
+    :param version: The target DatasetVersion
+    :param frames: iterable of the frames of the version
+    :param index: FingerprintIndex
+    :param version_key: The version key in the index (e.g. "dataset/version")
+    :param full: If True, frames is the full version content, and the indexed frames not in it are deleted,
+        otherwise frames is a partial update and nothing is deleted
+    :param chunk_size: Number of frames compared (and sent) together
+    :param commit: If True, commit the version when something changed
+    :return: FrameDiff with the number of added, changed, removed and unchanged frames
+    """
+    added = changed = unchanged = 0
+    seen, updates = [], []
+    for chunk in _chunks(frames, chunk_size):
+        fingerprints = [(frame.id, frame_fingerprint(frame)) for frame in chunk]
+        known = index.lookup(version_key, [frame_id for frame_id, _ in fingerprints])
+        send, send_fingerprints = [], []
+        for frame, (frame_id, fingerprint) in zip(chunk, fingerprints):
+            previous = known.get(frame_id)
+            if previous == fingerprint:
+                unchanged += 1
+                continue
+            if previous is None:
+                added += 1
+            else:
+                changed += 1
+            send.append(frame)
+            send_fingerprints.append((frame_id, fingerprint))
+        if send:
+            version.add_frames(send)
+            updates.extend(send_fingerprints)
+        if full:
+            seen.extend(frame_id for frame_id, _ in fingerprints)
+
+    removed = index.missing(version_key, seen) if full else []
+    for removed_chunk in _chunks(removed, chunk_size):
+        version.delete_frames(removed_chunk)
+
+    diff = FrameDiff(added, changed, len(removed), unchanged)
+    print("Delta commit of {}: {} added, {} changed, {} removed, {} unchanged".format(version_key, *diff))
+    if commit and (added or changed or removed):
+        version.commit_version()
+    # the index is updated only once the frames were sent (and committed)
+    index.update(version_key, updates)
+    index.remove(version_key, removed)
+    return diff
+
+
+def _get_version(dataset_name, version_name):
+    """
+    :return: The version, or None if the dataset has no version with this name
+    """
+    try:
+        return DatasetVersion.get_version(dataset_name=dataset_name, version_name=version_name)
+    except ValueError:
+        # the SDK raises ValueError when no version matches, any other error (e.g. the server is not reachable)
+        # must not end up creating the version
+        return None
+
+
+def _version_key(dataset_name, version):
+    return "{}/{}".format(dataset_name, getattr(version, "version_id", None) or version.id)
+
+
+def delta_commit_version(frames, dataset_name, version_name, index_path, chunk_size=1000):
+    """
+    Send only the frames that changed since the last registration of the version.
+    A missing version is created as a child of the current version, and its index starts from the index of the
+    current version. If the index has nothing for the version, it is built from the server content first.
+    :param frames: iterable of all the frames of the version
+    :param dataset_name: Dataset name
+    :param version_name: Version name (default is current version)
+    :param index_path: Local fingerprint index file (see FingerprintIndex)
+    :param chunk_size: Number of frames compared and sent together
+    :return: FrameDiff
+    """
+    dataset = DatasetVersion.create_new_dataset(dataset_name=dataset_name)
+    index = FingerprintIndex(index_path)
+    try:
+        if version_name:
+            version = _get_version(dataset_name, version_name)
+        else:
+            version = DatasetVersion.get_current(dataset_name=dataset_name)
+        if version is None:
+            parent = DatasetVersion.get_current(dataset_name=dataset_name)
+            version = dataset.create_version(version_name=version_name)
+            index.copy_version(_version_key(dataset_name, parent), _version_key(dataset_name, version))
+        version_key = _version_key(dataset_name, version)
+        if not index.count(version_key):
+            count = index_from_server(index, version_key, dataset_name, version.version_name)
+            print("Indexed {} frames of {} from the server".format(count, version_key))
+        return commit_delta(version, frames, index, version_key, chunk_size=chunk_size)
+    finally:
+        index.close()
@@ -0,0 +1,116 @@
+"""
+Local manifest of registered files, for incremental re-registration.
+
+The manifest is a small sqlite file holding, for every registered file, its size, modification time, content hash and
+the registered frame id. When scanning a folder, only files with a different size or modification time are hashed,
+and only files with a new content hash are reported as changed, so a re-sync takes time in proportion to the change
+and not to the dataset size. A manifest can be shared by several folders and extensions, a scan only reports as deleted
+the files under the scanned folder with the scanned extension.
+
+Usage:
+    manifest = FileManifest("manifest.sqlite")
+    changed, deleted = manifest.scan("./toy_img/", "jpg")
+    ... register the changed files ...
+    manifest.record(changed_entry, frame_id)
+    manifest.forget(deleted)
+"""
+import hashlib
+import os
+import sqlite3
+from collections import namedtuple
+from fnmatch import fnmatchcase
+
+from pathlib2 import Path
+
+FileEntry = namedtuple("FileEntry", ["path", "size", "mtime", "hash"])
+
+
+def file_hash(path, block_size=1024 * 1024):
+    """
+    :param path: File path
+    :return: sha256 hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FileManifest(object):
+    def __init__(self, db_path):
+        """
+        :param db_path: Path to the sqlite manifest file (created if missing)
+        :type db_path: str
+        """
+        self._db = sqlite3.connect(db_path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files "
+            "(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT, frame_id TEXT)")
+
+    def scan(self, base_folder, ext):
+        """
+        Compare a folder with the manifest
+        :param base_folder: Folder to scan recursively
+        :param ext: Files extension
+        :return: tuple of (list of FileEntry for new or modified files, list of paths deleted from the folder)
+            (only the manifest files under base_folder with the extension can be reported as deleted, the manifest
+            can be shared by several folders and extensions)
+        """
+        pattern = '*.{}'.format(ext)
+        root = Path(base_folder).absolute().as_posix().rstrip("/") + "/"
+        known = {row[0]: row[1:] for row in self._db.execute(
+            "SELECT path, size, mtime, hash FROM files WHERE substr(path, 1, ?)=?", (len(root), root))
+            if fnmatchcase(os.path.basename(row[0]), pattern)}
+        changed = []
+        touched = []
+        for file in Path(base_folder).rglob(pattern):
+            path = file.absolute().as_posix()
+            stat = os.stat(path)
+            previous = known.pop(path, None)
+            if previous and previous[0] == stat.st_size and previous[1] == stat.st_mtime:
+                continue
+            entry = FileEntry(path, stat.st_size, stat.st_mtime, file_hash(path))
+            if previous and previous[2] == entry.hash:
+                # only the modification time changed, no need to register again
+                touched.append(entry)
+                continue
+            changed.append(entry)
+        with self._db:
+            self._db.executemany(
+                "UPDATE files SET mtime=? WHERE path=?", [(entry.mtime, entry.path) for entry in touched])
+        return changed, sorted(known.keys())
+
+    def record(self, entries, frame_ids):
+        """
+        Store registered files
+        :param entries: list of FileEntry
+        :param frame_ids: list of the registered frame ids, matching entries
+        """
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime, hash, frame_id) VALUES (?, ?, ?, ?, ?)",
+                [(e.path, e.size, e.mtime, e.hash, frame_id) for e, frame_id in zip(entries, frame_ids)])
+
+    def frame_ids(self, paths):
+        """
+        :param paths: list of file paths
+        :return: dictionary of path to registered frame id
+        """
+        ids = {}
+        for path in paths:
+            row = self._db.execute("SELECT frame_id FROM files WHERE path=?", (path,)).fetchone()
+            if row:
+                ids[path] = row[0]
+        return ids
+
+    def forget(self, paths):
+        """
+        Remove files from the manifest
+        :param paths: list of file paths
+        """
+        with self._db:
+            self._db.executemany("DELETE FROM files WHERE path=?", [(path,) for path in paths])
+
+    def close(self):
+        self._db.close()
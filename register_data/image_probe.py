@@ -0,0 +1,280 @@
+"""
+Header-only image dimension probing.
+
+Frames registered without width and height make every later consumer decode the full image just to learn its size.
+probe_frames() reads only the first few KB of every frame source (a ranged GET for s3:// and http(s):// sources),
+parses the JPEG (SOF marker and EXIF orientation) or PNG (IHDR chunk) header, and sets the frame width and height,
+optionally with the image format and EXIF orientation in the frame metadata. The sources are probed in parallel
+threads, and the results are kept in a local sqlite cache keyed by the file content hash when it is known (e.g. from
+the file manifest, see file_manifest.py), or by the file path, size and modification time otherwise.
+
+Compare with a full PIL decode with:
+
+python image_probe.py --path toy_img --ext jpg
+"""
+import io
+import os
+import sqlite3
+import struct
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from time import time
+
+from PIL import Image
+
+HEAD_SIZE = 4 * 1024
+MAX_HEAD_SIZE = 1024 * 1024
+# JPEG start of frame markers (baseline, progressive, lossless, arithmetic...)
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+class NeedMoreData(Exception):
+    pass
+
+
+def _exif_orientation(exif):
+    """
+    :param exif: The APP1 segment payload, starting with the TIFF header
+    :return: the EXIF orientation (1-8), or None
+    """
+    if len(exif) < 8 or exif[:2] not in (b"II", b"MM"):
+        return None
+    order = "<" if exif[:2] == b"II" else ">"
+    ifd_offset = struct.unpack(order + "I", exif[4:8])[0]
+    if ifd_offset + 2 > len(exif):
+        return None
+    count = struct.unpack(order + "H", exif[ifd_offset:ifd_offset + 2])[0]
+    for i in range(count):
+        entry = ifd_offset + 2 + i * 12
+        if entry + 12 > len(exif):
+            break
+        tag, _, _ = struct.unpack(order + "HHI", exif[entry:entry + 8])
+        if tag == EXIF_ORIENTATION_TAG:
+            return struct.unpack(order + "H", exif[entry + 8:entry + 10])[0]
+    return None
+
+
+def _parse_jpeg(data):
+    orientation = None
+    pos = 2
+    while True:
+        if pos + 4 > len(data):
+            raise NeedMoreData()
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            # markers without a segment
+            pos += 2
+            continue
+        if marker in (0xD9, 0xDA):
+            # end of image or start of scan before any frame header
+            return None
+        length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        if marker in SOF_MARKERS:
+            if pos + 9 > len(data):
+                raise NeedMoreData()
+            height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+            return "JPEG", width, height, orientation
+        if marker == 0xE1 and orientation is None:
+            if pos + 2 + length > len(data):
+                raise NeedMoreData()
+            segment = data[pos + 4:pos + 2 + length]
+            if segment[:6] == b"Exif\x00\x00":
+                orientation = _exif_orientation(segment[6:])
+        pos += 2 + length
+
+
+def parse_image_header(data):
+    """
+    Parse the dimensions from the first bytes of an image
+    :param data: The first bytes of the image file
+    :type data: bytes
+    :return: tuple of (format, width, height, EXIF orientation or None), or None if the format is not supported
+    :raises NeedMoreData: If the header does not fit in data
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        if len(data) < 24:
+            raise NeedMoreData()
+        width, height = struct.unpack(">II", data[16:24])
+        return "PNG", width, height, None
+    if data[:2] == b"\xff\xd8":
+        return _parse_jpeg(data)
+    return None
+
+
+def read_head(source, size):
+    """
+    Read the first bytes of a frame source
+    :param source: Local path, file://, s3:// or http(s):// URI
+    :param size: Number of bytes to read
+    :return: bytes (shorter than size at the end of the file)
+    """
+    if source.startswith("s3://"):
+        import boto3
+        bucket, _, key = source[len("s3://"):].partition("/")
+        response = _s3_client(boto3).get_object(Bucket=bucket, Key=key, Range="bytes=0-{}".format(size - 1))
+        return response["Body"].read()
+    if source.startswith("http://") or source.startswith("https://"):
+        from urllib.request import Request, urlopen
+        # servers ignoring the Range header send the whole file, read only what we need
+        with urlopen(Request(source, headers={"Range": "bytes=0-{}".format(size - 1)})) as response:
+            return response.read(size)
+    if "://" in source and not source.startswith("file://"):
+        # other storage types: download (cached) with the StorageManager
+        from clearml import StorageManager
+        source = StorageManager.get_local_copy(source)
+    path = source[len("file://"):] if source.startswith("file://") else source
+    with open(path, "rb") as f:
+        return f.read(size)
+
+
+_s3 = threading.local()
+
+
+def _s3_client(boto3):
+    if not hasattr(_s3, "client"):
+        _s3.client = boto3.client("s3")
+    return _s3.client
+
+
+def probe_source(source):
+    """
+    Probe the dimensions of an image, reading only its header
+    :param source: Local path or URI of the image
+    :return: tuple of (format, width, height, EXIF orientation or None), or None if unknown
+    """
+    size = HEAD_SIZE
+    while True:
+        data = read_head(source, size)
+        try:
+            info = parse_image_header(data)
+        except NeedMoreData:
+            # e.g. a large EXIF thumbnail before the frame header
+            if len(data) < size or size >= MAX_HEAD_SIZE:
+                return None
+            size *= 4
+            continue
+        if info is not None:
+            return info
+        # other formats, PIL only parses the header when opening
+        try:
+            img = Image.open(io.BytesIO(data))
+            return img.format, img.size[0], img.size[1], None
+        except Exception:
+            return None
+
+
+class ProbeCache(object):
+    def __init__(self, db_path):
+        """
+        :param db_path: Path to the sqlite cache file (created if missing)
+        :type db_path: str
+        """
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS probes "
+            "(key TEXT PRIMARY KEY, format TEXT, width INTEGER, height INTEGER, orientation INTEGER)")
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT format, width, height, orientation FROM probes WHERE key=?", (key,)).fetchone()
+        return tuple(row) if row else None
+
+    def put(self, key, info):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO probes (key, format, width, height, orientation) VALUES (?, ?, ?, ?, ?)",
+                (key,) + tuple(info))
+
+    def close(self):
+        self._db.close()
+
+
+def cache_key(source, content_hash=None):
+    """
+    :return: the content hash if known, otherwise the path, size and modification time of local files, and the URI
+        of remote files (uploaded objects are not modified in place)
+    """
+    if content_hash:
+        return content_hash
+    path = source[len("file://"):] if source.startswith("file://") else source
+    if "://" not in path:
+        stat = os.stat(path)
+        return "{}:{}:{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    return source
+
+
+def probe_frames(frames, workers=16, cache=None, content_hashes=None, add_meta=False):
+    """
+    Set the width and height of frames from their image headers
+    :param frames: list of SingleFrame
+    :param workers: Number of probing threads
+    :param cache: Optional ProbeCache
+    :param content_hashes: Optional dictionary of frame source to its content hash, used as the cache key
+    :param add_meta: If True, also store the image format and EXIF orientation in the frame metadata
+    :return: number of probed frames
+    """
+    content_hashes = content_hashes or {}
+
+    def probe(frame):
+        source = str(frame.source)
+        key = cache_key(source, content_hashes.get(source)) if cache else None
+        info = cache.get(key) if cache else None
+        if info is None:
+            info = probe_source(source)
+            if info is None:
+                print("Could not probe {}".format(source))
+                return False
+            if cache:
+                cache.put(key, info)
+        image_format, frame.width, frame.height, orientation = info
+        if add_meta:
+            frame.metadata["format"] = image_format
+            if orientation:
+                frame.metadata["exif_orientation"] = orientation
+        return True
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(probe, frames))
+
+
+def benchmark(files):
+    """
+    Time the header probing against a full PIL decode
+    :return: dictionary of method name to seconds
+    """
+    start = time()
+    probed = [probe_source(f) for f in files]
+    probe_seconds = time() - start
+    start = time()
+    decoded = []
+    for f in files:
+        img = Image.open(f)
+        img.load()
+        decoded.append(img.size)
+    decode_seconds = time() - start
+    mismatches = sum(1 for p, d in zip(probed, decoded) if p is None or tuple(p[1:3]) != d)
+    print("probe:  {:.3f}s, full decode: {:.3f}s ({:.1f}x), {} mismatches in {} files".format(
+        probe_seconds, decode_seconds, decode_seconds / probe_seconds if probe_seconds else 0, mismatches, len(files)))
+    return {"probe": probe_seconds, "decode": decode_seconds}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Compare header-only probing with a full image decode')
+
+    parser.add_argument('--path', type=str, help='Folder with images (searched recursively)', required=True)
+    parser.add_argument('--ext', type=str, help='Files extension', default="jpg")
+
+    args = parser.parse_args()
+
+    benchmark(sorted(glob(os.path.join(args.path, "**", "*.{}".format(args.ext)), recursive=True)))
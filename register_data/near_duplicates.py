@@ -0,0 +1,255 @@
+"""
+Near-duplicate image detection at registration time.
+
+The content hash of the upload path (and of the file manifest) only catches byte-identical files, so re-encoded,
+resized or slightly cropped copies of the same image are still uploaded, stored and trained on every epoch.
+mark_near_duplicates() computes a 64 bit perceptual hash of every frame source on a pool of processes (the JPEGs are
+decoded at a reduced scale, see PIL Image.draft, and the DCT is two small matrix products), and looks every hash up
+in a BK-tree of the already seen hashes, so finding the hashes within the Hamming distance threshold does not compare
+against all of them. The frames matching an earlier image are tagged in their metadata (near_duplicate_of, with the
+distance), or skipped.
+
+The hashes can be kept in a local sqlite file (PerceptualIndex(db_path)), so the frames registered in later runs are
+also compared against the images of the previous registrations.
+
+Compare the BK-tree lookups with a linear scan with:
+
+python near_duplicates.py --path toy_img --ext jpg --threshold 10
+"""
+import os
+import sqlite3
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from time import time
+
+import numpy as np
+from PIL import Image
+
+from preview_generator import local_path
+
+DCT_SIZE = 32
+HASH_SIZE = 8
+
+
+def _dct_matrix(size):
+    k = np.arange(size)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2. * size)) * np.sqrt(2. / size)
+    matrix[0] /= np.sqrt(2.)
+    return matrix
+
+
+DCT_MATRIX = _dct_matrix(DCT_SIZE)
+
+
+def _bits_to_int(bits):
+    return int("".join("1" if b else "0" for b in bits.ravel().tolist()), 2)
+
+
+def _gray(source, size):
+    img = Image.open(local_path(source))
+    # decode JPEGs at the smallest scale still larger than the hash input
+    img.draft("L", (size, size))
+    return np.asarray(img.convert("L").resize((size, size), Image.BILINEAR), dtype=np.float64)
+
+
+def dct_hash(source):
+    """
+    :param source: Frame source, local path or URI
+    :return: 64 bit perceptual hash (the low frequencies of the DCT compared to their median)
+    """
+    pixels = _gray(source, DCT_SIZE)
+    low = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:HASH_SIZE, :HASH_SIZE]
+    # the DC coefficient is only the mean brightness
+    return _bits_to_int(low > np.median(low.ravel()[1:]))
+
+
+def average_hash(source):
+    """
+    :param source: Frame source, local path or URI
+    :return: 64 bit average hash (the 8x8 thumbnail pixels compared to their mean)
+    """
+    pixels = _gray(source, HASH_SIZE)
+    return _bits_to_int(pixels > pixels.mean())
+
+
+HASH_FUNCTIONS = {"dct": dct_hash, "average": average_hash}
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree(object):
+    """
+    Burkhard-Keller tree of hashes, for the Hamming distance
+    """
+
+    def __init__(self):
+        # node: [hash, item, {distance: child node}]
+        self._root = None
+        self._size = 0
+
+    def add(self, hash_value, item):
+        node = [hash_value, item, {}]
+        self._size += 1
+        if self._root is None:
+            self._root = node
+            return
+        parent = self._root
+        while True:
+            distance = hamming(hash_value, parent[0])
+            child = parent[2].get(distance)
+            if child is None:
+                parent[2][distance] = node
+                return
+            parent = child
+
+    def search(self, hash_value, radius):
+        """
+        :return: list of (distance, hash, item) within the radius, the closest first
+        """
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(hash_value, node[0])
+            if distance <= radius:
+                found.append((distance, node[0], node[1]))
+            # the triangle inequality: only the children in [distance - radius, distance + radius] can match
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return sorted(found, key=lambda match: match[0])
+
+    def __len__(self):
+        return self._size
+
+
+class PerceptualIndex(object):
+    def __init__(self, db_path=None):
+        """
+        :param db_path: Optional sqlite file keeping the hashes between runs (created if missing)
+        :type db_path: str
+        """
+        self.tree = BKTree()
+        self._db = None
+        self._pending = []
+        if db_path:
+            self._db = sqlite3.connect(db_path)
+            self._db.execute("CREATE TABLE IF NOT EXISTS hashes (hash TEXT, source TEXT PRIMARY KEY)")
+            for hash_hex, source in self._db.execute("SELECT hash, source FROM hashes"):
+                self.tree.add(int(hash_hex, 16), source)
+
+    def search(self, hash_value, radius):
+        return self.tree.search(hash_value, radius)
+
+    def add(self, hash_value, source):
+        """
+        Add an image, searchable at once, and stored in the sqlite file on the next flush()
+        """
+        self.tree.add(hash_value, source)
+        self._pending.append(("{:016x}".format(hash_value), source))
+
+    def flush(self):
+        if self._db is not None and self._pending:
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO hashes (hash, source) VALUES (?, ?)", self._pending)
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+
+
+def hash_sources(sources, method="dct", workers=None):
+    """
+    :param sources: list of frame sources
+    :param method: "dct" or "average"
+    :param workers: Number of hashing processes (default: number of cores)
+    :return: list of hashes (None for the sources that could not be decoded)
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_safe_hash, sources, [method] * len(sources), chunksize=16))
+
+
+def _safe_hash(source, method):
+    try:
+        return HASH_FUNCTIONS[method](source)
+    except Exception as ex:
+        print("Could not hash {}: {}".format(source, ex))
+        return None
+
+
+def mark_near_duplicates(frames, threshold=6, skip=False, index=None, method="dct", workers=None):
+    """
+    Tag (or skip) the frames whose image is a near-duplicate of an earlier frame (or of an indexed image)
+    :param frames: list of SingleFrame
+    :param threshold: Maximum Hamming distance (out of 64 bits) between near-duplicate hashes
+    :param skip: If True, drop the near-duplicates, otherwise set their metadata near_duplicate_of and
+        near_duplicate_distance
+    :param index: PerceptualIndex of the already registered images (default: only compare the frames together)
+    :param method: Perceptual hash, "dct" or "average"
+    :param workers: Number of hashing processes
+    :return: tuple of (list of the kept frames, number of near-duplicates)
+    """
+    index = index or PerceptualIndex()
+    sources = [str(frame.source) for frame in frames]
+    hashes = hash_sources(sources, method, workers)
+    kept, duplicates = [], 0
+    for frame, source, hash_value in zip(frames, sources, hashes):
+        if hash_value is None:
+            kept.append(frame)
+            continue
+        frame.metadata["phash"] = "{:016x}".format(hash_value)
+        matches = [match for match in index.search(hash_value, threshold) if match[2] != source]
+        if matches:
+            duplicates += 1
+            if skip:
+                continue
+            distance, _, original = matches[0]
+            frame.metadata["near_duplicate_of"] = original
+            frame.metadata["near_duplicate_distance"] = distance
+        else:
+            # only the first image of every near-duplicates group is indexed
+            index.add(hash_value, source)
+        kept.append(frame)
+    index.flush()
+    print("{} near-duplicates in {} frames ({})".format(duplicates, len(frames), "skipped" if skip else "tagged"))
+    return kept, duplicates
+
+
+def benchmark(files, threshold, method="dct"):
+    """
+    Time the BK-tree lookups against a linear scan of all the hashes
+    :return: dictionary of method name to seconds
+    """
+    hashes = [h for h in hash_sources(files, method) if h is not None]
+    tree = BKTree()
+    for i, hash_value in enumerate(hashes):
+        tree.add(hash_value, i)
+    start = time()
+    tree_matches = sum(len(tree.search(h, threshold)) for h in hashes)
+    tree_seconds = time() - start
+    start = time()
+    linear_matches = sum(1 for h in hashes for other in hashes if hamming(h, other) <= threshold)
+    linear_seconds = time() - start
+    print("bk-tree: {:.3f}s, linear scan: {:.3f}s, {} pairs within {} bits in {} images ({} identical results)".format(
+        tree_seconds, linear_seconds, tree_matches - len(hashes), threshold, len(hashes),
+        tree_matches == linear_matches))
+    return {"bk_tree": tree_seconds, "linear": linear_seconds}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Compare BK-tree near-duplicate lookups with a linear scan')
+
+    parser.add_argument('--path', type=str, help='Folder with images (searched recursively)', required=True)
+    parser.add_argument('--ext', type=str, help='Files extension', default="jpg")
+    parser.add_argument('--threshold', type=int, help='Maximum Hamming distance of near-duplicates', default=6)
+    parser.add_argument('--method', type=str, help='Perceptual hash (dct or average)', default="dct")
+
+    args = parser.parse_args()
+
+    benchmark(sorted(glob(os.path.join(args.path, "**", "*.{}".format(args.ext)), recursive=True)),
+              args.threshold, args.method)
@@ -0,0 +1,140 @@
+"""
+Parallel preview (thumbnail) generation with a content-addressed cache.
+
+Frames without a preview_source make the web UI (and any browsing tool) fetch the full resolution originals.
+PreviewGenerator renders a small WebP (or JPEG) preview of every frame source on a pool of processes, decoding JPEGs
+directly at a reduced scale (see PIL Image.draft), and stores it in a local folder or a bucket under the content hash
+of the source file and the render parameters (<hash[:2]>/<hash>_<max_size>_q<quality>.webp). Identical images, even
+registered in different datasets, are rendered and stored once, and previews already in the cache (with the same size
+and quality) are never rendered again. Once stored, the frame preview_source is set
+to the preview URI.
+
+Usage:
+    generator = PreviewGenerator("s3://bucket/previews/", max_size=256, workers=8)
+    generator.generate(frames)
+    print(generator.stats)
+    generator.close()
+"""
+import io
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import time
+
+from PIL import Image
+
+from file_manifest import file_hash
+from upload_engine import get_target
+
+FORMATS = {"webp": "WEBP", "jpg": "JPEG"}
+
+
+def local_path(source):
+    """
+    :param source: Frame source, local path or URI
+    :return: a local path of the source (remote sources are downloaded, cached, with the StorageManager)
+    """
+    if source.startswith("file://"):
+        return source[len("file://"):]
+    if "://" in source:
+        from clearml import StorageManager
+        return StorageManager.get_local_copy(source)
+    return source
+
+
+def source_hash(source):
+    return file_hash(local_path(source))
+
+
+def render_preview(source, max_size=256, fmt="webp", quality=80):
+    """
+    Render a preview of an image
+    :param source: Frame source, local path or URI
+    :param max_size: Maximum width and height of the preview
+    :param fmt: Preview format, "webp" or "jpg"
+    :param quality: Encoding quality
+    :return: the encoded preview bytes
+    """
+    img = Image.open(local_path(source))
+    # decode JPEGs at the smallest scale still larger than the preview, no-op for other formats
+    img.draft("RGB", (max_size, max_size))
+    img = img.convert("RGB")
+    img.thumbnail((max_size, max_size), Image.BILINEAR)
+    out = io.BytesIO()
+    img.save(out, FORMATS[fmt], quality=quality)
+    return out.getvalue()
+
+
+class PreviewGenerator(object):
+    def __init__(self, destination, max_size=256, fmt="webp", quality=80, workers=None, endpoint_url=None):
+        """
+        :param destination: Previews cache, s3://bucket/folder/ or a local folder
+        :type destination: str
+        :param max_size: Maximum width and height of the previews
+        :type max_size: int
+        :param fmt: Previews format, "webp" or "jpg"
+        :type fmt: str
+        :param quality: Previews encoding quality
+        :type quality: int
+        :param workers: Number of rendering processes (default: number of cores)
+        :type workers: int
+        :param endpoint_url: S3 compatible server url
+        :type endpoint_url: str
+        """
+        if fmt not in FORMATS:
+            raise ValueError("Unsupported preview format {}, use one of {}".format(fmt, list(FORMATS)))
+        self._target = get_target(destination, endpoint_url)
+        self._max_size = max_size
+        self._fmt = fmt
+        self._quality = quality
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        self._stats_lock = threading.Lock()
+        self.stats = {"frames": 0, "unique": 0, "rendered": 0, "cached": 0, "seconds": 0.0, "frames_per_sec": 0.0}
+
+    def _key(self, content_hash):
+        # previews of another size or quality are other files, never returned from the cache
+        return "{}/{}_{}_q{}.{}".format(content_hash[:2], content_hash, self._max_size, self._quality, self._fmt)
+
+    def generate(self, frames, content_hashes=None):
+        """
+        Render the missing previews and set the frames preview_source
+        :param frames: list of SingleFrame
+        :param content_hashes: Optional dictionary of frame source to its content hash (sha256, e.g. from the
+            file manifest), the other sources are hashed by the pool
+        :return: the frames
+        """
+        start = time()
+        content_hashes = dict(content_hashes or {})
+        sources = sorted(set(str(frame.source) for frame in frames))
+        missing = [source for source in sources if source not in content_hashes]
+        content_hashes.update(zip(missing, self._pool.map(source_hash, missing, chunksize=16)))
+
+        # one source per content hash
+        unique = {}
+        for source in sources:
+            unique.setdefault(content_hashes[source], source)
+        with ThreadPoolExecutor(max_workers=16) as threads:
+            cached = dict(zip(unique, threads.map(lambda h: self._target.exists(self._key(h)), unique)))
+            to_render = [h for h in unique if not cached[h]]
+            previews = self._pool.map(
+                render_preview, [unique[h] for h in to_render], [self._max_size] * len(to_render),
+                [self._fmt] * len(to_render), [self._quality] * len(to_render), chunksize=4)
+            # store the previews while the next ones are rendered
+            list(threads.map(lambda item: self._target.put_bytes(self._key(item[0]), item[1]),
+                             zip(to_render, previews)))
+
+        for frame in frames:
+            frame.preview_source = self._target.uri(self._key(content_hashes[str(frame.source)]))
+
+        with self._stats_lock:
+            self.stats["frames"] += len(frames)
+            self.stats["unique"] += len(unique)
+            self.stats["rendered"] += len(to_render)
+            self.stats["cached"] += len(unique) - len(to_render)
+            self.stats["seconds"] += time() - start
+            self.stats["frames_per_sec"] = self.stats["frames"] / max(self.stats["seconds"], 1e-6)
+        print("Previews: {frames} frames, {unique} unique images, {rendered} rendered, {cached} already cached, "
+              "{frames_per_sec:.1f} frames/sec".format(**self.stats))
+        return frames
+
+    def close(self):
+        self._pool.shutdown()
@@ -13,12 +13,38 @@ You can run this example from this dir with:
 python register_dataset_with_upload.py
 --path ./toy_img/ --ext jpg --ds_name my_uploaded_dataset --version_name my_version
 --bucket s3://bucket/folder/
+
+To re-sync a folder, add `--manifest manifest.sqlite`: a local manifest of the registered files is kept (see
+file_manifest.py), and only new or modified files are registered on the next runs. Deleted files are reported.
+
+To control the upload, add `--upload_workers N`: the files are uploaded before add_frames by N threads, large files
+in parts of `--part_size_mb`, and the progress is written to `--upload_journal`, so an interrupted upload resumes
+where it stopped when running again. The files are stored by content hash in the bucket, so as with the auto upload,
+identical files are uploaded once (see upload_engine.py).
+
+To set the frames width and height, add `--probe_workers N`: the image headers are parsed by N threads, without
+decoding the images, and the results are cached in `--probe_cache` (see image_probe.py).
+
+To set the frames previews, add `--preview_dest s3://bucket/previews/` (or a local folder): small previews are
+rendered by a pool of processes and stored by content hash, so identical images are rendered once (see
+preview_generator.py).
+
+To find near-duplicate images (resized, re-encoded or slightly cropped copies), add `--near_dup_threshold 6`: a
+perceptual hash of every image is computed by a pool of processes and compared (with a BK-tree) to the other images
+and to the images of the previous runs kept in `--near_dup_index`. The near-duplicates are tagged in their metadata
+(near_duplicate_of), or not registered at all with `--near_dup_skip` (see near_duplicates.py).
 """
 from argparse import ArgumentParser
 
 from allegroai import DatasetVersion, SingleFrame
 from pathlib2 import Path
 
+from file_manifest import FileManifest
+from image_probe import ProbeCache, probe_frames
+from near_duplicates import PerceptualIndex, mark_near_duplicates
+from preview_generator import PreviewGenerator
+from upload_engine import FrameUploader
+
 
 def get_frames(base_folder, ext):
     # Generate single frames
@@ -30,6 +56,23 @@ def get_frames(base_folder, ext):
     return ret_frames
 
 
+def get_changed_frames(base_folder, ext, manifest):
+    """
+    Generate single frames only for the files that are new or modified since the last registration
+    :param base_folder: Folder to register
+    :param ext: Files extension
+    :param manifest: FileManifest of the previous registrations
+    :return: tuple of (list of frames, list of matching FileEntry, list of deleted paths)
+    """
+    changed, deleted = manifest.scan(base_folder, ext)
+    ret_frames = [SingleFrame(source=entry.path, metadata={"meta": "data"}) for entry in changed]
+    print('{} new or modified files, {} deleted files'.format(len(changed), len(deleted)))
+    if deleted:
+        for path, frame_id in manifest.frame_ids(deleted).items():
+            print('Deleted: {} (frame id {})'.format(path, frame_id))
+    return ret_frames, changed, deleted
+
+
 def create_version_with_frames(ds_name, version_name, version_frames, bucket=None, path=None):
     ds = DatasetVersion.create_new_dataset(ds_name)
     # get new version in a Dataset (this is our version we will upload to)
@@ -53,9 +96,79 @@ if __name__ == '__main__':
     parser.add_argument('--ds_name', type=str, help='Dataset name for the data', required=True)
     parser.add_argument('--version_name', type=str, help='Version name for the data (default is current version)')
     parser.add_argument('--bucket', type=str, help='Bucket path to upload the data to (s3://bucket/folder/)')
+    parser.add_argument('--manifest', type=str, help='Local manifest file, register only new or modified files')
+    parser.add_argument('--upload_workers', type=int, help='Upload the files with N threads before registration')
+    parser.add_argument('--part_size_mb', type=int, help='Multipart upload part size in MB', default=8)
+    parser.add_argument('--upload_journal', type=str, help='Upload journal file', default='upload_journal.jsonl')
+    parser.add_argument('--endpoint_url', type=str, help='S3 compatible server url, for the upload workers')
+    parser.add_argument('--probe_workers', type=int, help='Set the frames width/height from the image headers')
+    parser.add_argument('--probe_cache', type=str, help='Image probe cache file', default='probe_cache.sqlite')
+    parser.add_argument('--preview_dest', type=str, help='Render previews into this bucket path or local folder')
+    parser.add_argument('--preview_size', type=int, help='Maximum preview width and height', default=256)
+    parser.add_argument('--preview_format', type=str, help='Preview format (webp or jpg)', default='webp')
+    parser.add_argument('--near_dup_threshold', type=int, help='Tag images within N bits of a perceptual hash')
+    parser.add_argument('--near_dup_skip', action='store_true', help='Do not register the near-duplicate images')
+    parser.add_argument('--near_dup_index', type=str, help='Perceptual hashes file', default='near_dup_index.sqlite')
 
     args = parser.parse_args()
 
-    frames = get_frames(args.path, args.ext)
+    def skip_near_duplicates(version_frames):
+        if args.near_dup_threshold is None:
+            return version_frames
+        index = PerceptualIndex(args.near_dup_index)
+        kept, _ = mark_near_duplicates(version_frames, args.near_dup_threshold, args.near_dup_skip, index)
+        index.close()
+        return kept
+
+    def probe(version_frames, content_hashes=None):
+        if not args.probe_workers:
+            return
+        cache = ProbeCache(args.probe_cache)
+        probed = probe_frames(version_frames, args.probe_workers, cache, content_hashes)
+        cache.close()
+        print('Probed the dimensions of {} frames'.format(probed))
+
+    def previews(version_frames, content_hashes=None):
+        if not args.preview_dest:
+            return
+        generator = PreviewGenerator(
+            args.preview_dest, args.preview_size, args.preview_format, endpoint_url=args.endpoint_url)
+        generator.generate(version_frames, content_hashes)
+        generator.close()
+
+    def upload_and_create_version(version_frames, content_hashes=None):
+        if args.upload_workers and args.bucket:
+            uploader = FrameUploader(
+                args.bucket,
+                workers=args.upload_workers,
+                part_size=args.part_size_mb * 1024 * 1024,
+                journal=args.upload_journal,
+                endpoint_url=args.endpoint_url,
+            )
+            # the frames sources are replaced with the uploaded files, no need for auto upload
+            uploader.upload_frames(version_frames, content_hashes)
+            create_version_with_frames(args.ds_name, args.version_name, version_frames)
+        else:
+            create_version_with_frames(args.ds_name, args.version_name, version_frames, args.bucket, args.path)
+
+    if args.manifest:
+        file_manifest = FileManifest(args.manifest)
+        frames, entries, deleted_files = get_changed_frames(args.path, args.ext, file_manifest)
+        frames = skip_near_duplicates(frames)
+        # the sources are replaced by the upload, keep the frame of every file
+        file_frames = {f.source: f for f in frames}
+        if frames:
+            content_hashes = {entry.path: entry.hash for entry in entries}
+            probe(frames, content_hashes)
+            previews(frames, content_hashes)
+            upload_and_create_version(frames, content_hashes)
+        # the skipped near-duplicates are recorded without a frame id, so they are not checked again
+        file_manifest.record(entries, [getattr(file_frames.get(entry.path), "id", None) for entry in entries])
+        file_manifest.forget(deleted_files)
+        file_manifest.close()
+    else:
+        frames = skip_near_duplicates(get_frames(args.path, args.ext))
 
-    create_version_with_frames(args.ds_name, args.version_name, frames, args.bucket, args.path)
+        probe(frames)
+        previews(frames)
+        upload_and_create_version(frames)
@@ -12,13 +12,34 @@ Example:
 You can run this example from this dir with:
 
 python register_s3_buckets.py --ds_name coco_sample --bucket s3://bucket/folder/
+
+For buckets with many objects, add `--concurrency N`: up to N folders are listed and registered at the same time,
+each as its own version, and the frames are streamed to add_frames in chunks of `--chunk_size` frames (local folders
+are listed incrementally, a bucket folder listing is loaded at once, see iter_folder).
+A local folder can be used instead of a bucket (e.g. for testing), `--bucket /path/to/base_folder/`.
+
+Add `--probe_workers N` to set the frames width and height: only the first KB of every image is read (a ranged read
+from the bucket) by N threads, and the results are cached in `--probe_cache` (see image_probe.py).
+
+To register the bucket again after a change, add `--delta_index fingerprints.sqlite`: only the frames that changed
+since the last registration of each version are sent, the missing versions are created (see delta_commit.py). The
+folders are then registered one after the other.
+
+Add `--preview_dest s3://bucket/previews/` to render a small preview of every image and set the frames preview_source
+(see preview_generator.py).
 """
 import os
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 from allegroai import DatasetVersion, SingleFrame
 from clearml import StorageManager
 
+from delta_commit import delta_commit_version
+from image_probe import ProbeCache, probe_frames
+from preview_generator import PreviewGenerator
+
 
 def create_frames(bucket):
     """
@@ -61,14 +82,141 @@ def create_version_with_frames(ds_name, frames_dict):
         print('Done uploading {} frames to version {}'.format(len(frames), version_name))
 
 
+def _local_path(path):
+    if "://" not in path or path.startswith("file://"):
+        return path[len("file://"):] if path.startswith("file://") else path
+    return None
+
+
+def list_folder(path):
+    """
+    List a bucket or a local folder
+    :param path: Bucket path (s3://bucket/folder/) or local folder
+    :return: list of full paths of the folder entries
+    """
+    local_path = _local_path(path)
+    if local_path is not None:
+        return [os.path.join(local_path, name) for name in sorted(os.listdir(local_path))]
+    return StorageManager.list(path, return_full_path=True)
+
+
+def iter_folder(path):
+    """
+    Stream the entries of a bucket or a local folder.
+    A local folder is read with os.scandir, one directory block at a time. StorageManager.list has no pagination, so
+    a bucket folder listing is still loaded at once (only the object paths, not the frames built from them).
+    :param path: Bucket path (s3://bucket/folder/) or local folder
+    :return: generator of the full paths of the folder entries (local entries are not sorted)
+    """
+    local_path = _local_path(path)
+    if local_path is None:
+        for file in StorageManager.list(path, return_full_path=True):
+            yield file
+        return
+    for entry in os.scandir(local_path):
+        yield os.path.join(local_path, entry.name)
+
+
+def iter_folder_frames(files_path):
+    """
+    Stream the frames of a single version folder
+    :param files_path: The version folder path
+    :return: generator of SingleFrame
+    """
+    for file in iter_folder(files_path):
+        yield SingleFrame(source=file)
+
+
+def register_version(dataset, version_name, files_path, chunk_size=1000, probe_workers=None, probe_cache=None,
+                     previews=None):
+    """
+    List a folder and register its files as a new version, adding the frames in chunks
+    :param dataset: The dataset to create the version in
+    :param version_name: Name of the new version
+    :param files_path: The version folder path
+    :param chunk_size: Number of frames per add_frames call
+    :param probe_workers: If given, set the frames width/height from the image headers with this number of threads
+    :param probe_cache: Optional ProbeCache for the image headers probing
+    :param previews: If given, PreviewGenerator setting the frames preview_source
+    :return: number of registered frames
+    """
+    dv = dataset.create_version(version_name=version_name)
+    frames = iter_folder_frames(files_path)
+    total = 0
+    frames_chunk = list(islice(frames, chunk_size))
+    while frames_chunk:
+        if probe_workers:
+            probe_frames(frames_chunk, probe_workers, probe_cache)
+        if previews:
+            previews.generate(frames_chunk)
+        dv.add_frames(frames_chunk)
+        total += len(frames_chunk)
+        frames_chunk = list(islice(frames, chunk_size))
+    dv.commit_version()
+    print('Done uploading {} frames to version {}'.format(total, version_name))
+    return total
+
+
+def register_versions_concurrently(ds_name, bucket, concurrency=4, chunk_size=1000, probe_workers=None,
+                                   probe_cache=None, previews=None):
+    """
+    Register each folder in the bucket as a version, listing and registering up to `concurrency` folders at once
+    :param ds_name: Dataset name for the versions
+    :param bucket: The bucket root path (or local folder) to folders to write in the dataset
+    :param concurrency: Maximum number of folders processed at the same time
+    :param chunk_size: Number of frames per add_frames call
+    :param probe_workers: If given, set the frames width/height from the image headers with this number of threads
+    :param probe_cache: Optional ProbeCache for the image headers probing
+    :param previews: If given, PreviewGenerator setting the frames preview_source
+    :return: dictionary with version name and number of registered frames
+    """
+    ds = DatasetVersion.create_new_dataset(ds_name)
+    folders = [os.path.basename(f.rstrip("/")) for f in list_folder(bucket)]
+    print("Going over the follow: {}".format(folders))
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {
+            folder: pool.submit(register_version, ds, folder, os.path.join(bucket, folder), chunk_size,
+                                probe_workers, probe_cache, previews)
+            for folder in folders
+        }
+        return {folder: future.result() for folder, future in futures.items()}
+
+
 if __name__ == '__main__':
     parser = ArgumentParser(description='Register allegro dataset from S3 bucket')
 
     parser.add_argument('--ds_name', type=str, help='Dataset name for the data', required=True)
     parser.add_argument('--bucket', type=str, help='Bucket root path to copy the data from')
+    parser.add_argument('--concurrency', type=int, help='Folders to list and register in parallel (streaming mode)')
+    parser.add_argument('--chunk_size', type=int, help='Frames per add_frames call in streaming mode', default=1000)
+    parser.add_argument('--probe_workers', type=int, help='Set the frames width/height from the image headers')
+    parser.add_argument('--probe_cache', type=str, help='Image probe cache file', default='probe_cache.sqlite')
+    parser.add_argument('--preview_dest', type=str, help='Render previews into this bucket path or local folder')
+    parser.add_argument('--preview_size', type=int, help='Maximum preview width and height', default=256)
+    parser.add_argument('--delta_index', type=str, help='Local fingerprint index, send only the changed frames')
 
     args = parser.parse_args()
 
-    ver_frames_dict = create_frames(args.bucket)
+    cache = ProbeCache(args.probe_cache) if args.probe_workers else None
+    generator = PreviewGenerator(args.preview_dest, args.preview_size) if args.preview_dest else None
+    if args.concurrency and not args.delta_index:
+        register_versions_concurrently(
+            args.ds_name, args.bucket, args.concurrency, args.chunk_size, args.probe_workers, cache, generator)
+    else:
+        ver_frames_dict = create_frames(args.bucket)
+        for version_frames in ver_frames_dict.values():
+            if args.probe_workers:
+                probe_frames(version_frames, args.probe_workers, cache)
+            if generator:
+                generator.generate(version_frames)
 
-    create_version_with_frames(args.ds_name, ver_frames_dict)
+        if args.delta_index:
+            for version_name, version_frames in ver_frames_dict.items():
+                delta_commit_version(
+                    version_frames, args.ds_name, version_name, args.delta_index, chunk_size=args.chunk_size)
+        else:
+            create_version_with_frames(args.ds_name, ver_frames_dict)
+    if cache:
+        cache.close()
+    if generator:
+        generator.close()
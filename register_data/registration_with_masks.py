@@ -0,0 +1,221 @@
+"""
+How to register segmentation data, with ROIs extracted from color masks.
+
+Each image `<name>.png` has a paired mask `<name>_mask.png`, and `_mask_legend.json` maps each class name to its mask
+RGB color (see data/sample_ds_with_masks). Every mask is read once, its colors are mapped to class ids with a lookup
+table, and the bounding box and pixel area of every class are computed with whole array operations. Each class
+present in the mask becomes a box ROI (with its area in the ROI metadata), and optionally polygon ROIs of its
+contours. The masks are processed by a pool of processes.
+
+You can run this example from this dir with:
+
+python registration_with_masks.py
+--path data/sample_ds_with_masks --ds_name my_segmentation_dataset --version_name my_version
+
+To register the folder again after a change, add `--delta_index fingerprints.sqlite`: only the frames that changed
+since the last registration are sent (see delta_commit.py).
+
+Compare the vectorized extraction with a naive per-pixel implementation (no registration) with:
+
+python registration_with_masks.py --path data/sample_ds_with_masks --benchmark
+"""
+import glob
+import json
+import os
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from time import time
+
+import numpy as np
+from PIL import Image
+
+from allegroai import DatasetVersion, SingleFrame
+
+from delta_commit import delta_commit_version
+
+MASK_SUFFIX = "_mask.png"
+LEGEND_FILE = "_mask_legend.json"
+
+
+def load_legend(folder):
+    """
+    :param folder: The dataset folder
+    :return: tuple of (list of class names, sorted uint32 array of packed RGB colors, matching class ids array)
+    """
+    with open(os.path.join(folder, LEGEND_FILE), "r") as f:
+        legend = json.load(f)
+    names = sorted(legend.keys())
+    colors = np.array([(r << 16) | (g << 8) | b for r, g, b in (legend[n] for n in names)], dtype=np.uint32)
+    order = np.argsort(colors)
+    return names, colors[order], order.astype(np.int32)
+
+
+def read_class_map(mask_path, colors, class_ids):
+    """
+    Read a mask and map its colors to class ids
+    :param mask_path: Mask file path
+    :param colors: Sorted packed RGB colors of the legend
+    :param class_ids: Class id of each color
+    :return: int32 (H, W) class ids array, -1 for colors not in the legend
+    """
+    mask = np.asarray(Image.open(mask_path))
+    if mask.ndim == 2:
+        # grayscale mask, R=G=B
+        packed = mask.astype(np.uint32) * 0x010101
+    else:
+        mask = mask[..., :3].astype(np.uint32)
+        packed = (mask[..., 0] << 16) | (mask[..., 1] << 8) | mask[..., 2]
+    idx = np.searchsorted(colors, packed).clip(0, len(colors) - 1)
+    return np.where(colors[idx] == packed, class_ids[idx], -1)
+
+
+def extract_rois(mask_path, colors, class_ids, num_classes, with_polygons=False):
+    """
+    Compute the bounding box and area of every class in a mask
+    :param mask_path: Mask file path
+    :param colors: Sorted packed RGB colors of the legend
+    :param class_ids: Class id of each color
+    :param num_classes: Number of classes in the legend
+    :param with_polygons: Also extract the contours polygons of each class
+    :return: list of (class id, (x, y, w, h), area, list of polygons) for the classes present in the mask
+    """
+    class_map = read_class_map(mask_path, colors, class_ids)
+    height, width = class_map.shape
+    valid = class_map >= 0
+    ids = np.where(valid, class_map, num_classes)
+
+    areas = np.bincount(ids.ravel(), minlength=num_classes + 1)[:num_classes]
+    # per row / per column pixel count of each class
+    rows = np.bincount((np.arange(height)[:, None] * (num_classes + 1) + ids).ravel(),
+                       minlength=height * (num_classes + 1)).reshape(height, num_classes + 1)[:, :num_classes] > 0
+    cols = np.bincount((np.arange(width)[None, :] * (num_classes + 1) + ids).ravel(),
+                       minlength=width * (num_classes + 1)).reshape(width, num_classes + 1)[:, :num_classes] > 0
+    y_min = rows.argmax(axis=0)
+    y_max = height - 1 - rows[::-1].argmax(axis=0)
+    x_min = cols.argmax(axis=0)
+    x_max = width - 1 - cols[::-1].argmax(axis=0)
+
+    rois = []
+    for class_id in np.flatnonzero(areas):
+        box = (int(x_min[class_id]), int(y_min[class_id]),
+               int(x_max[class_id] - x_min[class_id] + 1), int(y_max[class_id] - y_min[class_id] + 1))
+        polygons = class_polygons(class_map == class_id) if with_polygons else []
+        rois.append((int(class_id), box, int(areas[class_id]), polygons))
+    return rois
+
+
+def class_polygons(binary_mask, min_points=3):
+    """
+    :param binary_mask: bool (H, W) array of a single class
+    :return: list of flat [x1, y1, x2, y2, ...] polygons of the class outer contours
+    """
+    import cv2
+    contours, _ = cv2.findContours(binary_mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return [c.reshape(-1).astype(float).tolist() for c in contours if len(c) >= min_points]
+
+
+def extract_rois_naive(mask_path, colors, class_ids, num_classes):
+    """
+    Reference implementation, going over the mask pixel by pixel
+    :return: same as extract_rois (without polygons)
+    """
+    mask = Image.open(mask_path).convert("RGB")
+    width, height = mask.size
+    pixels = mask.load()
+    lookup = {int(c): int(i) for c, i in zip(colors, class_ids)}
+    boxes = {}
+    for y in range(height):
+        for x in range(width):
+            r, g, b = pixels[x, y]
+            class_id = lookup.get((r << 16) | (g << 8) | b)
+            if class_id is None:
+                continue
+            x0, y0, x1, y1, area = boxes.get(class_id, (x, y, x, y, 0))
+            boxes[class_id] = (min(x0, x), min(y0, y), max(x1, x), max(y1, y), area + 1)
+    return [(class_id, (x0, y0, x1 - x0 + 1, y1 - y0 + 1), area, [])
+            for class_id, (x0, y0, x1, y1, area) in sorted(boxes.items())]
+
+
+def _extract_worker(args):
+    image_path, mask_path, colors, class_ids, num_classes, with_polygons = args
+    return image_path, extract_rois(mask_path, colors, class_ids, num_classes, with_polygons)
+
+
+def iter_mask_rois(folder, workers=None, with_polygons=False):
+    """
+    Extract the ROIs of all the masks in a folder with a pool of processes
+    :param folder: The dataset folder
+    :param workers: Number of processes (default: number of cores)
+    :param with_polygons: Also extract the contours polygons of each class
+    :return: generator of (image path, list of class names, list of ROIs as returned by extract_rois)
+    """
+    names, colors, class_ids = load_legend(folder)
+    jobs = (
+        (os.path.abspath(mask_path[:-len(MASK_SUFFIX)] + ".png"), mask_path, colors, class_ids, len(names),
+         with_polygons)
+        for mask_path in sorted(glob.glob(os.path.join(folder, "*" + MASK_SUFFIX)))
+    )
+    pool = Pool(processes=workers)
+    try:
+        for image_path, rois in pool.imap(_extract_worker, jobs, chunksize=4):
+            yield image_path, names, rois
+    finally:
+        pool.terminate()
+
+
+def get_frames_with_mask_rois(folder, workers=None, with_polygons=False):
+    frames = []
+    for image_path, names, rois in iter_mask_rois(folder, workers, with_polygons):
+        frame = SingleFrame(source=image_path)
+        for class_id, box, area, polygons in rois:
+            frame.add_annotation(box2d_xywh=box, labels=[names[class_id]], metadata={'area': area})
+            for poly in polygons:
+                frame.add_annotation(poly2d_xy=poly, labels=[names[class_id]])
+        frames.append(frame)
+    return frames
+
+
+def benchmark(folder):
+    names, colors, class_ids = load_legend(folder)
+    for mask_path in sorted(glob.glob(os.path.join(folder, "*" + MASK_SUFFIX))):
+        start = time()
+        rois = extract_rois(mask_path, colors, class_ids, len(names))
+        vectorized_time = time() - start
+        start = time()
+        naive_rois = extract_rois_naive(mask_path, colors, class_ids, len(names))
+        naive_time = time() - start
+        print("{}: vectorized {:.3f}s, naive {:.3f}s, same results: {}".format(
+            os.path.basename(mask_path), vectorized_time, naive_time, rois == naive_rois))
+
+
+def create_version_with_frames(new_frames, ds_name, ver_name):
+    # Get the dataset (will create a new one if we don't have such) version
+    ds = DatasetVersion.create_new_dataset(dataset_name=ds_name)
+    dv = ds.create_version(version_name=ver_name) if ver_name else DatasetVersion.get_current(dataset_name=ds_name)
+    # Add frames to created version
+    dv.add_frames(new_frames)
+    dv.commit_version()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Register allegro dataset with rois from segmentation masks')
+
+    parser.add_argument('--path', type=str, help='Path to the folder you like to register.', required=True)
+    parser.add_argument('--ds_name', type=str, help='Dataset name for the data')
+    parser.add_argument('--version_name', type=str, help='Version name for the data (default is current version)')
+    parser.add_argument('--workers', type=int, help='Number of processes (default: cores count)')
+    parser.add_argument('--polygons', action='store_true', help='Also add polygon ROIs of each class contours')
+    parser.add_argument('--delta_index', type=str, help='Local fingerprint index, send only the changed frames')
+    parser.add_argument('--benchmark', action='store_true', help='Compare with the naive extraction and exit')
+
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.path)
+    else:
+        frames = get_frames_with_mask_rois(args.path, args.workers, args.polygons)
+        if args.delta_index:
+            delta_commit_version(frames, args.ds_name, args.version_name, args.delta_index)
+        else:
+            create_version_with_frames(frames, args.ds_name, args.version_name)
+        print("We are done :)")
@@ -8,25 +8,46 @@ You can run this example from this dir with:
 
 python registration_with_roi_and_meta.py
 --path data/sample_ds --ext jpg --ds_name my_uploaded_dataset --version_name my_version
+
+For large folders, add `--streaming`: each json file is parsed once, the frames are built by a pool of
+`--workers` processes, and sent to the version in chunks of `--chunk_size` frames, so memory stays flat.
+
+If the json files were packed into a columnar store (see annotation_store.py), register from it with
+`--store sample_ds.npz` instead of reading the json files.
+
+To register the folder again after a change, add `--delta_index fingerprints.sqlite`: only the frames whose source,
+metadata or annotations changed since the last registration with the same index are sent, and the frames that are not
+in the folder anymore are deleted from the version (see delta_commit.py). A missing version is created as a child of
+the current version, and its index starts from the index of the current version (or from the server content, when
+the index has nothing for the version).
 """
 import glob
 import json
 import os
 from argparse import ArgumentParser
+from itertools import islice
+from multiprocessing import Pool
 
 from allegroai import DatasetVersion, SingleFrame
 from pathlib2 import Path
 
+from annotation_store import AnnotationStore
+from bulk_annotations import add_annotations
+from delta_commit import delta_commit_version
+
 
-def add_rois_to_frame(filename, a_frame):
+def add_rois_to_frame(filename, a_frame, data=None):
     """
     Add the ROIs for each frame
     :param filename: Full file path
     :type filename: str
     :param a_frame: Frame to add ROIs
     :type a_frame: SingleFrame
+    :param data: The already parsed json data of the file (optional)
+    :type data: dict
     """
-    data = get_json_file(filename)
+    if data is None:
+        data = get_json_file(filename)
 
     # Iterating over rois in the json
     for roi in data['rois']:
@@ -38,15 +59,18 @@ def add_rois_to_frame(filename, a_frame):
         )
 
 
-def add_frame_meta(filename, single_frame):
+def add_frame_meta(filename, single_frame, data=None):
     """
     Add the metadata for each frame
     :param filename: Full file path
     :type filename: str
     :param single_frame: Frame to add metadata
     :type single_frame: SingleFrame
+    :param data: The already parsed json data of the file (optional)
+    :type data: dict
     """
-    data = get_json_file(filename)
+    if data is None:
+        data = get_json_file(filename)
     single_frame.width = data['size']['x']
     single_frame.height = data['size']['y']
     single_frame.metadata['dangerous'] = data['meta']['dangerous']
@@ -85,12 +109,126 @@ def get_frames_with_roi_meta(ext):
     return fr
 
 
-def create_version_with_frames(new_frames, ds_name, ver_name):
+def build_frame(full_path):
+    """
+    Create a SingleFrame with its ROIs and metadata, parsing the json file once
+    :param full_path: Full file path
+    :type full_path: str
+    :return: SingleFrame
+    """
+    data = get_json_file(full_path)
+    frame = SingleFrame(source=full_path)
+    add_rois_to_frame(full_path, frame, data=data)
+    add_frame_meta(full_path, frame, data=data)
+    return frame
+
+
+def iter_frames_with_roi_meta(folder, ext, workers=None, window=1000):
+    """
+    Streaming version of get_frames_with_roi_meta, frames are built by a pool of processes
+    :param folder: The folder with the images and json files
+    :type folder: str
+    :param ext: Images extension
+    :type ext: str
+    :param workers: Number of processes (default: number of cores)
+    :type workers: int
+    :param window: Number of files submitted to the pool together, at most two windows of frames are built ahead
+        of the consumer (Pool.imap alone reads all its inputs at once)
+    :type window: int
+    :return: generator of SingleFrame, in the files listing order
+    """
+    files = (os.path.abspath(f) for f in glob.iglob(os.path.join(folder, "*.{}".format(ext))))
+    pool = Pool(processes=workers)
+    chunksize = max(1, min(64, window // (4 * (workers or os.cpu_count()))))
+    try:
+        current = pool.imap(build_frame, list(islice(files, window)), chunksize=chunksize)
+        while current is not None:
+            # the next window is built while the consumer handles the current one
+            next_files = list(islice(files, window))
+            following = pool.imap(build_frame, next_files, chunksize=chunksize) if next_files else None
+            for frame in current:
+                yield frame
+            current = following
+    finally:
+        pool.terminate()
+
+
+def iter_frames_from_store(store_path, folder, block_size=1024):
+    """
+    Create the frames from a columnar annotation store instead of the json files
+    :param store_path: .npz store created by annotation_store.pack_sidecars
+    :type store_path: str
+    :param folder: The folder with the images
+    :type folder: str
+    :param block_size: Number of frames annotated together (see bulk_annotations.add_annotations)
+    :type block_size: int
+    :return: generator of SingleFrame
+    """
+    store = AnnotationStore(store_path)
+    c = store.columns
+    roi_meta = [{'alive': json.loads(str(meta))['alive']} for meta in c["roi_meta_table"]]
+    for first in range(0, len(store), block_size):
+        last = min(first + block_size, len(store))
+        frames = []
+        for idx in range(first, last):
+            frame = SingleFrame(source=os.path.abspath(os.path.join(folder, str(c["image"][idx]))))
+            frame.width = int(c["width"][idx])
+            frame.height = int(c["height"][idx])
+            frame.metadata['dangerous'] = json.loads(str(c["meta_table"][c["meta_ids"][idx]]))['dangerous']
+            frame.preview_source = str(c["url"][idx])
+            frames.append(frame)
+
+        # the rois of the block are contiguous in the store columns
+        r0, r1 = c["roi_frame_offsets"][first], c["roi_frame_offsets"][last]
+        p0, p1 = c["roi_poly_offsets"][r0], c["roi_poly_offsets"][r1]
+        l0, l1 = c["roi_label_offsets"][r0], c["roi_label_offsets"][r1]
+        add_annotations(
+            frames,
+            frame_offsets=c["roi_frame_offsets"][first:last + 1] - r0,
+            label_ids=c["roi_label_ids"][l0:l1],
+            label_offsets=c["roi_label_offsets"][r0:r1 + 1] - l0,
+            label_table=c["label_table"],
+            poly2d_xy=c["roi_poly"][p0:p1],
+            poly_offsets=c["roi_poly_offsets"][r0:r1 + 1] - p0,
+            confidence=c["roi_confidence"][r0:r1],
+            metadata=[roi_meta[i] for i in c["roi_meta_ids"][r0:r1]],
+            # the same rois as the json path, which does not validate them
+            validate=False,
+        )
+        for frame in frames:
+            yield frame
+
+
+def chunks(iterable, chunk_size):
+    """
+    Split an iterable into lists of up to chunk_size items
+    """
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunk_size))
+
+
+def create_version_with_frames(new_frames, ds_name, ver_name, chunk_size=None):
+    """
+    :param new_frames: list or generator of frames to add
+    :param ds_name: Dataset name
+    :param ver_name: Version name (default is current version)
+    :param chunk_size: If given, send the frames to the version in chunks of this size
+    """
     # Get the dataset (will create a new one if we don't have such) version
     ds = DatasetVersion.create_new_dataset(dataset_name=ds_name)
     dv = ds.create_version(version_name=ver_name) if ver_name else DatasetVersion.get_current(dataset_name=ds_name)
     # Add frames to created version
-    dv.add_frames(new_frames)
+    if chunk_size:
+        total = 0
+        for frames_chunk in chunks(new_frames, chunk_size):
+            dv.add_frames(frames_chunk)
+            total += len(frames_chunk)
+            print("Added {} frames".format(total))
+    else:
+        dv.add_frames(new_frames)
     dv.commit_version()
 
 
@@ -101,6 +239,11 @@ if __name__ == '__main__':
     parser.add_argument('--ext', type=str, help='Files extension to upload from the dir. Default', default="*")
     parser.add_argument('--ds_name', type=str, help='Dataset name for the data', required=True)
     parser.add_argument('--version_name', type=str, help='Version name for the data (default is current version)')
+    parser.add_argument('--streaming', action='store_true', help='Build frames in parallel and add them in chunks')
+    parser.add_argument('--workers', type=int, help='Number of processes for --streaming (default: cores count)')
+    parser.add_argument('--chunk_size', type=int, help='Frames per add_frames call for --streaming', default=1000)
+    parser.add_argument('--store', type=str, help='Columnar annotation store to register from, instead of json files')
+    parser.add_argument('--delta_index', type=str, help='Local fingerprint index, send only the changed frames')
 
     args = parser.parse_args()
 
@@ -109,7 +252,19 @@ if __name__ == '__main__':
     dataset_name = args.ds_name
     version_name = args.version_name
 
-    frames = get_frames_with_roi_meta(args.ext)
-
-    create_version_with_frames(frames, dataset_name, version_name)
+    if args.delta_index:
+        if args.store:
+            frames = iter_frames_from_store(args.store, base_path)
+        else:
+            frames = iter_frames_with_roi_meta(base_path, args.ext, args.workers, args.chunk_size)
+        delta_commit_version(frames, dataset_name, version_name, args.delta_index, chunk_size=args.chunk_size)
+    elif args.store:
+        frames = iter_frames_from_store(args.store, base_path)
+        create_version_with_frames(frames, dataset_name, version_name, chunk_size=args.chunk_size)
+    elif args.streaming:
+        frames = iter_frames_with_roi_meta(base_path, args.ext, args.workers, args.chunk_size)
+        create_version_with_frames(frames, dataset_name, version_name, chunk_size=args.chunk_size)
+    else:
+        frames = get_frames_with_roi_meta(args.ext)
+        create_version_with_frames(frames, dataset_name, version_name)
     print("We are done :)")
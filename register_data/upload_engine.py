@@ -0,0 +1,320 @@
+"""
+Parallel, resumable upload of local frames before registration.
+
+Instead of uploading with `add_frames(auto_upload_destination=...)` in one blocking step, the frames files are pushed
+to the destination by a pool of threads, large files are split into parts (S3 multipart upload), and every finished
+file and part is written to a journal file, keyed by the file path, size and modification time. If the run is
+interrupted, running it again with the same journal resumes where it stopped (files modified since are uploaded again),
+and once all the files are uploaded the journal is removed. Once uploaded, the SingleFrame source is replaced with the
+uploaded URI, so the frames can be added to the version without auto upload.
+
+The files are stored by content hash (`<sha256[:2]>/<sha256><ext>`, the same hash as file_manifest.py), so files with
+the same content are uploaded once: in the same run, and across runs for contents already in the destination.
+
+The destination can be an S3 bucket (s3://bucket/folder/, any S3 compatible server with `endpoint_url`) or a local
+folder (useful for testing).
+
+Usage:
+    uploader = FrameUploader("s3://bucket/folder/", workers=16, part_size=8 * 1024 * 1024, journal="journal.jsonl")
+    uploader.upload_frames(frames)
+    print(uploader.stats)
+"""
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from time import time
+
+from file_manifest import file_hash
+
+
+class LocalTarget(object):
+    """
+    Upload destination in a local folder
+    """
+
+    def __init__(self, root):
+        self._root = root[len("file://"):] if root.startswith("file://") else root
+
+    def uri(self, key):
+        return os.path.join(self._root, key)
+
+    def put(self, key, path):
+        os.makedirs(os.path.dirname(self.uri(key)), exist_ok=True)
+        shutil.copyfile(path, self.uri(key) + ".partial")
+        os.rename(self.uri(key) + ".partial", self.uri(key))
+
+    def put_bytes(self, key, data):
+        os.makedirs(os.path.dirname(self.uri(key)), exist_ok=True)
+        with open(self.uri(key) + ".partial", "wb") as f:
+            f.write(data)
+        os.rename(self.uri(key) + ".partial", self.uri(key))
+
+    def exists(self, key):
+        return os.path.exists(self.uri(key))
+
+    def start_multipart(self, key, size):
+        os.makedirs(os.path.dirname(self.uri(key)), exist_ok=True)
+        with open(self.uri(key) + ".partial", "wb") as f:
+            f.truncate(size)
+        return self.uri(key) + ".partial"
+
+    def put_part(self, key, upload_id, number, offset, data):
+        with open(upload_id, "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+        return str(number)
+
+    def complete_multipart(self, key, upload_id, parts):
+        os.rename(upload_id, self.uri(key))
+
+
+class S3Target(object):
+    """
+    Upload destination in an S3 (or S3 compatible) bucket
+    """
+
+    def __init__(self, root, endpoint_url=None):
+        import boto3
+        bucket, _, prefix = root[len("s3://"):].partition("/")
+        self._bucket = bucket
+        self._prefix = prefix.strip("/")
+        self._client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def _key(self, key):
+        return "{}/{}".format(self._prefix, key) if self._prefix else key
+
+    def uri(self, key):
+        return "s3://{}/{}".format(self._bucket, self._key(key))
+
+    def put(self, key, path):
+        with open(path, "rb") as f:
+            self._client.put_object(Bucket=self._bucket, Key=self._key(key), Body=f)
+
+    def put_bytes(self, key, data):
+        self._client.put_object(Bucket=self._bucket, Key=self._key(key), Body=data)
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self._client.head_object(Bucket=self._bucket, Key=self._key(key))
+            return True
+        except ClientError:
+            return False
+
+    def start_multipart(self, key, size):
+        return self._client.create_multipart_upload(Bucket=self._bucket, Key=self._key(key))["UploadId"]
+
+    def put_part(self, key, upload_id, number, offset, data):
+        return self._client.upload_part(
+            Bucket=self._bucket, Key=self._key(key), UploadId=upload_id, PartNumber=number, Body=data)["ETag"]
+
+    def complete_multipart(self, key, upload_id, parts):
+        self._client.complete_multipart_upload(
+            Bucket=self._bucket, Key=self._key(key), UploadId=upload_id,
+            MultipartUpload={"Parts": [{"PartNumber": n, "ETag": etag} for n, etag in sorted(parts.items())]})
+
+
+def get_target(destination, endpoint_url=None):
+    """
+    :param destination: s3://bucket/folder/ or a local folder
+    :param endpoint_url: S3 compatible server url
+    :return: S3Target or LocalTarget
+    """
+    if destination.startswith("s3://"):
+        return S3Target(destination, endpoint_url)
+    return LocalTarget(destination)
+
+
+def file_identity(path):
+    """
+    :return: tuple of (path, size, modification time in ns), a modified file is uploaded again
+    """
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime_ns
+
+
+def content_key(path, content_hash=None):
+    """
+    :param path: File path
+    :param content_hash: The file sha256 hex digest, if already known
+    :return: the key of the file in the destination, by content hash (keeping the file extension)
+    """
+    content_hash = content_hash or file_hash(path)
+    return "{}/{}{}".format(content_hash[:2], content_hash, os.path.splitext(path)[1].lower())
+
+
+def _id_record(file_id):
+    path, size, mtime = file_id
+    return {"path": path, "size": size, "mtime": mtime}
+
+
+class FrameUploader(object):
+    def __init__(self, destination, workers=8, part_size=8 * 1024 * 1024, journal=None, endpoint_url=None):
+        """
+        :param destination: s3://bucket/folder/ or a local folder
+        :type destination: str
+        :param workers: Number of upload threads
+        :type workers: int
+        :param part_size: Files larger than this are uploaded in parts of this size (S3 minimum is 5MB)
+        :type part_size: int
+        :param journal: Journal file path, an interrupted upload with the same journal is resumed
+        :type journal: str
+        :param endpoint_url: S3 compatible server url (e.g. a local S3 server)
+        :type endpoint_url: str
+        """
+        self._target = get_target(destination, endpoint_url)
+        self._workers = workers
+        self._part_size = part_size
+        self._journal_path = journal
+        self._journal_lock = threading.Lock()
+        self._done, self._started, self._parts = self._read_journal()
+        # key to URI of the contents stored in this run
+        self._stored = {}
+        self.stats = {"files": 0, "skipped": 0, "deduplicated": 0, "bytes": 0, "seconds": 0.0, "bytes_per_sec": 0.0}
+
+    def upload_frames(self, frames, content_hashes=None, batch_size=1000):
+        """
+        Upload the frames sources, and replace each frame source with the uploaded URI
+        :param frames: list of SingleFrame with local sources
+        :param content_hashes: Optional dictionary of frame source to its sha256 (e.g. from the FileManifest entries),
+            the other files are hashed by the upload threads
+        :param batch_size: Number of files scheduled together
+        :return: the frames
+        """
+        start = time()
+        content_hashes = content_hashes or {}
+        frames_iter = iter(frames)
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            batch = list(islice(frames_iter, batch_size))
+            while batch:
+                self._upload_batch(pool, batch, content_hashes)
+                batch = list(islice(frames_iter, batch_size))
+        # everything is uploaded, nothing to resume
+        self._clear_journal()
+        self.stats["seconds"] = time() - start
+        self.stats["bytes_per_sec"] = self.stats["bytes"] / max(self.stats["seconds"], 1e-6)
+        print("Uploaded {files} files ({skipped} already uploaded, {deduplicated} with an uploaded content), "
+              "{bytes} bytes, {bytes_per_sec:.0f} bytes/sec".format(**self.stats))
+        return frames
+
+    def _content_key(self, path, content_hash):
+        key = content_key(path, content_hash)
+        # a content uploaded by a previous run is not uploaded again
+        exists = key not in self._stored and self._target.exists(key)
+        return key, exists
+
+    def _upload_batch(self, pool, frames, content_hashes):
+        pending = []
+        for frame in frames:
+            file_id = file_identity(os.path.abspath(frame.source))
+            if file_id in self._done:
+                frame.source = self._done[file_id]
+                self.stats["skipped"] += 1
+                continue
+            pending.append((frame, file_id))
+        keys = pool.map(lambda item: self._content_key(item[1][0], content_hashes.get(str(item[0].source))), pending)
+        # the files of every content, only the first one is uploaded
+        contents = OrderedDict()
+        for (frame, file_id), (key, exists) in zip(pending, keys):
+            if exists:
+                self._stored[key] = self._target.uri(key)
+            contents.setdefault(key, []).append((frame, file_id))
+
+        futures = []
+        multipart = []
+        for key, files in contents.items():
+            if key in self._stored:
+                self._files_done(files, key, uploaded=False)
+                continue
+            file_id = files[0][1]
+            size = file_id[1]
+            if size <= self._part_size:
+                futures.append(pool.submit(self._upload_file, files, key))
+                continue
+            upload_id = self._started.get(file_id)
+            if upload_id is None:
+                upload_id = self._target.start_multipart(key, size)
+                self._started[file_id] = upload_id
+                self._journal(dict(_id_record(file_id), event="start", upload_id=upload_id))
+            parts = self._parts.setdefault(file_id, {})
+            for number, offset in enumerate(range(0, size, self._part_size), start=1):
+                if number not in parts:
+                    futures.append(pool.submit(self._upload_part, file_id, key, upload_id, number, offset))
+            multipart.append((files, key, upload_id))
+
+        for future in futures:
+            future.result()
+        for files, key, upload_id in multipart:
+            self._target.complete_multipart(key, upload_id, self._parts[files[0][1]])
+            self._files_done(files, key)
+
+    def _upload_file(self, files, key):
+        self._target.put(key, files[0][1][0])
+        self._files_done(files, key)
+
+    def _upload_part(self, file_id, key, upload_id, number, offset):
+        with open(file_id[0], "rb") as f:
+            f.seek(offset)
+            data = f.read(self._part_size)
+        etag = self._target.put_part(key, upload_id, number, offset, data)
+        with self._journal_lock:
+            self._parts[file_id][number] = etag
+            self.stats["bytes"] += len(data)
+        self._journal(dict(_id_record(file_id), event="part", number=number, etag=etag))
+
+    def _files_done(self, files, key, uploaded=True):
+        """
+        :param files: list of (frame, file id) with the content of key, the first one was uploaded (if uploaded)
+        """
+        uri = self._target.uri(key)
+        with self._journal_lock:
+            self._stored[key] = uri
+            for index, (frame, file_id) in enumerate(files):
+                frame.source = uri
+                self._done[file_id] = uri
+                if uploaded and index == 0:
+                    self.stats["files"] += 1
+                    if file_id not in self._started:
+                        self.stats["bytes"] += file_id[1]
+                else:
+                    self.stats["deduplicated"] += 1
+        for frame, file_id in files:
+            self._journal(dict(_id_record(file_id), event="done", uri=uri))
+
+    def _journal(self, record):
+        if not self._journal_path:
+            return
+        with self._journal_lock:
+            with open(self._journal_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def _read_journal(self):
+        done, started, parts = {}, {}, {}
+        if not self._journal_path or not os.path.exists(self._journal_path):
+            return done, started, parts
+        with open(self._journal_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line might be partial if the run was killed while writing it
+                    continue
+                file_id = (record["path"], record.get("size"), record.get("mtime"))
+                if record["event"] == "done":
+                    done[file_id] = record["uri"]
+                elif record["event"] == "start":
+                    started[file_id] = record["upload_id"]
+                    parts[file_id] = {}
+                elif record["event"] == "part":
+                    parts.setdefault(file_id, {})[record["number"]] = record["etag"]
+        return done, started, parts
+
+    def _clear_journal(self):
+        if self._journal_path and os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
+        self._done, self._started, self._parts = {}, {}, {}
+        self._stored = {}